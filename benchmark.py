@@ -0,0 +1,263 @@
+"""
+Headless benchmark of the background subtractors over the bundled clips.
+
+Every subtractor in BackgroundSubtractor.OPENCV_BG_SUBTRACTORS is run with the <name>_params block
+(and the erode/dilate/min_radius/... settings) from each config file, over each clip.  Configs that
+end up with identical detection settings are only run once.  Each run happens in a fresh process so
+the peak RSS is for that run only.
+
+Usage:
+
+python benchmark.py
+
+python benchmark.py --subtractors CNT MOG2 --pascal-voc ./config/motion_roi.xml --roi-mode crop
+
+python benchmark.py --configs ./config/rpi_headless_bg_subtract_config.json --media ./media/atv.mp4 --max-frames 200
+
+python benchmark.py --subtractors MOG --media ./media/atv.mp4 --pascal-voc ./config/motion_roi.xml --blob-modes contours components
+
+python benchmark.py --subtractors MOG --pascal-voc ./config/motion_roi.xml --gate-intervals 0 5
+
+python benchmark.py --subtractors CNT MOG MOG2 --frame-cache ./frame_cache
+
+Writes <output-dir>/benchmark_report.json and <output-dir>/benchmark_report.md
+"""
+import argparse
+import glob
+import json
+import platform
+import resource
+import time
+from multiprocessing import get_context
+from pathlib import Path
+
+import cv2
+
+from utils.BackgroundSubtractUtil import BackgroundSubtractor, BLOB_MODES
+from utils.conf import Conf
+from utils.FrameCacheUtil import FrameCache, create_frame_cache
+from utils.pascal_voc_util import read_pascal_voc_rectangles
+from utils.labelme_util import read_labelme_polygons
+from utils.StageTimerUtil import StageTimer
+
+SUBTRACTORS = ["CNT", "GMG", "MOG", "GSOC", "LSBP", "MOG2"]
+
+# config keys that change what the detector does.  Everything else (display, dropbox, ...) is ignored
+DETECTION_KEYS = ["erode_kernel", "erode_iterations", "dilate_kernel", "dilate_iterations", "min_radius",
+                  "min_area_ratio", "roi_mode", "process_width", "roi_min_inside_ratio", "blob_mode", "blob_max_aspect_ratio",
+                  "gate_interval", "gate_threshold", "gate_hold_frames", "gate_thumb_width",
+                  "lighting_change", "lighting_luminance_jump", "lighting_foreground_ratio", "lighting_transition_frames", "lighting_profiles"]
+
+# stages that find and filter the foreground blobs, for comparing the blob modes
+BLOB_STAGES = ["find_contours", "contour_loop", "components", "blob_filter"]
+
+
+def peak_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    if platform.system() == 'Darwin':
+        return max_rss / (1024 * 1024)
+    return max_rss / 1024
+
+
+def build_jobs(config_paths, subtractors, clips, overrides, blob_modes=None, gate_intervals=None):
+    """
+    :param blob_modes: run each configuration with each of these blob modes, None uses the config's
+    :param gate_intervals: run each configuration with each of these gate intervals, None uses the config's
+    :return: list of job dicts, one per unique (detection settings, clip)
+    """
+    settings = []
+    seen = set()
+    for config_path, blob_mode, gate_interval, name in [(c, b, g, n) for c in config_paths for b in (blob_modes or [None])
+                                                        for g in (gate_intervals or [None]) for n in subtractors]:
+        conf = Conf(config_path).to_dict()
+        conf.update({k: v for k, v in overrides.items() if v is not None})
+        if blob_mode is not None:
+            conf['blob_mode'] = blob_mode
+        if gate_interval is not None:
+            conf['gate_interval'] = gate_interval
+        detection_conf = {k: conf.get(k) for k in DETECTION_KEYS if conf.get(k) is not None}
+        detection_conf['named_subtractor'] = name
+        params_key = f"{name}_params"
+        if params_key in conf:
+            detection_conf[params_key] = conf[params_key]
+
+        key = json.dumps(detection_conf, sort_keys=True)
+        if key in seen:
+            continue
+        seen.add(key)
+        settings.append((Path(config_path).stem, detection_conf))
+
+    return [{"config": config_name, "conf": detection_conf, "clip": str(clip)}
+            for config_name, detection_conf in settings for clip in clips]
+
+
+def run_job(job, motion_roi_rects, motion_roi_polygons, max_frames, threads, frame_cache_dir=None):
+    """
+    Process pool worker.  Runs one subtractor configuration over one clip.
+
+    :param frame_cache_dir: read the frames from this FrameCache instead of decoding the clip
+    """
+    if threads is not None:
+        cv2.setNumThreads(threads)
+
+    conf = job['conf']
+    stage_timer = StageTimer(interval=float('inf'), window=max_frames or 1000000)
+    bg_sub = BackgroundSubtractor(**conf, motion_roi_rects=motion_roi_rects, motion_roi_polygons=motion_roi_polygons, stage_timer=stage_timer)
+
+    cap = None
+    cached_frames = None
+    if frame_cache_dir is not None:
+        # filled by the main process, so this is a hit
+        cached_frames = FrameCache(frame_cache_dir).open(job['clip']).frames
+    else:
+        cap = cv2.VideoCapture(job['clip'])
+    frames = 0
+    motion_frames = 0
+    start_time = time.perf_counter()
+    start_cpu = resource.getrusage(resource.RUSAGE_SELF)
+    while max_frames is None or frames < max_frames:
+        if cached_frames is not None:
+            if frames >= len(cached_frames):
+                break
+            frame = cached_frames[frames]
+        else:
+            grabbed, frame = cap.read()
+            if not grabbed or frame is None:
+                break
+
+        stage_timer.start()
+        motionThisFrame = bg_sub.apply(frame)[0]
+        stage_timer.end_frame()
+
+        frames += 1
+        motion_frames += int(motionThisFrame)
+    elapsed = time.perf_counter() - start_time
+    end_cpu = resource.getrusage(resource.RUSAGE_SELF)
+    if cap is not None:
+        cap.release()
+
+    stages = stage_timer.summary()['stages']
+    blob_p50 = sum(stages[stage]['p50'] for stage in BLOB_STAGES if stage in stages)
+    detect_seconds = sum(stage_timer.samples['total']) if frames > 0 else 0.0
+    latency = stages.get('total', {"p50": None, "p95": None, "p99": None})
+
+    return {
+        "config": job['config'],
+        "subtractor": conf['named_subtractor'],
+        "blob_mode": conf.get('blob_mode', 'contours'),
+        "gate_interval": conf.get('gate_interval') or 0,
+        "params": conf.get(f"{conf['named_subtractor']}_params", {}),
+        "clip": Path(job['clip']).name,
+        "frames": frames,
+        "motion_frames": motion_frames,
+        "motion_pct": (motion_frames / frames) * 100 if frames > 0 else 0.0,
+        "detect_fps": frames / detect_seconds if detect_seconds > 0 else 0.0,
+        "wall_fps": frames / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": latency,
+        "blob_p50_ms": blob_p50,
+        "gated_pct": bg_sub.frame_gate.gated_ratio() * 100 if bg_sub.frame_gate is not None else 0.0,
+        "frame_cache": cached_frames is not None,
+        # includes decoding the clip, which is the same with and without the gate, unless the
+        # frames come from the frame cache
+        "cpu_seconds": (end_cpu.ru_utime - start_cpu.ru_utime) + (end_cpu.ru_stime - start_cpu.ru_stime),
+        "stages_ms": stages,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def write_report(results, output_dir, run_info):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    with open(output_dir / "benchmark_report.json", 'w') as f:
+        json.dump({"run": run_info, "results": results}, f, indent=2)
+
+    # one row per configuration, totals over all of the clips
+    rows = {}
+    for r in results:
+        row = rows.setdefault((r['config'], r['subtractor'], r['blob_mode'], r['gate_interval']),
+                              {"frames": 0, "motion_frames": 0, "detect_seconds": 0.0, "p95": [], "blob_p50": [], "rss": 0.0, "gated": 0.0, "cpu": 0.0})
+        row['frames'] += r['frames']
+        row['motion_frames'] += r['motion_frames']
+        row['detect_seconds'] += r['frames'] / r['detect_fps'] if r['detect_fps'] > 0 else 0.0
+        row['p95'].append(r['latency_ms']['p95'] or 0.0)
+        row['blob_p50'].append(r['blob_p50_ms'])
+        row['gated'] += r['frames'] * r['gated_pct'] / 100
+        row['cpu'] += r['cpu_seconds']
+        row['rss'] = max(row['rss'], r['peak_rss_mb'])
+
+    lines = ["| config | subtractor | blob mode | gate | frames | motion % | gated % | detect fps | worst clip p95 ms | blob p50 ms | CPU s | peak RSS MB |",
+             "|---|---|---|---:|---:|---:|---:|---:|---:|---:|---:|---:|"]
+    for (config, subtractor, blob_mode, gate_interval), row in sorted(rows.items(), key=lambda item: -(item[1]['frames'] / item[1]['detect_seconds'] if item[1]['detect_seconds'] > 0 else 0)):
+        fps = row['frames'] / row['detect_seconds'] if row['detect_seconds'] > 0 else 0.0
+        motion_pct = (row['motion_frames'] / row['frames']) * 100 if row['frames'] > 0 else 0.0
+        gated_pct = (row['gated'] / row['frames']) * 100 if row['frames'] > 0 else 0.0
+        lines.append(f"| {config} | {subtractor} | {blob_mode} | {gate_interval} | {row['frames']} | {motion_pct:.2f} | {gated_pct:.1f} | {fps:.1f} | "
+                     f"{max(row['p95']):.2f} | {max(row['blob_p50']):.2f} | {row['cpu']:.1f} | {row['rss']:.0f} |")
+
+    lines += ["", "| config | subtractor | blob mode | gate | clip | frames | motion % | gated % | detect fps | p50 ms | p95 ms | p99 ms | blob p50 ms | CPU s | peak RSS MB |",
+              "|---|---|---|---:|---|---:|---:|---:|---:|---:|---:|---:|---:|---:|---:|"]
+    for r in results:
+        l = r['latency_ms']
+        lines.append(f"| {r['config']} | {r['subtractor']} | {r['blob_mode']} | {r['gate_interval']} | {r['clip']} | {r['frames']} | {r['motion_pct']:.2f} | "
+                     f"{r['gated_pct']:.1f} | {r['detect_fps']:.1f} | {l['p50'] or 0:.2f} | {l['p95'] or 0:.2f} | {l['p99'] or 0:.2f} | "
+                     f"{r['blob_p50_ms']:.2f} | {r['cpu_seconds']:.1f} | {r['peak_rss_mb']:.0f} |")
+
+    table = "\n".join(lines)
+    with open(output_dir / "benchmark_report.md", 'w') as f:
+        f.write(table + "\n")
+
+    return table
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--configs", nargs='+', default=sorted(glob.glob("./config/*_bg_subtract_config.json")), help="background subtraction config files to take the settings from")
+    ap.add_argument("--subtractors", nargs='+', default=SUBTRACTORS, choices=SUBTRACTORS, help="background subtractors to benchmark")
+    ap.add_argument("--media", nargs='+', default=sorted(glob.glob("./media/*.mp4")), help="video clips to run over")
+    ap.add_argument("--pascal-voc", required=False, help="Path to rectangle annotated file in PascalVOC format with ROIs to look for motion")
+    ap.add_argument("--roi-polygons", required=False, help="Path to a LabelMe json file with polygon ROIs")
+    ap.add_argument("--roi-mode", required=False, help="override the roi_mode of every config")
+    ap.add_argument("--blob-modes", nargs='+', choices=BLOB_MODES, required=False, help="run every configuration with each of these blob modes")
+    ap.add_argument("--gate-intervals", nargs='+', type=int, required=False, help="run every configuration with each of these gate_interval values, 0 turns the gate off")
+    ap.add_argument("--process-width", type=int, required=False, help="override the process_width of every config")
+    ap.add_argument("--max-frames", type=int, required=False, help="only process the first N frames of each clip")
+    ap.add_argument("--threads", type=int, default=1, help="cv2.setNumThreads for each run.  Keep at 1 for repeatable numbers")
+    ap.add_argument("--workers", type=int, default=1, help="number of runs to do at the same time.  More than 1 makes the timings noisier")
+    ap.add_argument("--frame-cache", required=False, help="directory to cache the decoded frames in.  The runs read the frames from it and CPU s leaves out decoding")
+    ap.add_argument("--frame-cache-max-mb", type=float, default=10240, help="size limit of the frame cache, least recently used clips are removed")
+    ap.add_argument("--output-dir", default="./benchmark_results", help="directory to write the reports to")
+    args = vars(ap.parse_args())
+
+    motion_roi_rects = read_pascal_voc_rectangles(args['pascal_voc'])
+    motion_roi_polygons = read_labelme_polygons(args['roi_polygons'])
+    overrides = {"roi_mode": args['roi_mode'], "process_width": args['process_width']}
+    jobs = build_jobs(args['configs'], args['subtractors'], args['media'], overrides, args['blob_modes'], args['gate_intervals'])
+    print(f"Running {len(jobs)} benchmark runs")
+
+    frame_cache = create_frame_cache(args['frame_cache'], args['frame_cache_max_mb'])
+    if frame_cache is not None:
+        # decode each clip once, before the runs that read it
+        for clip in args['media']:
+            frame_cache.open(clip)
+        print(frame_cache.stats_summary())
+
+    # spawn a fresh process per run so each run starts from the same memory baseline
+    ctx = get_context('spawn')
+    results = []
+    with ctx.Pool(processes=args['workers'], maxtasksperchild=1) as pool:
+        for result in pool.starmap(run_job, [(job, motion_roi_rects, motion_roi_polygons, args['max_frames'], args['threads'], args['frame_cache'])
+                                                  for job in jobs], chunksize=1):
+            results.append(result)
+
+    for r in results:
+        print(f"{r['config']:30} {r['subtractor']:5} {r['blob_mode']:10} {r['clip']:15} {r['detect_fps']:8.1f} fps  {r['motion_pct']:6.2f}% motion")
+
+    run_info = {
+        "time": time.time(),
+        "platform": platform.platform(),
+        "opencv": cv2.__version__,
+        "args": args,
+    }
+    print(write_report(results, args['output_dir'], run_info))
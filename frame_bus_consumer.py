@@ -0,0 +1,106 @@
+"""
+Show and snapshot the frames main.py publishes to the shared memory frame bus, in a process of
+its own so the display and the JPEG encoding never hold up detection.
+
+Set "frame_bus" in the bg config to the bus name, and usually turn display_video/display_mask and
+write_snaps off there.  Snapshots written here can be uploaded by running the Dropbox uploader on
+the snapshot directory.
+
+Usage:
+
+python main.py --video-file ./media/atv.mp4 --pascal-voc ./config/motion_roi.xml --bg-config ./config/mac_bg_subtract_config.json
+
+python frame_bus_consumer.py --bus motion_frames --display --display-mask
+
+python frame_bus_consumer.py --bus motion_frames --snap-dir ./motion --frames-between-snaps 10
+
+"""
+import argparse
+import datetime
+import time
+from pathlib import Path
+
+import cv2
+
+from utils.BackgroundImageWriterUtil import write_encoded
+from utils.SharedFrameBusUtil import FrameBusSubscriber
+
+BUS_WINDOW_NAME = 'Frame Bus'
+MASK_WINDOW_NAME = 'Frame Bus Mask'
+
+
+def write_snapshot(bus_frame, snap_dir, encode_params):
+    """
+    Encode the frame straight from the shared memory and only write it out if the publisher did
+    not start overwriting the slot while it was being encoded.
+
+    :return: True if the snapshot was written
+    """
+    ok, encoded = cv2.imencode('.jpg', bus_frame.frame, encode_params)
+    if not ok or not bus_frame.valid():
+        return False
+
+    timestamp = datetime.datetime.fromtimestamp(bus_frame.timestamp)
+    day_outputdir = Path(snap_dir) / timestamp.strftime("%Y%m%d")
+    day_outputdir.mkdir(parents=True, exist_ok=True)
+    write_encoded(encoded, str(day_outputdir / f"{timestamp.strftime('%Y%m%d-%H%M%S.%f')[:-3]}.jpg"))
+    return True
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--bus", required=False, default="motion_frames", help="frame_bus name from the bg config")
+    ap.add_argument("--display", action='store_true', help="show the frames with the motion rectangles")
+    ap.add_argument("--display-mask", action='store_true', help="show the foreground masks")
+    ap.add_argument("--snap-dir", required=False, help="write a JPEG of motion frames in to day sub directories of this directory")
+    ap.add_argument("--frames-between-snaps", type=int, default=10, help="motion frames between snapshots")
+    ap.add_argument("--jpeg-quality", type=int, default=90, help="JPEG quality of the snapshots")
+    ap.add_argument("--timeout", type=float, default=30, help="seconds to wait for the publisher to start")
+    args = vars(ap.parse_args())
+
+    subscriber = FrameBusSubscriber(args['bus'], timeout=args['timeout'])
+    print(f"Attached to frame bus {args['bus']}, {subscriber.slots} slots")
+
+    encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), args['jpeg_quality']]
+    frames = 0
+    snaps = 0
+    snaps_dropped = 0
+    motion_frames_since_snap = args['frames_between_snaps']
+
+    while not subscriber.closed():
+        # the display only needs the newest frame, snapshots should not skip motion frames
+        bus_frame = subscriber.read(latest=args['snap_dir'] is None)
+        if bus_frame is None:
+            time.sleep(0.005)
+            continue
+        frames += 1
+
+        if args['snap_dir'] is not None and bus_frame.motion:
+            motion_frames_since_snap += 1
+            if motion_frames_since_snap >= args['frames_between_snaps']:
+                if write_snapshot(bus_frame, args['snap_dir'], encode_params):
+                    snaps += 1
+                    motion_frames_since_snap = 0
+                else:
+                    snaps_dropped += 1
+
+        if args['display'] or args['display_mask']:
+            # copy, drawing on the shared memory would draw on the publisher's frame
+            copies = bus_frame.copy()
+            if copies is None:
+                continue
+            frame, mask = copies
+            if args['display']:
+                for (rx, ry, rw, rh) in bus_frame.motion_rects:
+                    cv2.rectangle(frame, (rx, ry), (rx + rw, ry + rh), (255, 0, 0), 2)
+                cv2.imshow(BUS_WINDOW_NAME, frame)
+            if args['display_mask']:
+                cv2.imshow(MASK_WINDOW_NAME, mask)
+            if cv2.waitKey(1) & 0xFF == ord("q"):
+                break
+
+    print(f"Frame bus: read {frames} frames, missed {subscriber.frames_missed}, wrote {snaps} snapshots, "
+          f"dropped {snaps_dropped} overwritten while encoding")
+    subscriber.close()
+    if args['display'] or args['display_mask']:
+        cv2.destroyAllWindows()
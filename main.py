@@ -9,6 +9,16 @@ python main.py --video-file ./media/walkers2.mp4 --pascal-voc ./config/motion_ro
 
 python main.py --video-file ./media/walkers2.mp4 --pascal-voc ./config/motion_roi.xml --bg-config ./config/bg_subtraction_config.json
 
+python main.py --video-dir ./media --pascal-voc ./config/motion_roi.xml --workers 4
+
+python main.py --video-file ./media/walkers2.mp4 --roi-polygons ./config/trail_roi.json
+
+python main.py --video-dir ./media --pascal-voc ./config/motion_roi.xml --replay --frame-step 2 --timeline-dir ./replay_results
+
+python main.py --video-file ./media/atv.mp4 --replay --start-sec 10 --end-sec 30
+
+python main.py --video-dir ./media --pascal-voc ./config/motion_roi.xml --replay --frame-cache ./frame_cache
+
 
 
 
@@ -18,16 +28,394 @@ import sys
 from utils.BackgroundSubtractUtil import BackgroundSubtractor
 from utils.conf import Conf
 import cv2
+import numpy as np
 import time
 import argparse
 import datetime
+import functools
 from pathlib import Path
 from utils.pascal_voc_util import read_pascal_voc_rectangles
-from utils.BackgroundImageWriterUtil import BackgroundImageWriter
+from utils.labelme_util import read_labelme_polygons
+from utils.BackgroundImageWriterUtil import create_image_writer
+from utils.BufferedVideoStreamUtil import BufferedVideoStream, DROP_OLDEST
+from utils.FrameCacheUtil import CachedVideoStream, create_frame_cache
+from utils.FrameRateGovernorUtil import FrameRateGovernor
+from utils.StageTimerUtil import create_stage_timer
+from utils.MotionEventUtil import create_event_tracker
+from utils.EventClipRecorderUtil import create_clip_recorder
+from utils.SharedFrameBusUtil import create_frame_bus
+from utils.ReplayUtil import ReplayClock, MotionTimeline, clip_start_time
 from utils.DropboxFileWatcherUpload import DropboxFileWatcherUpload
 from dotenv import load_dotenv
 import os
 from imutils.video import VideoStream
+from multiprocessing import Pool
+import signal
+import threading
+
+ORIGINAL_WINDOW_NAME = 'Original'
+
+# seconds between the live stream capture/processed/dropped summaries
+LIVE_REPORT_INTERVAL = 60
+
+
+def mask_window_name(conf):
+    return f"{conf['named_subtractor']} Mask"
+
+
+@functools.lru_cache(maxsize=32)
+def day_output_dir(detected_motion_dir, day_timestring):
+    """
+    Make the day directory the first time it is needed instead of with a mkdir for every frame
+
+    :return: Path of the day directory
+    """
+    day_outputdir = Path(detected_motion_dir) / day_timestring
+    day_outputdir.mkdir(parents=True, exist_ok=True)
+    return day_outputdir
+
+
+def new_counters():
+    return {"frames": 0, "frames_with_motion": 0, "snaps_queued": 0}
+
+
+def process_frame(frame, conf, args, bg_sub, image_writer, motion_roi_rects, counters, event_tracker=None, clip_recorder=None, frame_bus=None,
+                  clock=None, timeline=None):
+    """
+    Detect motion in one frame, queue a snapshot when there is motion and update the display.
+    With an event_tracker the snapshots are chosen per motion event by the tracker instead.
+    With a clip_recorder every frame is handed to it to record clips of the motion events.
+    With a frame_bus every frame, its mask and the motion results are published to the shared
+    memory frame bus for frame_bus_consumer.py and other processes.
+    With a clock, a ReplayClock, the frame is stamped with its time in the clip instead of now,
+    and with a timeline its motion results are added to the MotionTimeline.
+
+    :return: False if the user asked to quit from the display window
+    """
+    counters['frames'] += 1
+    timer = bg_sub.stage_timer
+
+    # detection is run at conf['process_width'], the full resolution original is what gets saved.
+    # apply() does not draw on the frame, so it stays the clean original until the display
+    # annotations at the end.  The frame buffer is reused by the capture thread, so the writer,
+    # event tracker and clip recorder copy it in to frame pool buffers only when they keep it.
+    original = frame
+
+    timestamp = clock.timestamp() if clock is not None else datetime.datetime.now()
+    timer.lap('timestamp')
+    motionThisFrame, framesWithoutMotion, contours, frame, mask, mask_rect = bg_sub.apply(original)
+
+    if conf['log_motion_status']:
+        if motionThisFrame:
+            print(f"Motion This Frame: {motionThisFrame}")
+
+    if motionThisFrame:
+        counters['frames_with_motion'] += 1
+
+        if conf['write_snaps'] and event_tracker is None:
+            day_outputdir = day_output_dir(conf['detected_motion_dir'], timestamp.strftime("%Y%m%d"))
+            image_filename = f"{timestamp.strftime('%Y%m%d-%H%M%S.%f')[:-3]}{image_writer.extension}"
+            image_fqn = day_outputdir / image_filename
+            if image_writer.add_image_to_queue(str(image_fqn), original, copy=True, throttle_key=conf['camera_name'], motion_box=mask_rect):
+                counters['snaps_queued'] += 1
+            timer.lap('enqueue')
+
+    if conf['write_snaps'] and event_tracker is not None:
+        counters['snaps_queued'] += event_tracker.update(timestamp, motionThisFrame, framesWithoutMotion, bg_sub.motion_rects, bg_sub.motion_areas, original)
+        timer.lap('event')
+
+    if clip_recorder is not None:
+        clip_recorder.add_frame(timestamp, original, motionThisFrame, framesWithoutMotion)
+        timer.lap('clip')
+
+    if frame_bus is not None:
+        frame_bus.publish(timestamp, original, mask, motionThisFrame, bg_sub.motion_rects)
+        timer.lap('frame_bus')
+
+    if timeline is not None:
+        timeline.add(timestamp, motionThisFrame, bg_sub.motion_rects, mask_rect)
+
+    if conf['display_video']:
+        # the snapshots have been copied by now, so it does not matter if frame is the original
+        if not frame.flags.writeable:
+            # frames mapped from the frame cache are read only
+            frame = frame.copy()
+        # Draw the ROIs rectangles on the frame
+        if conf['display_motion_roi']:
+            for roi in motion_roi_rects:
+                cv2.rectangle(frame, (roi[0], roi[1]), (roi[2], roi[3]), (255, 255, 0), 2)
+            for polygon in bg_sub.motion_roi_polygons:
+                cv2.polylines(frame, [np.array(polygon, dtype=np.int32)], True, (255, 255, 0), 2)
+
+        if motionThisFrame:
+            for (rx, ry, rw, rh) in bg_sub.motion_rects:
+                cv2.rectangle(frame, (rx, ry), (rx + rw, ry + rh),(255, 0, 0), 2)
+        timer.lap('annotate')
+
+    if conf['display_mask']:
+        cv2.imshow(mask_window_name(conf), mask)
+
+    if conf['display_video']:
+        cv2.imshow(ORIGINAL_WINDOW_NAME, frame)
+
+    if conf['display_mask'] or conf['display_video']:
+        key = cv2.waitKey(3) & 0xFF
+
+        # if the `q` key was pressed, break from the loop
+        if key == ord("q"):
+            return False
+
+        if args.get('wait_on_start') == True:
+            cv2.waitKey(0)
+            args['wait_on_start'] = False
+
+        if motionThisFrame and args['slow_motion'] == True:
+            time.sleep(0.2)
+        timer.lap('display')
+
+    return True
+
+
+def process_video_file(vid, conf, args, bg_sub, image_writer, motion_roi_rects, stop_event=None, event_tracker=None, clip_recorder=None, frame_bus=None):
+    """
+    Run motion detection over every frame of one video file, or every args['frame_step'] frame
+    between args['start_sec'] and args['end_sec'].
+
+    With args['replay'] the frames are stamped with their time in the clip instead of the time
+    they are processed, and the motion timeline of the clip is written to args['timeline_dir'].
+
+    :return: dict with the per file results
+    """
+    counters = new_counters()
+    timer = bg_sub.stage_timer
+    start_time = time.time()
+
+    start_msec = (args.get('start_sec') or 0) * 1000
+    end_msec = args['end_sec'] * 1000 if args.get('end_sec') is not None else None
+    frame_cache = create_frame_cache(args.get('frame_cache'), args.get('frame_cache_max_mb'))
+    if frame_cache is not None:
+        # decoded once in to the cache, after that the frames are mapped straight from it
+        cap = CachedVideoStream(frame_cache.open(vid), frame_step=args.get('frame_step') or 1, start_msec=start_msec, end_msec=end_msec)
+    else:
+        # decode in a background thread so decoding overlaps with the detection below
+        cap = BufferedVideoStream(str(vid), queue_size=conf['capture_queue_size'], policy=conf['capture_policy'],
+                                  frame_step=args.get('frame_step') or 1, start_msec=start_msec, end_msec=end_msec).start()
+
+    if clip_recorder is not None:
+        # the clip plays back at the speed of the file, not the speed it was processed at
+        clip_recorder.set_position_source(cap)
+
+    clock = None
+    timeline = None
+    if args.get('replay'):
+        clock = ReplayClock(cap, clip_start_time(vid))
+        timeline = MotionTimeline(vid, clock, {"frame_step": cap.frame_step, "start_sec": args.get('start_sec'), "end_sec": args.get('end_sec'),
+                                               "named_subtractor": conf['named_subtractor']})
+
+    while stop_event is None or not stop_event.is_set():
+        timer.start()
+        frame = cap.read()
+        if frame is None:
+            break
+        timer.lap('capture')
+
+        keep_going = process_frame(frame, conf, args, bg_sub, image_writer, motion_roi_rects, counters, event_tracker, clip_recorder, frame_bus,
+                                   clock, timeline)
+        timer.end_frame()
+        if not keep_going:
+            break
+
+    if clip_recorder is not None:
+        clip_recorder.flush()
+
+    # an event still open at the end of the clip is written out with what it has
+    if event_tracker is not None:
+        counters['snaps_queued'] += event_tracker.close()
+
+    cap.stop()
+    print(cap.stats_summary())
+    if frame_cache is not None:
+        print(frame_cache.stats_summary())
+    print(image_writer.frame_pool.stats_summary())
+    if bg_sub.frame_gate is not None:
+        print(bg_sub.frame_gate.stats_summary())
+    if bg_sub.lighting is not None:
+        print(bg_sub.lighting.stats_summary())
+    timer.report()
+    if counters['frames'] > 0:
+        print(f"Percentage of frames with motion: {(counters['frames_with_motion']/counters['frames'])*100:.2f}%")
+
+    elapsed = time.time() - start_time
+    timeline_path = None
+    if timeline is not None:
+        timeline_path = timeline.write(args.get('timeline_dir') or "./replay_results")
+        print(f"Timeline: {timeline.summary()['intervals']} motion intervals, written to {timeline_path}")
+
+    return {
+        "file": str(vid),
+        "frames": counters['frames'],
+        "frames_with_motion": counters['frames_with_motion'],
+        "snaps_queued": counters['snaps_queued'],
+        "seconds": elapsed,
+        "fps": counters['frames'] / elapsed if elapsed > 0 else 0.0,
+        "timeline": str(timeline_path) if timeline_path is not None else None,
+    }
+
+
+def open_live_stream(conf):
+    """
+    Open the camera.  USB/V4L cameras are read through a BufferedVideoStream that drops the
+    oldest frames when detection falls behind.  The PiCamera is read through imutils VideoStream.
+    """
+    if conf['picamera']:
+        cap = VideoStream(usePiCamera=True, src=conf['camera_src']).start()
+    else:
+        cap = BufferedVideoStream(conf['camera_src'], queue_size=conf['capture_queue_size'], policy=DROP_OLDEST).start()
+
+    # allow the camera sensor to warm up
+    time.sleep(2.0)
+    return cap
+
+
+def live_stream_summary(cap, counters, elapsed, name=None):
+    if isinstance(cap, BufferedVideoStream):
+        capture = f"captured {cap.frames_decoded}, processed {counters['frames']}, dropped {cap.frames_dropped}"
+    else:
+        # VideoStream only ever hands back its most recent frame and does not count the frames the
+        # camera delivers, so the frames overwritten between our reads can not be measured.  The
+        # duplicate reads are polls that found no new frame yet, not camera frames.
+        capture = (f"processed {counters['frames']}, captured and dropped unknown with VideoStream, "
+                   f"{counters['duplicate_reads']} reads before a new frame")
+
+    return (f"{name or 'Live'}: {capture}, "
+            f"motion {counters['frames_with_motion']}, snaps {counters['snaps_queued']}, "
+            f"{counters['frames'] / elapsed if elapsed > 0 else 0.0:.1f} fps processed")
+
+
+def process_live_stream(cap, conf, args, bg_sub, image_writer, motion_roi_rects, stop_event, event_tracker=None, clip_recorder=None, governor=None, frame_bus=None):
+    """
+    Run motion detection on the camera until stop_event is set.  Processing is limited to
+    conf['target_fps'], and when detection falls behind the camera the loop skips ahead
+    to the newest frame.
+
+    :param governor: FrameRateGovernor to pace the loop with instead of one for conf['target_fps'],
+            like the supervisor's CpuBudgetGovernor
+
+    :return: dict of the live counters
+    """
+    counters = new_counters()
+    counters['duplicate_reads'] = 0
+    timer = bg_sub.stage_timer
+    if governor is None:
+        governor = FrameRateGovernor(conf['target_fps'])
+    last_frame = None
+    start_time = time.time()
+    last_report_time = start_time
+
+    while not stop_event.is_set():
+        governor.wait()
+
+        timer.start()
+        if isinstance(cap, BufferedVideoStream):
+            frame = cap.read(latest=True)
+            if frame is None:
+                print("Camera stream ended")
+                break
+        else:
+            # VideoStream returns the same frame until the camera delivers a new one
+            frame = cap.read()
+            if frame is None or frame is last_frame:
+                counters['duplicate_reads'] += 1
+                time.sleep(0.005)
+                continue
+            last_frame = frame
+        timer.lap('capture')
+
+        keep_going = process_frame(frame, conf, args, bg_sub, image_writer, motion_roi_rects, counters, event_tracker, clip_recorder, frame_bus)
+        timer.end_frame()
+        if not keep_going:
+            break
+
+        if time.time() - last_report_time >= LIVE_REPORT_INTERVAL:
+            last_report_time = time.time()
+            print(live_stream_summary(cap, counters, last_report_time - start_time, conf['camera_name']))
+
+    if event_tracker is not None:
+        counters['snaps_queued'] += event_tracker.close()
+
+    print(live_stream_summary(cap, counters, time.time() - start_time, conf['camera_name']))
+    if bg_sub.frame_gate is not None:
+        print(bg_sub.frame_gate.stats_summary())
+    if bg_sub.lighting is not None:
+        print(bg_sub.lighting.stats_summary())
+    cap.stop()
+    return counters
+
+
+def batch_process_video_file(vid, bg_config, args):
+    """
+    Process pool worker for --video-dir batch mode.  Each call owns its own subtractor and
+    writer so no background model state is shared between clips.  Display is always off.
+    """
+    # the workers already use all the cores, keep OpenCV from starting its own thread pool in each
+    cv2.setNumThreads(1)
+
+    conf = Conf(bg_config)
+    conf.display_video = False
+    conf.display_mask = False
+
+    motion_roi_rects = read_pascal_voc_rectangles(args.get('pascal_voc'))
+    motion_roi_polygons = read_labelme_polygons(args.get('roi_polygons'))
+
+    image_writer = create_image_writer(conf)
+
+    stage_timer = create_stage_timer(conf)
+    add_stage_timer_gauges(stage_timer, image_writer)
+    bg_sub = BackgroundSubtractor(**conf.to_dict(), motion_roi_rects=motion_roi_rects, motion_roi_polygons=motion_roi_polygons, stage_timer=stage_timer)
+    event_tracker = create_event_tracker(conf, image_writer, motion_roi_rects, motion_roi_polygons=motion_roi_polygons)
+    clip_recorder = create_clip_recorder(conf, image_writer.frame_pool)
+
+    result = process_video_file(vid, conf, args, bg_sub, image_writer, motion_roi_rects, event_tracker=event_tracker, clip_recorder=clip_recorder)
+
+    if clip_recorder is not None:
+        clip_recorder.stop()
+    image_writer.drain()
+    result['snaps_written'] = image_writer.images_written
+    return result
+
+
+def connect_file_processor(image_writer, file_processor=None):
+    # hand each snapshot straight to the uploader as soon as it is written
+    if file_processor is not None:
+        image_writer.add_write_listener(file_processor.notify)
+
+
+def add_stage_timer_gauges(stage_timer, image_writer, file_processor=None):
+    stage_timer.add_gauge('writer_queue', image_writer.queue_size)
+    # full size frame copies that needed a new buffer, flat once the pool has warmed up
+    stage_timer.add_gauge('frame_allocs', lambda: image_writer.frame_pool.allocations)
+    if file_processor is not None:
+        stage_timer.add_gauge('upload_backlog', file_processor.backlog)
+
+
+def ignore_worker_signals():
+    # the parent process handles ctrl-c/SIGTERM and terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def print_batch_results(results, elapsed):
+    print(f"{'file':60} {'frames':>8} {'motion':>8} {'snaps':>8} {'fps':>8}")
+    for r in results:
+        print(f"{Path(r['file']).name:60} {r['frames']:>8} {r['frames_with_motion']:>8} {r['snaps_written']:>8} {r['fps']:>8.1f}")
+
+    total_frames = sum(r['frames'] for r in results)
+    total_motion = sum(r['frames_with_motion'] for r in results)
+    total_snaps = sum(r['snaps_written'] for r in results)
+    print(f"{'TOTAL':60} {total_frames:>8} {total_motion:>8} {total_snaps:>8} {total_frames / elapsed if elapsed > 0 else 0.0:>8.1f}")
+    if total_frames > 0:
+        print(f"Percentage of frames with motion: {(total_motion/total_frames)*100:.2f}%")
+
 
 if __name__ == '__main__':
     ap = argparse.ArgumentParser()
@@ -36,23 +424,20 @@ if __name__ == '__main__':
     ap.add_argument("--wait-on-start", action='store_true', help="After showing the first frame, wait for a key to be pressed to continue")
     ap.add_argument("--video-file", required=False, help="Full path to video file to read from. If this is not set, then the Webcam will be used.")
     ap.add_argument("--video-dir", required=False, help="Full path to directory that contains video files. The directory and all subdirectories will be searched for video files")
+    ap.add_argument("--workers", type=int, default=1, help="Number of worker processes used to process the --video-dir files in parallel.  Display is turned off when > 1")
     ap.add_argument("--pascal-voc", required=False, help="Path to rectangle annotated file in PascalVOC format with ROIs to look for motion")
+    ap.add_argument("--roi-polygons", required=False, help="Path to a LabelMe json file with polygon ROIs to look for motion, used along with --pascal-voc")
+    ap.add_argument("--replay", action='store_true', help="Replay recorded clips headless as fast as they decode, with the frames stamped with their time in the clip, and write a motion timeline per clip")
+    ap.add_argument("--timeline-dir", default="./replay_results", help="directory the --replay motion timelines are written to")
+    ap.add_argument("--frame-step", type=int, default=1, help="only process every Nth frame of the video files")
+    ap.add_argument("--start-sec", type=float, required=False, help="start processing the video files at this many seconds in")
+    ap.add_argument("--end-sec", type=float, required=False, help="stop processing the video files at this many seconds in")
+    ap.add_argument("--frame-cache", required=False, help="directory to cache the decoded frames of the video files in, so they are only decoded once")
+    ap.add_argument("--frame-cache-max-mb", type=float, default=10240, help="size limit of the frame cache, least recently used clips are removed")
     args = vars(ap.parse_args())
 
     conf = Conf(args['bg_config'])
 
-    if conf['display_video']:
-        original_window_name = 'Original'
-        cv2.namedWindow(original_window_name, cv2.WINDOW_NORMAL)
-        cv2.resizeWindow(original_window_name, 600, 600)
-        cv2.moveWindow(original_window_name, 600, 100)
-
-    if conf['display_mask']:
-        subtractor_name = conf['named_subtractor']
-        mask_window_name = f'{subtractor_name} Mask'
-        cv2.namedWindow(mask_window_name, cv2.WINDOW_NORMAL)
-        cv2.moveWindow(mask_window_name, 200, 250)
-
     # Determine if we are reading a video or using the computer camera
     video_files_to_process = []
     if args.get("video_file", None) != None:
@@ -61,14 +446,25 @@ if __name__ == '__main__':
         path = Path(args.get("video_dir"))
         for p in path.rglob("*.MP4"):
             video_files_to_process.append(p.absolute())
-    else:
-        cap = VideoStream(usePiCamera=conf['picamera'], src=conf['camera_src']).start()
-        time.sleep(2.0)
+    live_mode = args.get("video_file", None) is None and args.get("video_dir", None) is None
+
+    if args['replay'] and live_mode:
+        raise ValueError("--replay needs --video-file or --video-dir")
+
+    batch_mode = args['workers'] > 1 and args.get("video_dir", None) != None
+    # replays run headless, no windows and no waitKey holding up each frame
+    if batch_mode or args['replay']:
+        conf.display_video = False
+        conf.display_mask = False
 
-    # set this to a large value so the first frame is saved, i.e. greater than the
-    # conf['frames_between_snaps'] value
-    framesSinceSnap=10000
-    snap_buffer = []
+    if conf['display_video']:
+        cv2.namedWindow(ORIGINAL_WINDOW_NAME, cv2.WINDOW_NORMAL)
+        cv2.resizeWindow(ORIGINAL_WINDOW_NAME, 600, 600)
+        cv2.moveWindow(ORIGINAL_WINDOW_NAME, 600, 100)
+
+    if conf['display_mask']:
+        cv2.namedWindow(mask_window_name(conf), cv2.WINDOW_NORMAL)
+        cv2.moveWindow(mask_window_name(conf), 200, 250)
 
     # Bounding Boxes contains Regions of Interest
     # These bounding rectangles where created using LabelImg (pip install LabelImg )
@@ -82,98 +478,94 @@ if __name__ == '__main__':
     if args.get('pascal_voc', None) is not None:
         motion_roi_rects = read_pascal_voc_rectangles(args.get('pascal_voc'))
 
-    bg_sub = BackgroundSubtractor(**conf.to_dict(), motion_roi_rects=motion_roi_rects)
-
-    image_writer = BackgroundImageWriter(frames_between_writes=conf['frames_between_snaps'])
-    image_writer.start()
-
-    wait_on_start = args.get('wait_on_start', False)
+    # polygon ROIs drawn with LabelMe, for a trail that curves through the rectangles
+    motion_roi_polygons = read_labelme_polygons(args.get('roi_polygons'))
 
+    bg_dropbox = None
     if conf["upload_dropbox"]:
         load_dotenv()
         env_path = conf['dropbox_env_file']
         load_dotenv(dotenv_path=env_path)
         access_token = os.getenv('dropbox_access_token')
 
-        bg_dropbox = DropboxFileWatcherUpload(dropbox_access_token=access_token, root_dir=conf['detected_motion_dir'], pattern="*.jpg", delete_after_process=conf["delete_after_process"])
+        file_watcher = conf['file_watcher'] or 'auto'
+        if batch_mode and file_watcher == 'notify':
+            # the snapshots are written by the pool workers, whose writers can not notify the uploader here
+            print("WARNING: file_watcher 'notify' does not see the snapshots of the batch workers, using 'auto'")
+            file_watcher = 'auto'
+        bg_dropbox = DropboxFileWatcherUpload(dropbox_access_token=access_token, root_dir=conf['detected_motion_dir'], pattern=f"*.{conf['snapshot_format'] or 'jpg'}", delete_after_process=conf["delete_after_process"],
+                                              watcher=file_watcher, workers=conf['upload_workers'] or 1,
+                                              journal_path=conf['upload_journal'])
         bg_dropbox.start()
 
-    frames_with_motion = 0
-    total_frames = 0
-    for i, vid in enumerate(video_files_to_process):
-        print(f"Process file: {vid}.  {(i/len(video_files_to_process))*100:.1f} complete")
-
-        cap = cv2.VideoCapture(str(vid))
-        while True:
-            rtn, frame = cap.read()
-            if frame is None:
+    # stop the frame loops cleanly on SIGTERM (systemd/kill) and ctrl-c so the
+    # image writer and dropbox queues get drained below
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"Received signal {signum}, shutting down")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    if live_mode:
+        image_writer = create_image_writer(conf)
+        connect_file_processor(image_writer, bg_dropbox)
+        stage_timer = create_stage_timer(conf)
+        add_stage_timer_gauges(stage_timer, image_writer, bg_dropbox)
+
+        bg_sub = BackgroundSubtractor(**conf.to_dict(), motion_roi_rects=motion_roi_rects, motion_roi_polygons=motion_roi_polygons, stage_timer=stage_timer)
+        event_tracker = create_event_tracker(conf, image_writer, motion_roi_rects, motion_roi_polygons=motion_roi_polygons)
+        clip_recorder = create_clip_recorder(conf, image_writer.frame_pool)
+        frame_bus = create_frame_bus(conf)
+        cap = open_live_stream(conf)
+        process_live_stream(cap, conf, args, bg_sub, image_writer, motion_roi_rects, stop_event, event_tracker, clip_recorder, frame_bus=frame_bus)
+
+        if clip_recorder is not None:
+            clip_recorder.stop()
+        if frame_bus is not None:
+            frame_bus.close()
+        image_writer.drain()
+    elif batch_mode:
+        # fan the clips out to a process pool, each worker has its own subtractor and writer
+        start_time = time.time()
+        with Pool(processes=args['workers'], initializer=ignore_worker_signals) as pool:
+            async_results = pool.starmap_async(batch_process_video_file, [(vid, args['bg_config'], args) for vid in video_files_to_process], chunksize=1)
+            while not async_results.ready() and not stop_event.is_set():
+                async_results.wait(1)
+
+            if stop_event.is_set():
+                pool.terminate()
+            else:
+                print_batch_results(async_results.get(), time.time() - start_time)
+    else:
+        image_writer = create_image_writer(conf)
+        connect_file_processor(image_writer, bg_dropbox)
+        stage_timer = create_stage_timer(conf)
+        add_stage_timer_gauges(stage_timer, image_writer, bg_dropbox)
+        clip_recorder = create_clip_recorder(conf, image_writer.frame_pool)
+        frame_bus = create_frame_bus(conf)
+
+        for i, vid in enumerate(video_files_to_process):
+            print(f"Process file: {vid}.  {(i/len(video_files_to_process))*100:.1f} complete")
+
+            # each clip is a separate recording, start with a fresh background model
+            bg_sub = BackgroundSubtractor(**conf.to_dict(), motion_roi_rects=motion_roi_rects, motion_roi_polygons=motion_roi_polygons, stage_timer=stage_timer)
+            event_tracker = create_event_tracker(conf, image_writer, motion_roi_rects, motion_roi_polygons=motion_roi_polygons)
+            process_video_file(vid, conf, args, bg_sub, image_writer, motion_roi_rects, stop_event, event_tracker, clip_recorder, frame_bus)
+            if stop_event.is_set():
                 break
 
-            total_frames += 1
-
-            # frame = imutils.resize(frame, width=800)
-            original = frame.copy()
-
-            # Draw the ROIs rectangles on the frame
-            if args.get('pascal_voc') and conf['display_motion_roi']:
-                for roi in motion_roi_rects:
-                    cv2.rectangle(frame, (roi[0], roi[1]), (roi[2], roi[3]), (255, 255, 0), 2)
-
-            timestamp = datetime.datetime.now()
-            day_timestring = timestamp.strftime("%Y%m%d")
-            hms_timestring = timestamp.strftime("%Y%m%d-%H%M%S.%f")[:-3]
-
-            day_outputdir_path = f"{conf['detected_motion_dir']}/{day_timestring}"
-            day_outputdir = Path(day_outputdir_path)
-
-            day_outputdir.mkdir(parents=True, exist_ok=True)
-            motionThisFrame, framesWithoutMotion, contours, frame, mask, mask_rect = bg_sub.apply(frame)
-
-            if conf['log_motion_status']:
-                if motionThisFrame:
-                    print(f"Motion This Frame: {motionThisFrame}")
-
-            if motionThisFrame:
-                frames_with_motion += 1
-                sorted_contours = sorted(contours, key=cv2.contourArea, reverse=True)
-                for contour in sorted_contours:
-                    (rx, ry, rw, rh) = cv2.boundingRect(contour)
-                    cv2.rectangle(frame, (rx, ry), (rx + rw, ry + rh),(255, 0, 0), 2)
-
-                if conf['write_snaps']:
-                    image_filename = f"{hms_timestring}.jpg"
-                    image_fqn = day_outputdir / image_filename
-                    image_writer.add_image_to_queue(str(image_fqn), original)
-
-            if conf['display_mask']:
-                cv2.imshow(mask_window_name, mask)
-
-            if conf['display_video']:
-                cv2.imshow(original_window_name, frame)
-
-            if conf['display_mask'] or conf['display_video']:
-                key = cv2.waitKey(3) & 0xFF
-
-                # if the `q` key was pressed, break from the loop
-                if key == ord("q"):
-                    break
-
-                if wait_on_start == True:
-                    cv2.waitKey(0)
-                    wait_on_start = False
-
-                if motionThisFrame and args['slow_motion'] == True:
-                    time.sleep(0.2)
-
-            print(f"Percentage of frames with motion: {(frames_with_motion/total_frames)*100:.2f}%")
-
-            if cap != None:
-                cap.release()
-
-    image_writer.drain()
+        if clip_recorder is not None:
+            clip_recorder.stop()
+        if frame_bus is not None:
+            frame_bus.close()
+        image_writer.drain()
 
     if conf['display_mask'] or conf['display_video']:
         cv2.destroyAllWindows()
 
     if conf["upload_dropbox"]:
         bg_dropbox.drain()
+        print(bg_dropbox.stats_summary())
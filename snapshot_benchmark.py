@@ -0,0 +1,153 @@
+"""
+Compare snapshot encoding settings on motion frames from the bundled clips.
+
+Motion frames and their motion boxes are sampled by running the detector of a bg config over each
+clip, then every sampled frame is encoded with each of the SNAPSHOT_SETTINGS by a SnapshotEncoder,
+the same way the BackgroundImageWriter does it.  Reports the bytes per snapshot and the encode
+time per setting, to choose the snapshot_* settings of a config with.
+
+Usage:
+
+python snapshot_benchmark.py
+
+python snapshot_benchmark.py --bg-config ./config/rpi_headless_bg_subtract_config.json --media ./media/atv.mp4 --pascal-voc ./config/motion_roi.xml
+
+Writes <output-dir>/snapshot_report.json and <output-dir>/snapshot_report.md
+"""
+import argparse
+import glob
+import json
+import platform
+import statistics
+import time
+from pathlib import Path
+
+import cv2
+
+from utils.BackgroundSubtractUtil import BackgroundSubtractor
+from utils.SnapshotEncoderUtil import SnapshotEncoder
+from utils.conf import Conf
+from utils.pascal_voc_util import read_pascal_voc_rectangles
+
+# name -> SnapshotEncoder arguments
+SNAPSHOT_SETTINGS = {
+    "jpg q95": {"format": "jpg", "quality": 95},
+    "jpg q80": {"format": "jpg", "quality": 80},
+    "jpg q60": {"format": "jpg", "quality": 60},
+    "webp q80": {"format": "webp", "quality": 80},
+    "png": {"format": "png"},
+    "jpg q80 max 1280px": {"format": "jpg", "quality": 80, "max_width": 1280},
+    "jpg q80 max 640px": {"format": "jpg", "quality": 80, "max_width": 640},
+    "webp q80 max 640px": {"format": "webp", "quality": 80, "max_width": 640},
+    "jpg q80 crop": {"format": "jpg", "quality": 80, "crop_to_motion": True},
+    "jpg q80 crop + thumb 320px": {"format": "jpg", "quality": 80, "crop_to_motion": True, "thumbnail_width": 320},
+}
+
+
+def sample_motion_frames(clip, conf, motion_roi_rects, samples):
+    """
+    :return: up to samples (frame, motion box) pairs spread over the motion frames of clip
+    """
+    bg_sub = BackgroundSubtractor(**conf.to_dict(), motion_roi_rects=motion_roi_rects)
+    cap = cv2.VideoCapture(clip)
+    motion_frames = []
+    while True:
+        grabbed, frame = cap.read()
+        if not grabbed or frame is None:
+            break
+        motionThisFrame, _, _, _, _, mask_rect = bg_sub.apply(frame)
+        if motionThisFrame:
+            motion_frames.append((frame.copy(), mask_rect))
+    cap.release()
+
+    step = max(1, len(motion_frames) // samples)
+    return motion_frames[::step][:samples]
+
+
+def encode_frames(frames, settings, repeats):
+    """
+    :return: bytes per snapshot, thumbnails included, and encode ms of each frame
+    """
+    encoder = SnapshotEncoder(**settings)
+    sizes = []
+    encode_ms = []
+    for frame, mask_rect in frames:
+        best_ms = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            encoded_files = encoder.encode(frame, mask_rect)
+            ms = (time.perf_counter() - start) * 1000
+            best_ms = ms if best_ms is None else min(best_ms, ms)
+        sizes.append(sum(encoded.nbytes for _, encoded in encoded_files))
+        encode_ms.append(best_ms)
+    return sizes, encode_ms
+
+
+def write_report(results, output_dir, run_info):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    with open(output_dir / "snapshot_report.json", 'w') as f:
+        json.dump({"run": run_info, "results": results}, f, indent=2)
+
+    lines = ["| setting | clip | frame size | snaps | KB/snap | vs jpg q95 | encode ms p50 | encode ms max |",
+             "|---|---|---|---:|---:|---:|---:|---:|"]
+    baseline = {r['clip']: r['bytes_per_snap'] for r in results if r['setting'] == "jpg q95"}
+    for r in results:
+        ratio = r['bytes_per_snap'] / baseline[r['clip']] if baseline.get(r['clip']) else 0.0
+        lines.append(f"| {r['setting']} | {r['clip']} | {r['frame_size']} | {r['snaps']} | {r['bytes_per_snap'] / 1024:.1f} | "
+                     f"{ratio:.2f} | {r['encode_ms_p50']:.2f} | {r['encode_ms_max']:.2f} |")
+
+    table = "\n".join(lines)
+    with open(output_dir / "snapshot_report.md", 'w') as f:
+        f.write(table + "\n")
+
+    return table
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--bg-config", default="./config/mac_bg_subtract_config.json", help="bg config whose detector picks the motion frames")
+    ap.add_argument("--media", nargs='+', default=sorted(glob.glob("./media/*.mp4")), help="video clips to sample the motion frames from")
+    ap.add_argument("--pascal-voc", required=False, help="Path to rectangle annotated file in PascalVOC format with ROIs to look for motion")
+    ap.add_argument("--settings", nargs='+', default=list(SNAPSHOT_SETTINGS.keys()), choices=list(SNAPSHOT_SETTINGS.keys()), help="encoding settings to compare")
+    ap.add_argument("--samples", type=int, default=20, help="motion frames to encode per clip")
+    ap.add_argument("--repeats", type=int, default=3, help="times each frame is encoded, the fastest one is kept")
+    ap.add_argument("--threads", type=int, default=1, help="cv2.setNumThreads.  Keep at 1 for repeatable numbers")
+    ap.add_argument("--output-dir", default="./benchmark_results", help="directory to write the reports to")
+    args = vars(ap.parse_args())
+
+    cv2.setNumThreads(args['threads'])
+    conf = Conf(args['bg_config'])
+    motion_roi_rects = read_pascal_voc_rectangles(args['pascal_voc'])
+
+    results = []
+    for clip in args['media']:
+        frames = sample_motion_frames(clip, conf, motion_roi_rects, args['samples'])
+        if len(frames) == 0:
+            print(f"{Path(clip).name}: no motion frames, skipped")
+            continue
+        frame_h, frame_w = frames[0][0].shape[:2]
+
+        for name in args['settings']:
+            sizes, encode_ms = encode_frames(frames, SNAPSHOT_SETTINGS[name], args['repeats'])
+            results.append({
+                "setting": name,
+                "encoder": SNAPSHOT_SETTINGS[name],
+                "clip": Path(clip).name,
+                "frame_size": f"{frame_w}x{frame_h}",
+                "snaps": len(sizes),
+                "bytes_per_snap": statistics.mean(sizes),
+                "encode_ms_p50": statistics.median(encode_ms),
+                "encode_ms_max": max(encode_ms),
+            })
+            r = results[-1]
+            print(f"{r['clip']:15} {name:28} {r['bytes_per_snap'] / 1024:8.1f} KB  {r['encode_ms_p50']:7.2f} ms")
+
+    run_info = {
+        "time": time.time(),
+        "platform": platform.platform(),
+        "opencv": cv2.__version__,
+        "args": args,
+    }
+    print(write_report(results, args['output_dir'], run_info))
@@ -0,0 +1,174 @@
+"""
+Run the motion detection of several cameras in one process.
+
+Each camera gets its own capture thread, BackgroundSubtractor, event tracker and clip recorder,
+and runs on a worker thread of its own.  All of the cameras share one BackgroundImageWriter and
+one Dropbox uploader, instead of one of each per process.  A camera that goes over its cpu_budget
+has its processing frame rate lowered until it fits.  A camera whose stream fails is restarted.
+
+Usage:
+
+python supervisor.py --cameras ./config/cameras.json
+
+python supervisor.py --cameras ./config/cameras.json --opencv-threads 2
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import os
+import signal
+import threading
+import time
+
+import cv2
+from dotenv import load_dotenv
+
+from main import process_live_stream, open_live_stream, connect_file_processor, add_stage_timer_gauges, LIVE_REPORT_INTERVAL
+from utils.BackgroundSubtractUtil import BackgroundSubtractor
+from utils.BackgroundImageWriterUtil import create_image_writer
+from utils.DropboxFileWatcherUpload import DropboxFileWatcherUpload
+from utils.EventClipRecorderUtil import create_clip_recorder
+from utils.FrameRateGovernorUtil import CpuBudgetGovernor
+from utils.MotionEventUtil import create_event_tracker
+from utils.SharedFrameBusUtil import create_frame_bus
+from utils.StageTimerUtil import create_stage_timer
+from utils.conf import Conf
+from utils.labelme_util import read_labelme_polygons
+from utils.pascal_voc_util import read_pascal_voc_rectangles
+
+
+def camera_conf(camera, supervisor_conf):
+    """
+    The bg config of the camera, with its source, output directory and overrides applied.
+    Display is always off, the windows can not be shared between the camera threads.
+    """
+    conf = Conf(camera['bg_config'])
+    conf.camera_name = camera['name']
+    conf.camera_src = camera.get('source', 0)
+    conf.picamera = camera.get('picamera', False)
+    conf.detected_motion_dir = camera.get('detected_motion_dir') or str(Path(supervisor_conf['detected_motion_dir']) / camera['name'])
+    conf.__dict__.update(camera.get('overrides', {}))
+    if conf['frame_bus']:
+        # one bus per camera
+        conf.frame_bus = f"{conf['frame_bus']}_{camera['name']}"
+    conf.display_video = False
+    conf.display_mask = False
+    return conf
+
+
+def run_camera(camera, supervisor_conf, image_writer, governor, stop_event):
+    """
+    Worker for one camera.  The pipeline is built again each time the stream is restarted.
+    """
+    restart_delay = supervisor_conf['restart_delay'] or 10
+    # video files are for trying things out, they are not restarted when they end
+    restart = camera.get('restart', not isinstance(camera.get('source'), str) or not os.path.isfile(camera['source']))
+    args = {"slow_motion": False, "wait_on_start": False}
+
+    while not stop_event.is_set():
+        clip_recorder = None
+        frame_bus = None
+        cap = None
+        try:
+            conf = camera_conf(camera, supervisor_conf)
+            motion_roi_rects = read_pascal_voc_rectangles(camera.get('pascal_voc'))
+            motion_roi_polygons = read_labelme_polygons(camera.get('roi_polygons'))
+
+            stage_timer = create_stage_timer(conf)
+            add_stage_timer_gauges(stage_timer, image_writer)
+            bg_sub = BackgroundSubtractor(**conf.to_dict(), motion_roi_rects=motion_roi_rects, motion_roi_polygons=motion_roi_polygons, stage_timer=stage_timer)
+            event_tracker = create_event_tracker(conf, image_writer, motion_roi_rects, motion_roi_polygons=motion_roi_polygons)
+            clip_recorder = create_clip_recorder(conf, image_writer.frame_pool)
+            frame_bus = create_frame_bus(conf)
+
+            print(f"{camera['name']}: starting on {conf['camera_src']}")
+            cap = open_live_stream(conf)
+            process_live_stream(cap, conf, args, bg_sub, image_writer, motion_roi_rects, stop_event, event_tracker, clip_recorder, governor, frame_bus)
+        except Exception as exc:
+            print(f"{camera['name']}: pipeline failed: {exc}")
+        finally:
+            # process_live_stream only stops the capture when it returns normally, a pipeline that
+            # failed would leave the capture thread and the camera device open for the restart
+            if cap is not None:
+                cap.stop()
+            if clip_recorder is not None:
+                clip_recorder.stop()
+            if frame_bus is not None:
+                frame_bus.close()
+
+        if not restart:
+            break
+        if not stop_event.is_set():
+            print(f"{camera['name']}: restarting in {restart_delay}s")
+            stop_event.wait(restart_delay)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--cameras", required=False, default="./config/cameras.json", help="path to the json file with the camera definitions")
+    ap.add_argument("--opencv-threads", type=int, default=1, help="cv2.setNumThreads.  At 1 all of a camera's detection work is on its own thread, where its cpu_budget is measured")
+    args = vars(ap.parse_args())
+
+    supervisor_conf = Conf(args['cameras'])
+    cameras = supervisor_conf['cameras'] or []
+    if len(cameras) == 0:
+        raise ValueError(f"No cameras in {args['cameras']}")
+    names = [camera['name'] for camera in cameras]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Camera names have to be unique: {names}")
+
+    cv2.setNumThreads(args['opencv_threads'])
+
+    # one writer and one uploader for all of the cameras
+    image_writer = create_image_writer(supervisor_conf)
+
+    bg_dropbox = None
+    if supervisor_conf['upload_dropbox']:
+        load_dotenv()
+        load_dotenv(dotenv_path=supervisor_conf['dropbox_env_file'])
+        access_token = os.getenv('dropbox_access_token')
+
+        bg_dropbox = DropboxFileWatcherUpload(dropbox_access_token=access_token, root_dir=supervisor_conf['detected_motion_dir'], pattern=f"*.{supervisor_conf['snapshot_format'] or 'jpg'}",
+                                              delete_after_process=supervisor_conf['delete_after_process'],
+                                              watcher=supervisor_conf['file_watcher'] or 'auto', workers=supervisor_conf['upload_workers'] or 1,
+                                              journal_path=supervisor_conf['upload_journal'])
+        bg_dropbox.start()
+        connect_file_processor(image_writer, bg_dropbox)
+
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"Received signal {signum}, shutting down")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    governors = {}
+    for camera in cameras:
+        target_fps = camera.get('overrides', {}).get('target_fps', Conf(camera['bg_config'])['target_fps'])
+        governors[camera['name']] = CpuBudgetGovernor(target_fps, camera.get('cpu_budget', 0))
+
+    with ThreadPoolExecutor(max_workers=len(cameras), thread_name_prefix="camera") as pool:
+        futures = [pool.submit(run_camera, camera, supervisor_conf, image_writer, governors[camera['name']], stop_event) for camera in cameras]
+
+        last_report_time = time.time()
+        while not stop_event.is_set() and not all(future.done() for future in futures):
+            stop_event.wait(1)
+            if time.time() - last_report_time >= LIVE_REPORT_INTERVAL:
+                last_report_time = time.time()
+                for name, governor in governors.items():
+                    print(f"{name}: {governor.stats_summary()}")
+                print(f"Writer queue {image_writer.queue_size()}, {image_writer.frame_pool.stats_summary()}")
+
+        stop_event.set()
+
+    for name, governor in governors.items():
+        print(f"{name}: {governor.stats_summary()}")
+
+    image_writer.drain()
+
+    if bg_dropbox is not None:
+        bg_dropbox.drain()
+        print(bg_dropbox.stats_summary())
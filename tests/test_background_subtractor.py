@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from utils.BackgroundSubtractUtil import BackgroundSubtractor
+
+
+def frames(width, height, count=5):
+    rng = np.random.default_rng(0)
+    for _ in range(count):
+        yield rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("settings", [
+    {},
+    {'process_width': 320},
+    {'motion_roi_rects': [(10, 10, 200, 150)], 'motion_roi_polygons': [[(300, 50), (500, 50), (400, 300)]]},
+    {'motion_roi_rects': [(10, 10, 200, 150)], 'roi_mode': 'crop', 'process_width': 320},
+    {'motion_roi_rects': [(10, 10, 200, 150)], 'gate_interval': 3, 'lighting_change': True},
+])
+def test_frame_size_change(settings):
+    subtractor = BackgroundSubtractor('MOG2', **settings)
+    for width, height in ((640, 480), (1280, 720), (640, 480)):
+        for frame in frames(width, height):
+            motion, _, _, image, mask, _ = subtractor.apply(frame)
+            assert image.shape == frame.shape
+            if mask is not None:
+                assert mask.shape[1] == min(width, settings.get('process_width') or width)
+
+    assert subtractor.input_shape == (480, 640, 3)
+
+
+def test_roi_mask_follows_the_frame_size():
+    subtractor = BackgroundSubtractor('MOG2', motion_roi_rects=[(0, 0, 100, 100)], process_width=320)
+    subtractor.apply(np.zeros((480, 640, 3), dtype=np.uint8))
+    assert subtractor.roi_mask.shape == (240, 320)
+
+    subtractor.apply(np.zeros((720, 1280, 3), dtype=np.uint8))
+    assert subtractor.roi_mask.shape == (180, 320)
+    assert subtractor.process_scale == 0.25
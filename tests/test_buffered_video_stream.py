@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+import utils.BufferedVideoStreamUtil as BufferedVideoStreamUtil
+from utils.BufferedVideoStreamUtil import BufferedVideoStream, is_live_source
+
+
+class FakeCapture:
+    """
+    cv2.VideoCapture stand in whose grab() fails on the calls in fail_on, counted over every
+    capture opened, and that runs out after frames good grabs
+    """
+    opened = 0
+    grabs = 0
+
+    def __init__(self, src, frames=10, fail_on=()):
+        FakeCapture.opened += 1
+        self.frames = frames
+        self.fail_on = fail_on
+        self.position = 0
+
+    def grab(self):
+        FakeCapture.grabs += 1
+        if FakeCapture.grabs in self.fail_on or self.position >= self.frames:
+            return False
+        self.position += 1
+        return True
+
+    def retrieve(self, buffer=None):
+        return True, np.full((4, 4, 3), self.position, dtype=np.uint8)
+
+    def get(self, prop):
+        return self.position * 40.0
+
+    def release(self):
+        pass
+
+
+@pytest.fixture
+def fake_capture(monkeypatch):
+    FakeCapture.opened = 0
+    FakeCapture.grabs = 0
+
+    def use(**kwargs):
+        monkeypatch.setattr(BufferedVideoStreamUtil.cv2, "VideoCapture", lambda src: FakeCapture(src, **kwargs))
+    return use
+
+
+def read_all(stream):
+    values = []
+    while True:
+        frame = stream.read()
+        if frame is None:
+            return values
+        values.append(int(frame[0, 0, 0]))
+
+
+@pytest.mark.parametrize("src, live", [(0, True), ("1", True), ("rtsp://192.168.1.20:554/stream1", True), ("./media/atv.mp4", False)])
+def test_is_live_source(src, live):
+    assert is_live_source(src) == live
+
+
+def test_file_ends_at_first_failed_read(fake_capture):
+    fake_capture(fail_on=(4,))
+    stream = BufferedVideoStream("./media/atv.mp4", retry_delay=0).start()
+
+    assert read_all(stream) == [1, 2, 3]
+    assert stream.read_errors == 0
+    stream.stop()
+
+
+def test_live_source_retries_a_failed_read(fake_capture):
+    fake_capture(frames=1000, fail_on=(4,))
+    stream = BufferedVideoStream(0, retry_delay=0).start()
+
+    values = [int(stream.read()[0, 0, 0]) for _ in range(6)]
+    stream.stop()
+    # one failed read is retried on the same capture
+    assert values == [1, 2, 3, 4, 5, 6]
+    assert (stream.read_errors, stream.reopens, FakeCapture.opened) == (1, 0, 1)
+    assert not stream.gave_up
+
+
+def test_live_source_reopened_after_failed_reads_in_a_row(fake_capture):
+    fake_capture(frames=1000, fail_on=(3, 4, 5))
+    stream = BufferedVideoStream("rtsp://camera/stream", retry_delay=0).start()
+
+    values = [int(stream.read()[0, 0, 0]) for _ in range(4)]
+    stream.stop()
+    # the second and third failures in a row each reopen the source, which starts from the beginning
+    assert values == [1, 2, 1, 2]
+    assert (stream.read_errors, stream.reopens, FakeCapture.opened) == (3, 2, 3)
+
+
+def test_live_source_ends_after_read_retries(fake_capture):
+    fake_capture(frames=1000, fail_on=range(3, 100))
+    stream = BufferedVideoStream(0, read_retries=3, retry_delay=0).start()
+
+    assert read_all(stream) == [1, 2]
+    assert (stream.read_errors, stream.reopens) == (4, 2)
+    assert stream.gave_up
+    stream.stop()
@@ -0,0 +1,62 @@
+import datetime
+import cv2
+import numpy as np
+from utils.EventClipRecorderUtil import EventClipRecorder
+
+START = datetime.datetime(2026, 10, 18, 10, 0, 0)
+
+
+def frame(value, width=160):
+    return np.full((width * 3 // 4, width, 3), value, dtype=np.uint8)
+
+
+def record(recorder, fps, motion):
+    """
+    Hand frames at fps to the recorder, motion is a list of True/False per frame
+    """
+    frames_without_motion = 100
+    for i, moving in enumerate(motion):
+        frames_without_motion = 0 if moving else frames_without_motion + 1
+        timestamp = START + datetime.timedelta(seconds=i / fps)
+        assert recorder.add_frame(timestamp, frame(i % 250), moving, frames_without_motion)
+    recorder.stop()
+
+
+def clip_frames(tmp_path):
+    clips = list(tmp_path.glob("*/*-clip.mp4"))
+    assert len(clips) == 1
+    cap = cv2.VideoCapture(str(clips[0]))
+    fps, count = cap.get(cv2.CAP_PROP_FPS), int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return fps, count
+
+
+def test_clip_uses_the_rate_frames_arrive_at(tmp_path):
+    recorder = EventClipRecorder(str(tmp_path), pre_roll_seconds=0, end_frames=5, queue_size=200).start()
+    # a governed camera delivering 4 fps, whatever target_fps says
+    record(recorder, 4, [False] * 10 + [True] * 20 + [False] * 10)
+
+    fps, count = clip_frames(tmp_path)
+    assert round(fps) == 4
+    # the motion frames and the end_frames after them, one clip frame each
+    assert count == 25
+
+
+def test_sampled_pre_roll_is_filled_to_its_duration(tmp_path):
+    recorder = EventClipRecorder(str(tmp_path), pre_roll_seconds=1, pre_roll_step=3, pre_roll_width=80, end_frames=5, queue_size=200).start()
+    record(recorder, 10, [False] * 30 + [True] * 10 + [False] * 10)
+
+    # only every 3rd idle frame was copied and encoded
+    assert recorder.frames_sampled_out > 0
+    fps, count = clip_frames(tmp_path)
+    assert round(fps) == 10
+    # about a second of pre-roll, then the 10 motion frames and 5 end frames
+    assert 8 + 15 <= count <= 11 + 15
+
+
+def test_flush_does_not_block_on_a_full_queue(tmp_path):
+    # not started, so nothing empties the queue
+    recorder = EventClipRecorder(str(tmp_path), queue_size=1, flush_timeout=0.01)
+    assert recorder.add_frame(START, frame(1), True, 0)
+    recorder.flush()
+    assert recorder.flushes_dropped == 1
@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+import pytest
+from utils.FrameCacheUtil import FrameCache
+
+
+@pytest.fixture
+def clip(tmp_path):
+    path = tmp_path / "clip.avi"
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 48))
+    for i in range(12):
+        writer.write(np.full((48, 64, 3), i * 20, dtype=np.uint8))
+    writer.release()
+    return path
+
+
+def test_open_decodes_once(tmp_path, clip):
+    cache = FrameCache(tmp_path / "cache")
+    first = cache.open(clip)
+    second = cache.open(clip)
+
+    assert len(first) == len(second) == 12
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert not first.frames.flags.writeable
+
+
+def test_clip_evicted_by_another_process_is_decoded_again(tmp_path, clip, monkeypatch):
+    cache = FrameCache(tmp_path / "cache")
+    cache.open(clip)
+    other_process = FrameCache(tmp_path / "cache")
+    real_map = FrameCache._map
+    evictions = []
+
+    def evicted_first(npy_path, json_path):
+        # the other process evicts the clip after this one found it and before it is mapped
+        if not evictions:
+            evictions.append(other_process.entries()[0]['key'])
+            other_process._remove(evictions[0])
+        return real_map(npy_path, json_path)
+
+    monkeypatch.setattr(FrameCache, "_map", staticmethod(evicted_first))
+    cached = cache.open(clip)
+
+    assert len(cached) == 12
+    assert (cache.hits, cache.misses) == (0, 2)
@@ -0,0 +1,32 @@
+import numpy as np
+from utils.BackgroundImageWriterUtil import BackgroundImageWriter, write_encoded
+from utils.FileWatcherUtil import scan_tree
+
+
+def test_write_encoded_leaves_only_the_complete_file(tmp_path):
+    encoded = np.arange(1000, dtype=np.uint8) % 251
+    write_encoded(encoded, str(tmp_path / "a-1.jpg"))
+
+    assert [p.name for p in tmp_path.iterdir()] == ["a-1.jpg"]
+    assert (tmp_path / "a-1.jpg").read_bytes() == encoded.tobytes()
+
+
+def test_scan_does_not_report_files_being_written(tmp_path):
+    # what a poll or startup scan sees while the writer is part way through a snapshot
+    (tmp_path / "a-1.jpg.tmp").write_bytes(b"\xff\xd8")
+    found = []
+    scan_tree(str(tmp_path), "*.jpg", found.append)
+    assert found == []
+
+
+def test_writer_notifies_listeners_of_complete_files(tmp_path):
+    writer = BackgroundImageWriter()
+    headers = {}
+    writer.add_write_listener(lambda file_fqn: headers.update({file_fqn: open(file_fqn, 'rb').read(2)}))
+    writer.start()
+    frame = np.random.default_rng(1).integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    assert writer.add_image_to_queue(str(tmp_path / "a-1.jpg"), frame, throttle=False)
+    writer.drain()
+
+    assert headers == {str(tmp_path / "a-1.jpg"): b"\xff\xd8"}
+    assert [p.name for p in tmp_path.iterdir()] == ["a-1.jpg"]
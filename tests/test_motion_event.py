@@ -0,0 +1,76 @@
+import datetime
+import json
+import numpy as np
+from utils.FrameBufferPoolUtil import FrameBufferPool
+from utils.MotionEventUtil import MotionEventTracker
+
+START = datetime.datetime(2026, 10, 18, 10, 0, 0)
+
+
+class RecordingWriter:
+    extension = ".jpg"
+
+    def __init__(self):
+        self.frame_pool = FrameBufferPool()
+        self.queued = []
+
+    def add_image_to_queue(self, fqn, image, throttle=True, motion_box=None):
+        self.queued.append((fqn, int(image[0, 0, 0])))
+        return True
+
+
+def run(tracker, motion):
+    """
+    :param motion: per frame, the area of the motion blob or 0 for no motion.  Each frame is
+            filled with its index so the snapshots can be told apart.
+    """
+    frames_without_motion = 0
+    for i, area in enumerate(motion):
+        frames_without_motion = 0 if area else frames_without_motion + 1
+        side = int(area ** 0.5)
+        rects, areas = ([(10, 10, side, side)], [area]) if area else ([], [])
+        tracker.update(START + datetime.timedelta(seconds=i), area > 0, frames_without_motion, rects, areas,
+                       np.full((120, 160, 3), i, dtype=np.uint8))
+    tracker.close()
+
+
+def test_frames_before_the_event_opens_are_candidates(tmp_path):
+    writer = RecordingWriter()
+    tracker = MotionEventTracker(writer, str(tmp_path), start_frames=3, end_frames=2, top_k=1)
+    # the largest blob is on the first motion frame, before the event opens on the third
+    run(tracker, [0, 900, 100, 100, 100, 0, 0, 0])
+
+    assert [image for _, image in writer.queued] == [1]
+    metadata = json.loads(next(tmp_path.glob("*/*-event.json")).read_text())
+    assert metadata["start"] == (START + datetime.timedelta(seconds=1)).isoformat()
+    assert metadata["motion_frames"] == 4
+
+
+def test_short_run_does_not_leak_frames(tmp_path):
+    writer = RecordingWriter()
+    tracker = MotionEventTracker(writer, str(tmp_path), start_frames=3, end_frames=2)
+    run(tracker, [0, 400, 400, 0, 400, 0])
+
+    assert writer.queued == []
+    assert tracker.run_frames == []
+    assert len(writer.frame_pool.free) == writer.frame_pool.allocations
+
+
+def test_centre_includes_polygon_rois(tmp_path):
+    tracker = MotionEventTracker(RecordingWriter(), str(tmp_path), motion_roi_rects=[(0, 0, 40, 40)],
+                                 motion_roi_polygons=[[(100, 0), (160, 0), (160, 120)]])
+    cx, cy, _ = tracker._centre((120, 160, 3))
+    assert (cx, cy) == (80, 60)
+
+
+def test_old_metadata_is_deleted(tmp_path):
+    old_day = tmp_path / (START - datetime.timedelta(days=10)).strftime("%Y%m%d")
+    old_day.mkdir()
+    (old_day / "old-event.json").write_text("{}")
+    (old_day / "old.jpg").write_text("")
+
+    run(MotionEventTracker(RecordingWriter(), str(tmp_path), start_frames=1, end_frames=1, metadata_days=7), [100, 0])
+
+    assert not (old_day / "old-event.json").exists()
+    assert (old_day / "old.jpg").exists()
+    assert len(list(tmp_path.glob("*/*-event.json"))) == 1
@@ -0,0 +1,288 @@
+from threading import Event, Thread
+import time
+import cv2
+import numpy as np
+import pytest
+from utils.AWSRekognitionFileWatcher import AWSRekognitionFileWatcher
+from utils.PerceptualHashCacheUtil import PerceptualHashCache, dhash
+from utils.RateLimiterUtil import RateLimiter
+from utils.rekognition_utils import StubRekognitionClient
+
+
+def jpeg_bytes(seed):
+    image = np.random.default_rng(seed).integers(0, 256, (240, 320, 3), dtype=np.uint8)
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+
+def write_snapshot(directory, name, seed):
+    path = directory / name
+    path.write_bytes(jpeg_bytes(seed))
+    return path
+
+
+class FakeClock:
+    """
+    Monotonic clock that only moves when sleep() is called or it is advanced by hand
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class FailingRekognitionClient:
+    def detect_labels(self, Image, MaxLabels=10, MinConfidence=80):
+        raise RuntimeError("throttled")
+
+
+class BlockingRekognitionClient(StubRekognitionClient):
+    """
+    Stub client whose calls wait for release, so several workers can be made to overlap
+    """
+
+    def __init__(self, fail=False):
+        super().__init__(latency=0)
+        self.fail = fail
+        self.entered = Event()
+        self.release = Event()
+
+    def detect_labels(self, Image, MaxLabels=10, MinConfidence=80):
+        self.entered.set()
+        assert self.release.wait(5)
+        if self.fail:
+            self.fail = False
+            raise RuntimeError("throttled")
+        return super().detect_labels(Image, MaxLabels, MinConfidence)
+
+
+def create_watcher(tmp_path, client, clock=None, **kwargs):
+    watcher = AWSRekognitionFileWatcher(label_filter=['vehicle'], aws_profile_name=None, aws_region=None,
+                                        root_dir=str(tmp_path / "motion"), pattern="*.jpg", output_dir=str(tmp_path / "aws_output"),
+                                        rekognition_client=client, **kwargs)
+    if clock is not None:
+        watcher.rate_limiter = RateLimiter(watcher.rate_limiter.max_per_second, clock=clock, sleep=clock.sleep)
+        if watcher.hash_cache is not None:
+            watcher.hash_cache = PerceptualHashCache(watcher.hash_cache.window_seconds, watcher.hash_cache.max_distance, clock=clock)
+    return watcher
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def motion_dir(tmp_path):
+    directory = tmp_path / "motion"
+    directory.mkdir()
+    return directory
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_rate_limiter_unlimited_does_not_wait(clock):
+    limiter = RateLimiter(0, clock=clock, sleep=clock.sleep)
+    assert all(limiter.acquire() == 0.0 for _ in range(100))
+    assert limiter.wait_seconds == 0.0
+    assert clock.slept == []
+
+
+def test_rate_limiter_spaces_calls(clock):
+    limiter = RateLimiter(20, clock=clock, sleep=clock.sleep)
+    waits = [limiter.acquire() for _ in range(5)]
+
+    # the first call uses the burst token, each one after that waits for the next token
+    assert waits == pytest.approx([0.0, 0.05, 0.05, 0.05, 0.05])
+    assert clock.slept == pytest.approx(waits[1:])
+    assert limiter.wait_seconds == pytest.approx(0.2)
+
+
+def test_rate_limiter_refills_while_idle(clock):
+    limiter = RateLimiter(10, burst=3, clock=clock, sleep=clock.sleep)
+    assert [limiter.acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire() == pytest.approx(0.1)
+
+    clock.now += 10
+    assert [limiter.acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+
+
+def test_hash_cache_hit_within_window(clock):
+    cache = PerceptualHashCache(window_seconds=30, max_distance=6, clock=clock)
+    image_hash = dhash(jpeg_bytes(1))
+    cache.put(image_hash, "labels")
+
+    clock.now += 29
+    assert cache.get(image_hash) == "labels"
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_hash_cache_miss_for_different_image(clock):
+    cache = PerceptualHashCache(window_seconds=30, max_distance=6, clock=clock)
+    cache.put(dhash(jpeg_bytes(1)), "labels")
+
+    assert cache.get(dhash(jpeg_bytes(2))) is None
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_hash_cache_miss_outside_window(clock):
+    cache = PerceptualHashCache(window_seconds=30, max_distance=6, clock=clock)
+    image_hash = dhash(jpeg_bytes(1))
+    cache.put(image_hash, "labels")
+
+    clock.now += 31
+    assert cache.get(image_hash) is None
+    assert len(cache.entries) == 0
+
+
+def test_hash_cache_ignores_undecodable_bytes():
+    cache = PerceptualHashCache()
+    image_hash = dhash(b"not a jpeg")
+    assert image_hash is None
+    cache.put(image_hash, "labels")
+    assert cache.get(image_hash) is None
+
+
+def test_watcher_reuses_labels_of_near_duplicate(tmp_path, motion_dir, clock):
+    client = StubRekognitionClient(latency=0)
+    watcher = create_watcher(tmp_path, client, clock)
+    first = write_snapshot(motion_dir, "20261018-100000-1.jpg", 1)
+    second = write_snapshot(motion_dir, "20261018-100001-2.jpg", 1)
+
+    watcher.process_file(str(first))
+    clock.now += 5
+    watcher.process_file(str(second))
+
+    stats = watcher.stats()
+    assert client.calls == 1
+    assert (stats['calls_made'], stats['calls_saved'], stats['call_errors']) == (1, 1, 0)
+    # both matched the filter and were moved to the output directory for their day
+    assert stats['files_matched'] == 2
+    assert sorted(p.name for p in (tmp_path / "aws_output" / "20261018").iterdir()) == [first.name, second.name]
+
+
+def test_watcher_calls_again_after_window(tmp_path, motion_dir, clock):
+    client = StubRekognitionClient(latency=0)
+    watcher = create_watcher(tmp_path, client, clock, cache_window=30)
+
+    watcher.process_file(str(write_snapshot(motion_dir, "a-1.jpg", 1)))
+    clock.now += 31
+    watcher.process_file(str(write_snapshot(motion_dir, "b-1.jpg", 1)))
+
+    assert client.calls == 2
+    assert (watcher.calls_made, watcher.calls_saved) == (2, 0)
+
+
+def test_watcher_calls_for_each_different_snapshot(tmp_path, motion_dir, clock):
+    client = StubRekognitionClient(latency=0)
+    watcher = create_watcher(tmp_path, client, clock)
+
+    for seed in range(3):
+        watcher.process_file(str(write_snapshot(motion_dir, f"a-{seed}.jpg", seed)))
+
+    assert (watcher.calls_made, watcher.calls_saved) == (3, 0)
+
+
+def test_watcher_without_cache(tmp_path, motion_dir):
+    client = StubRekognitionClient(latency=0)
+    watcher = create_watcher(tmp_path, client, cache_window=0)
+
+    assert watcher.hash_cache is None
+    for i in range(2):
+        watcher.process_file(str(write_snapshot(motion_dir, f"a-{i}.jpg", 1)))
+    assert (watcher.calls_made, watcher.calls_saved) == (2, 0)
+
+
+def test_watcher_rate_limits_calls(tmp_path, motion_dir, clock):
+    watcher = create_watcher(tmp_path, StubRekognitionClient(latency=0), clock, max_calls_per_second=20, cache_window=0)
+
+    for i in range(5):
+        watcher.process_file(str(write_snapshot(motion_dir, f"a-{i}.jpg", i)))
+
+    assert watcher.calls_made == 5
+    assert watcher.stats()['rate_limit_wait'] == pytest.approx(0.2)
+    assert clock.now == pytest.approx(1000.2)
+
+
+def test_concurrent_near_duplicates_make_one_call(tmp_path, motion_dir):
+    client = BlockingRekognitionClient()
+    watcher = create_watcher(tmp_path, client)
+    first = Thread(target=watcher.process_file, args=(str(write_snapshot(motion_dir, "a-1.jpg", 1)),))
+    second = Thread(target=watcher.process_file, args=(str(write_snapshot(motion_dir, "a-2.jpg", 1)),))
+
+    first.start()
+    assert client.entered.wait(5)
+    second.start()
+    # the second worker waits for the first one's labels instead of calling as well
+    wait_for(lambda: watcher.hash_cache.waits == 1)
+    client.release.set()
+    first.join(5)
+    second.join(5)
+
+    assert client.calls == 1
+    assert (watcher.calls_made, watcher.calls_saved) == (1, 1)
+    assert watcher.files_matched == 2
+    assert watcher.hash_cache.pending == []
+
+
+def test_waiting_worker_calls_when_the_first_call_fails(tmp_path, motion_dir):
+    client = BlockingRekognitionClient(fail=True)
+    watcher = create_watcher(tmp_path, client)
+    errors = []
+
+    def process(path):
+        try:
+            watcher.process_file(path)
+        except RuntimeError as exc:
+            errors.append(exc)
+
+    first = Thread(target=process, args=(str(write_snapshot(motion_dir, "a-1.jpg", 1)),))
+    second = Thread(target=process, args=(str(write_snapshot(motion_dir, "a-2.jpg", 1)),))
+    first.start()
+    assert client.entered.wait(5)
+    second.start()
+    wait_for(lambda: watcher.hash_cache.waits == 1)
+    client.release.set()
+    first.join(5)
+    second.join(5)
+
+    assert len(errors) == 1
+    assert (watcher.calls_made, watcher.calls_saved, watcher.call_errors) == (1, 0, 1)
+    assert watcher.hash_cache.pending == []
+
+
+def test_watcher_raises_errors(tmp_path, motion_dir):
+    watcher = create_watcher(tmp_path, FailingRekognitionClient())
+    snapshot = write_snapshot(motion_dir, "a-1.jpg", 1)
+
+    with pytest.raises(RuntimeError, match="throttled"):
+        watcher.process_file(str(snapshot))
+
+    stats = watcher.stats()
+    assert (stats['calls_made'], stats['calls_saved'], stats['call_errors']) == (0, 0, 1)
+    # left where it is to be retried, and the failure is not cached
+    assert snapshot.exists()
+    assert len(watcher.hash_cache.entries) == 0
+    assert watcher.hash_cache.pending == []
+
+
+def test_watcher_leaves_unmatched_snapshots(tmp_path, motion_dir):
+    client = StubRekognitionClient(labels=[{'Name': 'Tree', 'Confidence': 99.0}], latency=0)
+    watcher = create_watcher(tmp_path, client)
+    snapshot = write_snapshot(motion_dir, "a-1.jpg", 1)
+
+    watcher.process_file(str(snapshot))
+
+    assert snapshot.exists()
+    assert watcher.files_matched == 0
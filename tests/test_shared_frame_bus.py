@@ -0,0 +1,89 @@
+import datetime
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+from utils.SharedFrameBusUtil import _PID, FrameBusPublisher, FrameBusSubscriber
+
+
+def frame_and_mask(height, width, value):
+    return np.full((height, width, 3), value, dtype=np.uint8), np.full((height, width), value, dtype=np.uint8)
+
+
+@pytest.fixture
+def publisher():
+    publisher = FrameBusPublisher(f"test_frame_bus_{os.getpid()}", slots=4)
+    yield publisher
+    publisher.close()
+
+
+def test_subscriber_reads_published_frames(publisher):
+    frame, mask = frame_and_mask(48, 64, 7)
+    publisher.publish(datetime.datetime.now(), frame, mask, True, [(1, 2, 3, 4)])
+    subscriber = FrameBusSubscriber(publisher.name, timeout=1)
+
+    bus_frame = subscriber.read()
+    assert bus_frame.seq == 0
+    assert bus_frame.motion
+    assert bus_frame.motion_rects == [(1, 2, 3, 4)]
+    assert np.array_equal(bus_frame.frame, frame) and np.array_equal(bus_frame.mask, mask)
+    assert subscriber.read() is None
+    del bus_frame
+    subscriber.close()
+
+
+def test_frame_size_change_replaces_the_bus(publisher):
+    now = datetime.datetime.now()
+    publisher.publish(now, *frame_and_mask(48, 64, 1), False)
+    subscriber = FrameBusSubscriber(publisher.name, timeout=1)
+    first = subscriber.read()
+    assert first.frame.shape == (48, 64, 3)
+
+    # the next clip is a different resolution
+    frame, mask = frame_and_mask(72, 96, 2)
+    assert publisher.publish(now, frame, mask, True) == 1
+    assert publisher.generation == 1
+
+    # read while still holding a frame of the old shared memory
+    second = subscriber.read()
+    assert subscriber.generation == 1
+    assert second.seq == 1
+    assert np.array_equal(second.frame, frame) and np.array_equal(second.mask, mask)
+    assert not subscriber.closed()
+
+    del first, second
+    publisher.close()
+    assert subscriber.closed()
+    subscriber.close()
+    assert subscriber.retired == []
+
+
+def test_second_publisher_of_a_live_bus_fails(publisher):
+    publisher.publish(datetime.datetime.now(), *frame_and_mask(48, 64, 1), False)
+    second = FrameBusPublisher(publisher.name)
+
+    with pytest.raises(FileExistsError, match=str(os.getpid())):
+        second.publish(datetime.datetime.now(), *frame_and_mask(48, 64, 1), False)
+    # the first publisher's bus is untouched
+    subscriber = FrameBusSubscriber(publisher.name, timeout=1)
+    assert subscriber.read().seq == 0
+    subscriber.close()
+
+
+def test_bus_left_behind_by_a_dead_process_is_taken_over(publisher):
+    exited = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    dead_pid = int(exited.stdout)
+    left_behind = FrameBusPublisher(publisher.name)
+    left_behind.publish(datetime.datetime.now(), *frame_and_mask(48, 64, 1), False)
+    left_behind.header[_PID] = dead_pid
+    # as if the process had been killed, nothing was closed
+    left_behind.header = left_behind.slot_views = None
+    left_behind.shm.close()
+
+    publisher.publish(datetime.datetime.now(), *frame_and_mask(48, 64, 5), True)
+    subscriber = FrameBusSubscriber(publisher.name, timeout=1)
+    bus_frame = subscriber.read()
+    assert bus_frame.frame[0, 0, 0] == 5
+    del bus_frame
+    subscriber.close()
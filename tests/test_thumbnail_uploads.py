@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+import pytest
+from utils.AWSRekognitionFileWatcher import AWSRekognitionFileWatcher
+from utils.BackgroundFileProcessor import BackgroundFileProcessor
+from utils.DropboxFileWatcherUpload import DropboxFileWatcherUpload
+from utils.SnapshotEncoderUtil import THUMBNAIL_PATTERN, SnapshotEncoder, thumbnail_path
+from utils.rekognition_utils import StubRekognitionClient
+
+
+class RecordingProcessor(BackgroundFileProcessor):
+    def __init__(self, root_dir, **kwargs):
+        super().__init__(root_dir, pattern="*.jpg", watcher='poll', exclude=THUMBNAIL_PATTERN, **kwargs)
+        self.processed = []
+
+    def process_file(self, absolute_file_path):
+        self.processed.append(absolute_file_path.name)
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    """
+    A snapshot and its thumbnail, encoded the way the BackgroundImageWriter does
+    """
+    day_dir = tmp_path / "motion" / "20261018"
+    day_dir.mkdir(parents=True)
+    frame = np.random.default_rng(1).integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    path = day_dir / "20261018-100000-1.jpg"
+    for suffix, encoded in SnapshotEncoder(thumbnail_width=40).encode(frame):
+        encoded.tofile(str(path.with_name(f"{path.stem}{suffix}.jpg")))
+    assert thumbnail_path(path).exists()
+    return path
+
+
+def test_thumbnail_path():
+    assert thumbnail_path("/motion/20261018/a-1.jpg").as_posix() == "/motion/20261018/a-1-thumb.jpg"
+
+
+def test_watcher_does_not_pick_up_thumbnails(tmp_path, snapshot):
+    processor = RecordingProcessor(str(tmp_path / "motion"))
+    processor.start()
+    processor.notify(thumbnail_path(snapshot))
+    processor.drain()
+
+    assert processor.processed == [snapshot.name]
+
+
+def test_rekognition_skips_thumbnails(tmp_path, snapshot):
+    client = StubRekognitionClient(labels=[{'Name': 'Tree', 'Confidence': 99.0}], latency=0)
+    watcher = AWSRekognitionFileWatcher(label_filter=['vehicle'], aws_profile_name=None, aws_region=None,
+                                        root_dir=str(tmp_path / "motion"), pattern="*.jpg", watcher='poll',
+                                        output_dir=str(tmp_path / "aws_output"), rekognition_client=client, cache_window=0)
+    watcher.start()
+    watcher.drain()
+
+    assert client.calls == 1
+
+
+def test_dropbox_uploads_thumbnail_with_its_snapshot(tmp_path, snapshot, monkeypatch):
+    uploader = DropboxFileWatcherUpload(dropbox_access_token="test", root_dir=str(tmp_path / "motion"), pattern="*.jpg",
+                                        delete_after_process=True, watcher='poll')
+    uploaded = []
+    monkeypatch.setattr(uploader, "_upload_file", lambda file_from, file_to: uploaded.append(file_to) or 1)
+    uploader.start()
+    uploader.drain()
+
+    assert uploaded == ["/20261018/20261018-100000-1.jpg", "/20261018/20261018-100000-1-thumb.jpg"]
+    assert not snapshot.exists() and not thumbnail_path(snapshot).exists()
@@ -0,0 +1,403 @@
+"""
+Search for the detection settings that find the labelled motion in the bundled clips for the least CPU.
+
+The ground truth motion intervals of each clip are in config/motion_labels.json.  Trials are the bg
+config with some of erode_kernel, erode_iterations, dilate_kernel, dilate_iterations, min_radius,
+min_area_ratio and the <name>_params changed, picked from SEARCH_SPACE (or --space) by a grid or a
+random search.  The unchanged bg config is always trial 0.
+
+Each clip is decoded once, in to a FrameCache, and every trial in the process pool maps the same
+frames read only instead of decoding the clip again.  Motion frames are grouped in to
+events with the event_start_frames/event_end_frames of the bg config, the same way the
+MotionEventTracker does it.  An event that overlaps a labelled interval is a true event, and a
+labelled interval that overlaps an event has been found.  Trials are ranked on the F1 score of the
+events, then the F1 score of the motion frames, then the CPU ms per frame.
+
+Usage:
+
+python tuner.py --pascal-voc ./config/motion_roi.xml
+
+python tuner.py --bg-config ./config/rpi_headless_bg_subtract_config.json --pascal-voc ./config/motion_roi.xml --trials 100 --workers 4
+
+python tuner.py --subtractors MOG MOG2 --search grid --space ./my_search_space.json --decode-width 960
+
+python tuner.py --pascal-voc ./config/motion_roi.xml --decode-width 640 --frame-cache ./frame_cache
+
+Writes <output-dir>/tuner_report.json, <output-dir>/tuner_report.md and the bg config with the
+settings of the best trial to --output-config
+"""
+import argparse
+import functools
+import glob
+import itertools
+import json
+import platform
+import random
+import shutil
+import tempfile
+import time
+from multiprocessing import get_context
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from benchmark import DETECTION_KEYS, SUBTRACTORS
+from utils.BackgroundSubtractUtil import BackgroundSubtractor
+from utils.conf import Conf
+from utils.FrameCacheUtil import FrameCache, create_frame_cache
+from utils.image_util import scale_rectangles, scale_polygons
+from utils.labelme_util import read_labelme_polygons
+from utils.pascal_voc_util import read_pascal_voc_rectangles
+
+# config key -> values to try.  <name>.<param> is a parameter of the <name> block and is only used
+# for trials of that subtractor, e.g. "MOG_params.history"
+SEARCH_SPACE = {
+    "erode_kernel": [0, 3, 5],
+    "erode_iterations": [1, 2, 3],
+    "dilate_kernel": [3, 5, 7],
+    "dilate_iterations": [1, 2, 3, 4],
+    "min_radius": [100, 200, 400, 700, 1000],
+    "min_area_ratio": [0, 0.0001, 0.0005, 0.001],
+    "CNT_params.minPixelStability": [5, 10, 15, 30],
+    "CNT_params.maxPixelStability": [300, 900],
+    "MOG_params.history": [50, 100, 200],
+    "MOG_params.nmixtures": [3, 5],
+    "MOG_params.backgroundRatio": [0.5, 0.7, 0.9],
+    "MOG2_params.history": [50, 100, 200, 500],
+    "MOG2_params.varThreshold": [8, 16, 32, 64],
+    "GMG_params.initializationFrames": [10, 20, 40],
+    "GMG_params.decisionThreshold": [0.7, 0.8, 0.9],
+}
+
+
+def trial_keys(space, subtractor):
+    """
+    :return: the keys of space that apply to a subtractor, sorted so the trials are repeatable
+    """
+    return sorted(key for key in space if '.' not in key or key.startswith(f"{subtractor}_params."))
+
+
+def apply_changes(detection_conf, changes):
+    """
+    :return: a copy of detection_conf with the changes of a trial, <name>_params.<param> keys are
+            set in the <name>_params block
+    """
+    conf = json.loads(json.dumps(detection_conf))
+    for key, value in changes.items():
+        if '.' in key:
+            block, param = key.split('.', 1)
+            conf[block] = dict(conf.get(block) or {}, **{param: value})
+        else:
+            conf[key] = value
+    return conf
+
+
+def build_trials(base_conf, subtractors, space, search, max_trials, seed):
+    """
+    :param base_conf: the bg config as a dict
+    :param search: 'grid' for every combination of the values in space, 'random' for max_trials
+            random combinations
+    :return: list of trial dicts.  Trial 0 is base_conf unchanged
+    """
+    base_detection_conf = {k: base_conf.get(k) for k in DETECTION_KEYS if base_conf.get(k) is not None}
+    base_detection_conf['named_subtractor'] = base_conf['named_subtractor']
+    for name in set(subtractors) | {base_conf['named_subtractor']}:
+        params_key = f"{name}_params"
+        if params_key in base_conf:
+            base_detection_conf[params_key] = base_conf[params_key]
+
+    trials = [{"trial": 0, "changes": {}, "conf": base_detection_conf}]
+    seen = {json.dumps(base_detection_conf, sort_keys=True)}
+
+    def add(changes):
+        conf = apply_changes(base_detection_conf, changes)
+        key = json.dumps(conf, sort_keys=True)
+        if key in seen:
+            return
+        seen.add(key)
+        trials.append({"trial": len(trials), "changes": changes, "conf": conf})
+
+    if search == 'grid':
+        for name in subtractors:
+            keys = trial_keys(space, name)
+            for values in itertools.product(*[space[key] for key in keys]):
+                add(dict({"named_subtractor": name}, **dict(zip(keys, values))))
+    else:
+        rng = random.Random(seed)
+        # a small space can have fewer unique combinations than max_trials
+        for _ in range(max_trials * 20):
+            if len(trials) > max_trials:
+                break
+            name = rng.choice(subtractors)
+            add(dict({"named_subtractor": name}, **{key: rng.choice(space[key]) for key in trial_keys(space, name)}))
+
+    return trials
+
+
+def motion_events(motion, start_frames, end_frames):
+    """
+    Group per frame motion results in to events like the MotionEventTracker.  An event opens after
+    start_frames motion frames in a row and closes after end_frames frames in a row without motion.
+
+    :return: list of (first motion frame, last motion frame) of each event
+    """
+    events = []
+    run = 0
+    last_motion = None
+    for index, moving in enumerate(motion):
+        if moving:
+            run += 1
+            if len(events) > 0 and events[-1][1] is None:
+                last_motion = index
+            elif run >= start_frames:
+                events.append([index - run + 1, None])
+                last_motion = index
+        else:
+            run = 0
+            if len(events) > 0 and events[-1][1] is None and index - last_motion >= end_frames:
+                events[-1][1] = last_motion
+    if len(events) > 0 and events[-1][1] is None:
+        events[-1][1] = last_motion
+    return [tuple(event) for event in events]
+
+
+def overlaps(interval, intervals):
+    return any(interval[0] <= end and start <= interval[1] for start, end in intervals)
+
+
+def score_clip(motion, labels, start_frames, end_frames):
+    """
+    :param labels: list of [first frame, last frame] of the labelled motion
+    :return: event and frame counts of one clip
+    """
+    events = motion_events(motion, start_frames, end_frames)
+    labelled = np.zeros(len(motion), dtype=bool)
+    for start, end in labels:
+        labelled[start:end + 1] = True
+    motion = np.asarray(motion, dtype=bool)
+
+    return {
+        "events": len(events),
+        "true_events": sum(1 for event in events if overlaps(event, labels)),
+        "labels": len(labels),
+        "labels_found": sum(1 for label in labels if overlaps(label, events)),
+        "frames": len(motion),
+        "motion_frames": int(motion.sum()),
+        "labelled_frames": int(labelled.sum()),
+        "true_motion_frames": int((motion & labelled).sum()),
+        "event_intervals": events,
+    }
+
+
+def f1(precision, recall):
+    return 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+
+
+def run_trial(trial, clips, labels, motion_roi_rects, motion_roi_polygons, start_frames, end_frames, threads, frame_cache_dir, decode_width):
+    """
+    Process pool worker.  Runs one trial over every clip, reading the frames from the FrameCache in
+    frame_cache_dir.
+    """
+    if threads is not None:
+        cv2.setNumThreads(threads)
+
+    # no size limit, the main process has already fitted the clips in to the cache
+    frame_cache = FrameCache(frame_cache_dir)
+    clip_results = []
+    cpu_seconds = 0.0
+    for clip in clips:
+        cached_clip = frame_cache.open(clip, width=decode_width)
+        conf = dict(trial['conf'])
+        scale = cached_clip.scale
+        rects, polygons = motion_roi_rects, motion_roi_polygons
+        if scale != 1.0:
+            # the config and the ROIs are in full resolution pixels
+            conf['min_radius'] = (conf.get('min_radius') or 0) * scale
+            rects = scale_rectangles(motion_roi_rects, scale)
+            polygons = scale_polygons(motion_roi_polygons, scale)
+        bg_sub = BackgroundSubtractor(**conf, motion_roi_rects=rects, motion_roi_polygons=polygons)
+
+        motion = []
+        start_cpu = time.process_time()
+        for frame in cached_clip.frames:
+            motion.append(bg_sub.apply(frame)[0])
+        cpu_seconds += time.process_time() - start_cpu
+
+        clip_results.append(dict(score_clip(motion, labels[Path(clip).name], start_frames, end_frames), clip=Path(clip).name))
+
+    totals = {key: sum(r[key] for r in clip_results) for key in ["events", "true_events", "labels", "labels_found", "frames",
+                                                                  "motion_frames", "labelled_frames", "true_motion_frames"]}
+    event_precision = totals['true_events'] / totals['events'] if totals['events'] > 0 else 0.0
+    event_recall = totals['labels_found'] / totals['labels'] if totals['labels'] > 0 else 0.0
+    frame_precision = totals['true_motion_frames'] / totals['motion_frames'] if totals['motion_frames'] > 0 else 0.0
+    frame_recall = totals['true_motion_frames'] / totals['labelled_frames'] if totals['labelled_frames'] > 0 else 0.0
+
+    return dict(totals,
+                trial=trial['trial'],
+                subtractor=trial['conf']['named_subtractor'],
+                changes=trial['changes'],
+                conf=trial['conf'],
+                event_precision=event_precision,
+                event_recall=event_recall,
+                event_f1=f1(event_precision, event_recall),
+                frame_precision=frame_precision,
+                frame_recall=frame_recall,
+                frame_f1=f1(frame_precision, frame_recall),
+                cpu_seconds=cpu_seconds,
+                cpu_ms_per_frame=(cpu_seconds / totals['frames']) * 1000 if totals['frames'] > 0 else 0.0,
+                clips=clip_results)
+
+
+def rank_results(results):
+    """
+    Sort the trials best first and mark the ones on the pareto front of event F1, frame F1 and CPU,
+    the trials no other trial beats on all three
+    """
+    results.sort(key=lambda r: (-r['event_f1'], -r['frame_f1'], r['cpu_ms_per_frame'], r['trial']))
+    for r in results:
+        r['pareto'] = not any(o['event_f1'] >= r['event_f1'] and o['frame_f1'] >= r['frame_f1'] and o['cpu_ms_per_frame'] <= r['cpu_ms_per_frame'] and
+                              (o['event_f1'], o['frame_f1'], o['cpu_ms_per_frame']) != (r['event_f1'], r['frame_f1'], r['cpu_ms_per_frame'])
+                              for o in results)
+    for rank, r in enumerate(results, start=1):
+        r['rank'] = rank
+    return results
+
+
+def describe_changes(changes):
+    return ", ".join(f"{key}={value}" for key, value in changes.items() if key != 'named_subtractor') or "bg config"
+
+
+def write_report(results, output_dir, run_info, top):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    with open(output_dir / "tuner_report.json", 'w') as f:
+        json.dump({"run": run_info, "results": results}, f, indent=2)
+
+    lines = ["| rank | trial | subtractor | changes | events | event P | event R | event F1 | frame P | frame R | frame F1 | CPU ms/frame | pareto |",
+             "|---:|---:|---|---|---:|---:|---:|---:|---:|---:|---:|---:|---|"]
+    for r in results[:top]:
+        lines.append(f"| {r['rank']} | {r['trial']} | {r['subtractor']} | {describe_changes(r['changes'])} | {r['events']} | "
+                     f"{r['event_precision']:.2f} | {r['event_recall']:.2f} | {r['event_f1']:.2f} | {r['frame_precision']:.2f} | "
+                     f"{r['frame_recall']:.2f} | {r['frame_f1']:.2f} | {r['cpu_ms_per_frame']:.2f} | {'*' if r['pareto'] else ''} |")
+
+    base = next(r for r in results if r['trial'] == 0)
+    if base['rank'] > top:
+        lines.append(f"| {base['rank']} | 0 | {base['subtractor']} | bg config | {base['events']} | {base['event_precision']:.2f} | "
+                     f"{base['event_recall']:.2f} | {base['event_f1']:.2f} | {base['frame_precision']:.2f} | {base['frame_recall']:.2f} | "
+                     f"{base['frame_f1']:.2f} | {base['cpu_ms_per_frame']:.2f} | {'*' if base['pareto'] else ''} |")
+
+    best = results[0]
+    lines += ["", f"Best trial {best['trial']} per clip", "",
+              "| clip | frames | labelled | events | true events | labels found | motion frames | true motion frames |",
+              "|---|---:|---|---|---:|---:|---:|---:|"]
+    for c in best['clips']:
+        labelled = " ".join(f"{start}-{end}" for start, end in run_info['labels'][c['clip']])
+        events = " ".join(f"{start}-{end}" for start, end in c['event_intervals'])
+        lines.append(f"| {c['clip']} | {c['frames']} | {labelled} | {events} | {c['true_events']} | {c['labels_found']}/{c['labels']} | "
+                     f"{c['motion_frames']} | {c['true_motion_frames']} |")
+
+    table = "\n".join(lines)
+    with open(output_dir / "tuner_report.md", 'w') as f:
+        f.write(table + "\n")
+
+    return table
+
+
+def write_best_config(base_conf, best, output_config, decode_width):
+    """
+    Write the bg config with the detection settings of the best trial.  The comments of the bg
+    config are not kept.
+    """
+    conf = dict(base_conf, **best['conf'])
+    if decode_width > 0 and (not conf.get('process_width') or conf['process_width'] > decode_width):
+        # the kernels were tuned on frames of this width
+        conf['process_width'] = decode_width
+
+    output_config = Path(output_config)
+    output_config.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_config, 'w') as f:
+        json.dump(conf, f, indent='\t')
+    return output_config
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--bg-config", default="./config/mac_bg_subtract_config.json", help="bg config the trials start from")
+    ap.add_argument("--labels", default="./config/motion_labels.json", help="json file with the labelled motion intervals of each clip")
+    ap.add_argument("--media", nargs='+', default=sorted(glob.glob("./media/*.mp4")), help="video clips to run over, clips without labels are skipped")
+    ap.add_argument("--pascal-voc", required=False, help="Path to rectangle annotated file in PascalVOC format with ROIs to look for motion")
+    ap.add_argument("--roi-polygons", required=False, help="Path to a LabelMe json file with polygon ROIs")
+    ap.add_argument("--subtractors", nargs='+', choices=SUBTRACTORS, required=False,
+                    help="subtractors to try, defaults to the one of the bg config")
+    ap.add_argument("--space", required=False, help="json file of config key -> list of values to search instead of SEARCH_SPACE")
+    ap.add_argument("--search", default="random", choices=["random", "grid"], help="random picks --trials combinations, grid tries all of them")
+    ap.add_argument("--trials", type=int, default=40, help="number of random trials, on top of the bg config")
+    ap.add_argument("--seed", type=int, default=0, help="seed of the random search")
+    ap.add_argument("--decode-width", type=int, default=0, help="downscale the decoded frames to this width, 0 keeps the full width.  "
+                                                                  "Less memory and faster trials, the best config gets it as its process_width")
+    ap.add_argument("--frame-cache", required=False, help="directory to cache the decoded frames in, to use them again in the next run.  "
+                                                        "A temporary directory that is removed at the end by default")
+    ap.add_argument("--frame-cache-max-mb", type=float, default=10240, help="size limit of the frame cache, least recently used clips are removed")
+    ap.add_argument("--threads", type=int, default=1, help="cv2.setNumThreads for each trial.  Keep at 1 for repeatable CPU numbers")
+    ap.add_argument("--workers", type=int, default=1, help="number of trials to run at the same time")
+    ap.add_argument("--top", type=int, default=20, help="trials in the markdown report")
+    ap.add_argument("--output-dir", default="./benchmark_results", help="directory to write the reports to")
+    ap.add_argument("--output-config", default="./benchmark_results/tuned_bg_subtract_config.json", help="where to write the bg config of the best trial")
+    args = vars(ap.parse_args())
+
+    base_conf = Conf(args['bg_config']).to_dict()
+    labels = Conf(args['labels']).to_dict()
+    space = Conf(args['space']).to_dict() if args['space'] else SEARCH_SPACE
+    subtractors = args['subtractors'] or [base_conf['named_subtractor']]
+    motion_roi_rects = read_pascal_voc_rectangles(args['pascal_voc'])
+    motion_roi_polygons = read_labelme_polygons(args['roi_polygons'])
+
+    media = []
+    for clip in args['media']:
+        if Path(clip).name in labels:
+            media.append(clip)
+        else:
+            print(f"{Path(clip).name}: no labels in {args['labels']}, skipped")
+    if len(media) == 0:
+        raise ValueError(f"None of the clips have labels in {args['labels']}")
+
+    trials = build_trials(base_conf, subtractors, space, args['search'], args['trials'], args['seed'])
+
+    frame_cache_dir = args['frame_cache'] or tempfile.mkdtemp(prefix="tuner-")
+    try:
+        # decode each clip before the trials, so they all map the same frames
+        frame_cache = create_frame_cache(frame_cache_dir, args['frame_cache_max_mb'])
+        for clip in media:
+            print(f"{Path(clip).name}: {len(frame_cache.open(clip, width=args['decode_width']))} frames")
+        print(frame_cache.stats_summary())
+        if frame_cache.evictions > 0:
+            print("The clips do not all fit in the frame cache, the trials will decode the evicted ones again")
+
+        print(f"Running {len(trials)} trials over {len(media)} clips")
+        worker = functools.partial(run_trial, clips=media, labels=labels, motion_roi_rects=motion_roi_rects, motion_roi_polygons=motion_roi_polygons,
+                                   start_frames=base_conf.get('event_start_frames') or 2, end_frames=base_conf.get('event_end_frames') or 15,
+                                   threads=args['threads'], frame_cache_dir=frame_cache_dir, decode_width=args['decode_width'])
+        ctx = get_context('spawn')
+        results = []
+        with ctx.Pool(processes=args['workers']) as pool:
+            for r in pool.imap_unordered(worker, trials):
+                results.append(r)
+                print(f"trial {r['trial']:4} {r['subtractor']:5} event F1 {r['event_f1']:.2f}  frame F1 {r['frame_f1']:.2f}  "
+                      f"{r['cpu_ms_per_frame']:7.2f} CPU ms/frame  {describe_changes(r['changes'])}")
+    finally:
+        if args['frame_cache'] is None:
+            shutil.rmtree(frame_cache_dir, ignore_errors=True)
+
+    rank_results(results)
+    run_info = {
+        "time": time.time(),
+        "platform": platform.platform(),
+        "opencv": cv2.__version__,
+        "args": args,
+        "labels": {Path(clip).name: labels[Path(clip).name] for clip in media},
+        "space": space,
+    }
+    print(write_report(results, args['output_dir'], run_info, args['top']))
+    print(f"Best trial {results[0]['trial']}, config written to {write_best_config(base_conf, results[0], args['output_config'], args['decode_width'])}")
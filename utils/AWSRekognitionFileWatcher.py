@@ -2,61 +2,179 @@ import sys
 sys.path.append("..")
 
 from utils.BackgroundFileProcessor import BackgroundFileProcessor
+from utils.PerceptualHashCacheUtil import PerceptualHashCache, dhash
+from utils.RateLimiterUtil import RateLimiter
+from utils.SnapshotEncoderUtil import THUMBNAIL_PATTERN
 from pathlib import Path
+from collections import deque
+from threading import Lock
+import time
 import boto3
-from rekognition_utils import RekognitionLabel
-from cv2_utils import read_image, draw_label_bounding_box
+import numpy as np
+from utils.rekognition_utils import RekognitionLabel
 from typing import List
 
 
 class AWSRekognitionFileWatcher(BackgroundFileProcessor):
+    """
+        Send each new snapshot to AWS Rekognition detect_labels and move the snapshots with a label
+        in label_filter to output_dir.
+
+        The calls are made from several worker threads, kept under max_calls_per_second by a shared
+        rate limiter.  Only the encoded bytes are sent, the image is not decoded apart from a cheap
+        1/8 scale grayscale decode for the perceptual hash.  A snapshot that is a near duplicate of
+        one sent in the last cache_window seconds reuses its labels instead of making another call,
+        and a worker whose snapshot is a near duplicate of one another worker is sending waits for
+        those labels.
+        Thumbnails are left out, they are the same scene as their snapshot.
+    """
 
     def __init__(self, label_filter: List, aws_profile_name: str, aws_region: str, root_dir: str, pattern: str = "*",
                  delete_after_process: bool = False, batch_size: int = 10, polling_time: int = 5,
-                 output_dir: str = "../aws_output"):
-        super().__init__(root_dir, pattern, delete_after_process, batch_size, polling_time)
+                 output_dir: str = "../aws_output", watcher: str = 'auto', workers: int = 4, journal_path: str = None,
+                 max_calls_per_second: float = 5, cache_window: float = 30, cache_max_distance: int = 6,
+                 rekognition_client=None):
+        """
+
+        :param workers: number of threads making detect_labels calls at the same time
+        :param max_calls_per_second: client side limit on detect_labels calls.  0 means no limit
+        :param cache_window: seconds a result is kept for reuse by near duplicate snapshots.  0 turns the cache off
+        :param cache_max_distance: hamming distance between perceptual hashes that still counts as a near duplicate
+        :param rekognition_client: client to use instead of creating a boto3 one, for example a
+                rekognition_utils.StubRekognitionClient to run offline
+        """
+        super().__init__(root_dir, pattern, delete_after_process, batch_size, polling_time, watcher, workers, journal_path,
+                         exclude=THUMBNAIL_PATTERN)
         self.label_filter = label_filter
         self.output_dir = output_dir
         self.destination = Path(self.output_dir)
 
-        session = boto3.Session(profile_name=aws_profile_name, region_name=aws_region)
-        self.rekognition_client = session.client('rekognition')
-
-    def process_file(self, absolute_file_path):
-        print(absolute_file_path)
-        image_path = Path(absolute_file_path)
-
+        if rekognition_client is None:
+            session = boto3.Session(profile_name=aws_profile_name, region_name=aws_region)
+            rekognition_client = session.client('rekognition')
+        self.rekognition_client = rekognition_client
+
+        self.rate_limiter = RateLimiter(max_calls_per_second)
+        self.hash_cache = PerceptualHashCache(cache_window, cache_max_distance) if cache_window else None
+
+        self.stats_lock = Lock()
+        self.calls_made = 0
+        self.calls_saved = 0
+        self.call_errors = 0
+        self.files_matched = 0
+        self.call_latencies = deque(maxlen=1000)
+        self.start_time = time.time()
+
+    def _detect_labels(self, image_bytes):
+        self.rate_limiter.acquire()
+        call_start = time.perf_counter()
         try:
-            img_str, image, rgb_image, h, w = read_image(str(image_path))
-            image_data = {'Bytes': img_str}
             response = self.rekognition_client.detect_labels(
-                Image=image_data,
+                Image={'Bytes': image_bytes},
                 MaxLabels=10,
                 MinConfidence=80)
-            labels = [RekognitionLabel(label) for label in response['Labels']]
+        except Exception:
+            with self.stats_lock:
+                self.call_errors += 1
+            raise
 
-            for label in labels:
-                if label.name.lower() in self.label_filter:
-                    print(f"{label.name} with confidence: {label.confidence}")
-                    dest_image_dir = self.destination / str(absolute_file_path).split("/")[-1].split("-")[0]
-                    dest_image_dir.mkdir(parents=True, exist_ok=True)
-                    dest_image_path = dest_image_dir / str(absolute_file_path).split("/")[-1]
-                    print(dest_image_path)
+        with self.stats_lock:
+            self.calls_made += 1
+            self.call_latencies.append(time.perf_counter() - call_start)
+        return response['Labels']
 
-                    if not dest_image_path.exists():
-                        image_path.replace(dest_image_path)
+    def process_file(self, absolute_file_path):
+        """
+        Errors are logged and raised again so the file is recorded as failed and retried
+        """
+        print(absolute_file_path)
+        image_path = Path(absolute_file_path)
 
-                    # break out this loop, once we find one label save it
-                    # break
+        try:
+            image_bytes = image_path.read_bytes()
+
+            response_labels = None
+            pending, owner = None, False
+            if self.hash_cache is not None:
+                response_labels, pending, owner = self.hash_cache.reserve(dhash(image_bytes))
+                if pending is not None and not owner:
+                    # another worker is sending a near duplicate, use its labels unless its call fails
+                    response_labels = pending.wait()
+
+            if response_labels is None:
+                try:
+                    response_labels = self._detect_labels(image_bytes)
+                finally:
+                    if owner:
+                        self.hash_cache.complete(pending, response_labels)
+            else:
+                with self.stats_lock:
+                    self.calls_saved += 1
 
         except Exception as exc:
-            pass
+            print(f"ERROR: Rekognition failed for {absolute_file_path}: {exc}")
+            raise
+
+        labels = [RekognitionLabel(label) for label in response_labels]
+
+        for label in labels:
+            if label.name.lower() in self.label_filter:
+                print(f"{label.name} with confidence: {label.confidence}")
+                dest_image_dir = self.destination / str(absolute_file_path).split("/")[-1].split("-")[0]
+                dest_image_dir.mkdir(parents=True, exist_ok=True)
+                dest_image_path = dest_image_dir / str(absolute_file_path).split("/")[-1]
+                print(dest_image_path)
+
+                if not dest_image_path.exists():
+                    image_path.replace(dest_image_path)
+                    with self.stats_lock:
+                        self.files_matched += 1
+
+                # once one label matches the file has been moved
+                break
+
+    def stats(self):
+        elapsed = time.time() - self.start_time
+        with self.stats_lock:
+            latencies = np.fromiter(self.call_latencies, dtype=np.float64)
+            stats = {
+                "calls_made": self.calls_made,
+                "calls_saved": self.calls_saved,
+                "call_errors": self.call_errors,
+                "files_matched": self.files_matched,
+                "calls_per_sec": self.calls_made / elapsed if elapsed > 0 else 0.0,
+                "rate_limit_wait": self.rate_limiter.wait_seconds,
+                "backlog": self.backlog(),
+                "workers": self.workers,
+            }
+        if len(latencies) > 0:
+            p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+            stats["latency_ms"] = {"p50": round(float(p50), 2), "p95": round(float(p95), 2)}
+        else:
+            stats["latency_ms"] = {"p50": None, "p95": None}
+        return stats
+
+    def stats_summary(self):
+        s = self.stats()
+        latency = s['latency_ms']
+        latency_text = f"{latency['p50']:.0f}/{latency['p95']:.0f} ms p50/p95" if latency['p50'] is not None else "no calls"
+        return (f"Rekognition: {s['calls_made']} calls, {s['calls_saved']} saved by the cache, {s['call_errors']} errors, "
+                f"{s['files_matched']} matched, {s['calls_per_sec']:.2f} calls/s, {latency_text}, "
+                f"{s['rate_limit_wait']:.1f}s rate limited, backlog {s['backlog']}, {s['workers']} workers")
 
 
 if __name__ == '__main__':
     from dotenv import load_dotenv
+    from utils.rekognition_utils import StubRekognitionClient
+    import argparse
     import os
 
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--root-dir", default="../motion", help="directory to watch for snapshots")
+    ap.add_argument("--stub", action='store_true', help="use a local stub client instead of calling AWS")
+    ap.add_argument("--workers", type=int, default=4, help="number of concurrent detect_labels calls")
+    args = vars(ap.parse_args())
+
     load_dotenv()
     env_path = Path('.') / '.env'
     load_dotenv(dotenv_path=env_path)
@@ -66,9 +184,12 @@ if __name__ == '__main__':
 
     db = AWSRekognitionFileWatcher(
         label_filter=['transportation', 'wheel', 'vehicle', 'person', 'atv', 'bike', 'bicycle', 'motorcycle'],
-        aws_profile_name=aws_profile_name, aws_region=aws_region, root_dir="../motion", pattern="*.jpg",
-        delete_after_process=True)
+        aws_profile_name=aws_profile_name, aws_region=aws_region, root_dir=args['root_dir'], pattern="*.jpg",
+        delete_after_process=not args['stub'], workers=args['workers'],
+        rekognition_client=StubRekognitionClient() if args['stub'] else None)
 
     db.start()
 
     db.drain()
+
+    print(db.stats_summary())
@@ -1,61 +1,169 @@
-from threading import Thread
-import time
+from threading import Thread, Lock, Timer
+import queue
 from pathlib import Path
+from fnmatch import fnmatch
+import os
 import abc
+from utils.FileWatcherUtil import create_file_watcher
+from utils.FileJournalUtil import FileJournal, DONE, FAILED
 
 class BackgroundFileProcessor:
-
-    def __init__(self, root_dir: str, pattern:str="*", delete_after_process: bool=False, batch_size: int=10, polling_time: int=5 ):
+    """
+        Call process_file for each file under root_dir that matches pattern, in a background thread.
+
+        New files are found by a file watcher backend (see FileWatcherUtil), or handed over directly
+        with notify(), and queued.  Each file is only queued once.
+
+        The state of every file is kept in a FileJournal.  With a journal_path the journal is on disk,
+        so after a restart files that are done are skipped, files that were interrupted are retried,
+        and files that failed are retried until they have failed max_attempts times.
+    """
+
+    def __init__(self, root_dir: str, pattern:str="*", delete_after_process: bool=False, batch_size: int=10, polling_time: int=5, watcher: str='auto', workers: int=1,
+                 journal_path: str=None, max_attempts: int=5, retry_delay: float=30, exclude: str=None):
+        """
+
+        :param batch_size: no longer used, files are processed as they arrive.  Kept so existing callers still work.
+        :param polling_time: seconds between scans when the 'poll' watcher is used
+        :param watcher: one of FileWatcherUtil.FILE_WATCHERS
+        :param workers: number of threads calling process_file at the same time.  process_file
+                must be thread safe when this is more than 1.
+        :param journal_path: sqlite file to keep the file states in.  None keeps them in memory only.
+        :param max_attempts: number of times process_file is called for a file before giving up on it
+        :param retry_delay: seconds before a failed file is retried, multiplied by the number of failed attempts
+        :param exclude: files whose name matches this pattern are left out even when they match pattern
+        """
         self.pattern = pattern
+        self.exclude = exclude
         self.delete_after_process = delete_after_process
         self.batch_size = batch_size
         self.polling_time = polling_time
         self.root_dir = root_dir
+        self.watcher_kind = watcher
+        self.workers = workers
 
-    def start(self):
+        self.watcher = None
+        self.thread = None
+        self.threads = []
+        self.pending = queue.Queue()
+        # files that have been queued and not yet processed and deleted
+        self.seen = set()
+        self.seen_lock = Lock()
+
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.journal = FileJournal(journal_path if journal_path is not None else ":memory:")
 
-        # start a thread write frames to the video file
-        self.thread = Thread(target=self._run, args=())
-        self.thread.daemon = True
-        self.thread.start()
+    def start(self):
+        # the processing threads have to be running before the watcher does its startup scan
+        for i in range(max(1, self.workers)):
+            thread = Thread(target=self._run, args=())
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.thread = self.threads[0]
+
+        # anything left over from the last run that still needs work
+        for file_path in self.journal.retryable(self.max_attempts):
+            if os.path.exists(file_path):
+                self._enqueue(file_path)
+            else:
+                self.journal.remove(file_path)
+
+        self.watcher = create_file_watcher(self.watcher_kind, self.root_dir, self.pattern, self._enqueue, self.polling_time)
+        self.watcher.start()
+
+    def notify(self, file_path):
+        """
+        Tell the processor about a new file directly, for example from BackgroundImageWriter after
+        each imwrite, instead of waiting for the watcher to find it.
+        """
+        file_path = os.path.abspath(str(file_path))
+        if fnmatch(os.path.basename(file_path), self.pattern) and file_path.startswith(os.path.abspath(self.root_dir) + os.sep):
+            self._enqueue(file_path)
+
+    def _enqueue(self, file_path):
+        if self.exclude and fnmatch(os.path.basename(file_path), self.exclude):
+            return
+
+        with self.seen_lock:
+            if file_path in self.seen:
+                return
+
+            entry = self.journal.get(file_path)
+            if entry is not None:
+                state, attempts = entry
+                if state == DONE:
+                    # the process stopped between finishing the file and deleting it
+                    if self.delete_after_process:
+                        self._delete(file_path)
+                    return
+                if state == FAILED and attempts >= self.max_attempts:
+                    return
+
+            self.seen.add(file_path)
+            self.journal.mark_pending(file_path)
+        self.pending.put(file_path)
+
+    def _retry(self, file_path):
+        with self.seen_lock:
+            self.seen.discard(file_path)
+        if os.path.exists(file_path):
+            self._enqueue(file_path)
+
+    def _delete(self, file_path):
+        if Path(file_path).exists():
+            print(f"deleting....{file_path}")
+            Path(file_path).unlink()
+        # the file is gone so there is nothing left to remember about it
+        self.journal.remove(file_path)
 
     def _run(self):
 
         while True:
-            time.sleep(self.polling_time)
-            path = Path(self.root_dir)
-            for i, path_element in enumerate(path.rglob(self.pattern)):
-                # path_name = str(path_element)
-                if i >= self.batch_size:
-                    break
-
-                try:
-                    file_path = path_element.absolute()
-                    self.process_file(file_path)
+            file_path = self.pending.get()
+            try:
+                # the file may have been moved or removed since it was queued
+                if Path(file_path).exists():
+                    self.journal.mark_in_flight(file_path)
+                    self.process_file(Path(file_path))
+                    self.journal.mark_done(file_path)
                     if self.delete_after_process:
-                        if Path(file_path).exists():
-                            print(f"deleting....{file_path}")
-                            Path(file_path).unlink()
-                except Exception as exc:
-                    print(exc)
+                        self._delete(file_path)
+                        # a deleted name is free to be used again
+                        with self.seen_lock:
+                            self.seen.discard(file_path)
+                else:
+                    self.journal.remove(file_path)
+            except Exception as exc:
+                print(exc)
+                attempts = self.journal.mark_failed(file_path, str(exc))
+                if attempts < self.max_attempts:
+                    retry = Timer(self.retry_delay * attempts, self._retry, args=(file_path,))
+                    retry.daemon = True
+                    retry.start()
+                else:
+                    print(f"Giving up on {file_path} after {attempts} attempts")
+            finally:
+                self.pending.task_done()
 
     def drain(self):
         print(f"Drain: {self.root_dir}")
-        while True:
-            path = Path(self.root_dir)
-            # gets all the files
-            f = [y for y in path.rglob(self.pattern)]
-            if len(f) == 0:
-                break
-
-            time.sleep(1)
-
-
-
-
+        # pick up anything the watcher has not reported yet, then wait for the queue to empty.
+        # Failed files waiting for a retry are not waited for, they stay in the journal.
+        if self.watcher is not None:
+            self.watcher.scan()
+        self.pending.join()
+
+    def backlog(self):
+        """
+        :return: number of files waiting to be processed
+        """
+        return self.pending.qsize()
 
     def join(self):
-        self.thread.join()
+        for thread in self.threads:
+            thread.join()
 
     @abc.abstractmethod
     def process_file(self, absolute_file_path):
@@ -1,70 +1,267 @@
+import os
 import queue
-from threading import Thread
+from pathlib import Path
+from threading import Thread, Lock
 import time
-import cv2
+from utils.FrameBufferPoolUtil import FrameBufferPool
+from utils.SnapshotEncoderUtil import SnapshotEncoder, create_snapshot_encoder
+
+# when the queue is full, drop the image being added
+DROP_NEWEST = 'drop_newest'
+# when the queue is full, drop the oldest queued image to make room
+DROP_OLDEST = 'drop_oldest'
+# when the queue is full, wait up to put_timeout seconds for room, then drop the image being added
+BLOCK = 'block'
+
+WRITER_POLICIES = [DROP_NEWEST, DROP_OLDEST, BLOCK]
+
+
+def write_encoded(encoded, file_fqn):
+    """
+    Write encoded image bytes under a temporary name and rename it to file_fqn once it is complete,
+    so a file watcher never picks up a half written file.  The temporary name ends in .tmp, which
+    the watchers' *.<format> patterns do not match.
+    """
+    tmp_fqn = f"{file_fqn}.tmp"
+    encoded.tofile(tmp_fqn)
+    os.replace(tmp_fqn, file_fqn)
 
 
 class BackgroundImageWriter:
     """
         Write images to specified fully qualified name as a background, asynchronous activity
+
+        Images are encoded and written by a pool of worker threads that wait on the queue, so an
+        image is picked up as soon as it is queued.  cv2.imencode and the file write release the
+        GIL, so the workers encode in parallel with each other and with detection.  What happens
+        when the queue is full is set by policy, one of WRITER_POLICIES.
+
+        How the images are encoded, format, quality, size and cropping, is up to the SnapshotEncoder.
+        Callers name the images with the writer's extension.
     """
 
-    def __init__(self, max_image_q_depth:int=50, frames_between_writes:int=1, empty_q_poll_wait:int=1):
+    def __init__(self, max_image_q_depth:int=50, frames_between_writes:int=1, empty_q_poll_wait:int=1, frame_pool: FrameBufferPool=None,
+                 workers:int=2, policy:str=DROP_NEWEST, put_timeout:float=1.0, encoder: SnapshotEncoder=None):
+        """
+
+        :param empty_q_poll_wait: no longer used, the workers block on the queue.  Kept so existing callers still work.
+        :param frame_pool: images are handed back to this pool once they have been written.  Images
+                queued on the writer belong to it from then on.
+        :param workers: number of encoder threads
+        :param policy: what to do when the queue is full, one of WRITER_POLICIES
+        :param put_timeout: seconds add_image_to_queue waits for room with the 'block' policy
+        :param encoder: SnapshotEncoder for the images, None writes full size JPEGs at OpenCV's default quality
+        """
+        if policy not in WRITER_POLICIES:
+            raise ValueError(f"Invalid writer policy: {policy}.  Only {WRITER_POLICIES} allowed.")
+
         self.max_image_q_depth = max_image_q_depth
         self.recording = False
-        self.thread = None
+        self.threads = []
         self.Q = None
         self.frame_between_writes = frames_between_writes
         self.empty_q_poll_wait = empty_q_poll_wait
-        self.frames_since_writing = 100000
+        self.workers = max(1, workers)
+        self.policy = policy
+        self.put_timeout = put_timeout
+        # frames since the last throttled write, per throttle_key
+        self.frames_since_writing = {}
+        self.write_listeners = []
+        self.frame_pool = frame_pool if frame_pool is not None else FrameBufferPool()
+        self.encoder = encoder if encoder is not None else SnapshotEncoder()
+        # file extension the images should be named with
+        self.extension = self.encoder.extension
+
+        self.stats_lock = Lock()
+        self.images_written = 0
+        self.images_dropped = 0
+        self.write_errors = 0
+        self.bytes_written = 0
+        self.encode_seconds = 0.0
+        self.max_encode_seconds = 0.0
+
+    def add_write_listener(self, fn):
+        """
+        :param fn: called with the fully qualified name of each image after it has been written,
+                for example BackgroundFileProcessor.notify
+        """
+        self.write_listeners.append(fn)
+
+    def _drop(self, image, fqn):
+        self.frame_pool.release(image)
+        with self.stats_lock:
+            self.images_dropped += 1
+            dropped = self.images_dropped
+        # the first drop and every 50th after that, a full queue would flood the log otherwise
+        if dropped % 50 == 1:
+            print(f"Image writer queue full ({self.policy}), dropped {fqn}, {dropped} dropped so far")
+
+    def _put(self, fqn, image, motion_box):
+        """
+        Queue an image according to the policy
 
+        :return: True if the image was queued
+        """
+        if self.policy == BLOCK:
+            try:
+                self.Q.put((fqn, image, motion_box), timeout=self.put_timeout)
+                return True
+            except queue.Full:
+                self._drop(image, fqn)
+                return False
 
-    def add_image_to_queue(self, fqn, image):
-        try:
-            self.frames_since_writing += 1
+        while True:
+            try:
+                self.Q.put_nowait((fqn, image, motion_box))
+                return True
+            except queue.Full:
+                if self.policy == DROP_NEWEST:
+                    self._drop(image, fqn)
+                    return False
+            # DROP_OLDEST, make room and try again.  A worker may have emptied a slot in between
+            try:
+                old_fqn, old_image, _ = self.Q.get_nowait()
+                self.Q.task_done()
+                self._drop(old_image, old_fqn)
+            except queue.Empty:
+                pass
+
+    def add_image_to_queue(self, fqn, image, throttle=True, copy=False, throttle_key=None, motion_box=None):
+        """
+        :param throttle: only queue one image every frames_between_writes calls.  False always queues
+                the image, for callers like the MotionEventTracker that have already picked the frames.
+        :param copy: queue a frame_pool copy of image, for a capture buffer that is about to be reused.
+                The copy is only made if the image can be queued.
+        :param throttle_key: callers sharing one writer, like the cameras of the supervisor, are
+                throttled separately by key
+        :param motion_box: (minX, minY, maxX, maxY) of the motion in image, for an encoder that crops to it
+        :return: True if the image was queued to be written
+        """
+        if throttle:
+            frames_since_writing = self.frames_since_writing.get(throttle_key, 100000) + 1
+            self.frames_since_writing[throttle_key] = frames_since_writing
+            if frames_since_writing <= self.frame_between_writes:
+                return False
 
-            if self.frames_since_writing > self.frame_between_writes:
-                self.Q.put_nowait((fqn, image))
-                self.frames_since_writing = 0
+        if self.policy == DROP_NEWEST and self.Q.full():
+            # do not bother copying an image that is going to be dropped
+            if copy:
+                image = None
+            self._drop(image, fqn)
+            return False
 
-        except queue.Full:
-            print(f"Queue Full: {self.Q.qsize()}")
+        if copy:
+            image = self.frame_pool.copy(image)
+        if not self._put(fqn, image, motion_box):
+            return False
+        if throttle:
+            self.frames_since_writing[throttle_key] = 0
+        return True
 
     def start(self):
-        # indicate that we are recording, start the video writer,
-        # and initialize the queue of frames that need to be written
-        # to the video file
         self.recording = True
         self.Q = queue.Queue(maxsize=self.max_image_q_depth)
 
-        # start a thread write frames to the video file
-        self.thread = Thread(target=self._write, args=())
-        self.thread.daemon = True
-        self.thread.start()
+        for i in range(self.workers):
+            thread = Thread(target=self._write, args=(), name=f"image-writer-{i}")
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _write_image(self, fqn, frame, motion_box):
+        """
+        :return: the fully qualified names of the files written, the snapshot and any thumbnail
+        """
+        start = time.perf_counter()
+        encoded_files = self.encoder.encode(frame, motion_box)
+        encode_seconds = time.perf_counter() - start
+
+        path = Path(fqn)
+        written = []
+        # the thumbnail first, so it is there when a watcher picks up the snapshot
+        for suffix, encoded in reversed(encoded_files):
+            file_fqn = str(path.with_name(f"{path.stem}{suffix}{self.extension}"))
+            write_encoded(encoded, file_fqn)
+            written.append(file_fqn)
+
+        with self.stats_lock:
+            self.images_written += 1
+            self.bytes_written += sum(encoded.nbytes for _, encoded in encoded_files)
+            self.encode_seconds += encode_seconds
+            self.max_encode_seconds = max(self.max_encode_seconds, encode_seconds)
+        return written
 
     def _write(self):
         while True:
-            # check to see if there are entries in the queue
-            if not self.Q.empty():
-                # grab the next frame in the queue and write it
-                # to the video file
-                fqn, frame = self.Q.get()
-                cv2.imwrite(fqn, frame)
-
-            # otherwise, the queue is empty, so sleep for a bit
-            # so we don't waste CPU cycles
-            else:
-                # if we are done recording, exit the thread
-                if not self.recording:
-                    return
-
-                time.sleep(self.empty_q_poll_wait)
+            item = self.Q.get()
+            if item is None:
+                # sentinel from drain()
+                self.Q.task_done()
+                return
 
-    def drain(self):
-        while not self.Q.empty():
-            time.sleep(1)
+            fqn, frame, motion_box = item
+            written = []
+            try:
+                written = self._write_image(fqn, frame, motion_box)
+            except Exception as exc:
+                with self.stats_lock:
+                    self.write_errors += 1
+                print(f"Image writer failed to write {fqn}: {exc}")
+            finally:
+                self.frame_pool.release(frame)
+                self.Q.task_done()
+
+            for file_fqn in written:
+                for listener in self.write_listeners:
+                    listener(file_fqn)
 
+    def drain(self):
+        """
+        Wait for everything queued to be written, then stop the workers
+        """
+        if self.Q is None:
+            return
+        self.Q.join()
         self.recording = False
+        for _ in self.threads:
+            self.Q.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        print(self.stats_summary())
 
     def queue_size(self):
-        return self.Q.qsize()
\ No newline at end of file
+        return self.Q.qsize()
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "written": self.images_written,
+                "dropped": self.images_dropped,
+                "errors": self.write_errors,
+                "bytes": self.bytes_written,
+                "encode_ms_avg": (self.encode_seconds / self.images_written) * 1000 if self.images_written > 0 else 0.0,
+                "encode_ms_max": self.max_encode_seconds * 1000,
+                "queue": self.Q.qsize() if self.Q is not None else 0,
+            }
+
+    def stats_summary(self):
+        s = self.stats()
+        return (f"Image writer ({self.encoder.describe()}): wrote {s['written']} images, {s['bytes'] / (1024 * 1024):.1f} MB, dropped {s['dropped']}, "
+                f"{s['errors']} errors, encode {s['encode_ms_avg']:.1f}ms avg {s['encode_ms_max']:.1f}ms max, "
+                f"{self.workers} workers, policy {self.policy}")
+
+
+def create_image_writer(conf, frame_pool: FrameBufferPool = None):
+    """
+    :return: a started BackgroundImageWriter with the writer and snapshot encoding settings of conf
+    """
+    image_writer = BackgroundImageWriter(max_image_q_depth=conf['writer_queue_size'] or 50,
+                                         frames_between_writes=conf['frames_between_snaps'] or 1,
+                                         frame_pool=frame_pool,
+                                         workers=conf['writer_workers'] or 2,
+                                         policy=conf['writer_policy'] or DROP_NEWEST,
+                                         put_timeout=conf['writer_put_timeout'] if conf['writer_put_timeout'] is not None else 1.0,
+                                         encoder=create_snapshot_encoder(conf))
+    image_writer.start()
+    return image_writer
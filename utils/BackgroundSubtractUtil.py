@@ -1,16 +1,60 @@
+import time
 import cv2
 import numpy as np
 import imutils
-from utils.image_util import mask_image_to_rectanges
+from utils.image_util import clip_rectangles, merge_overlapping_rectangles, scale_rectangles, scale_polygons, polygon_bounding_rect, build_roi_mask
+from utils.StageTimerUtil import NULL_STAGE_TIMER
+from utils.FrameGateUtil import FrameDifferenceGate
+from utils.LightingChangeUtil import LightingChangeDetector
+
+ROI_MODES = ['mask', 'crop', 'union']
+BLOB_MODES = ['contours', 'components']
 
 class BackgroundSubtractor():
 
     def __init__(self, named_subtractor='CNT', min_radius:int=0, min_area_ratio=0, annotate_background_motion=False, erode_kernel:int=0, erode_iterations:int=0,
-                 dilate_kernel:int=0, dilate_iterations:int=0, motion_roi_rects:list=None, **kwargs):
+                 dilate_kernel:int=0, dilate_iterations:int=0, motion_roi_rects:list=None, roi_mode:str='mask', process_width:int=0, stage_timer=None,
+                 motion_roi_polygons:list=None, roi_min_inside_ratio:float=0, blob_mode:str='contours', blob_max_aspect_ratio:float=0,
+                 gate_interval:int=0, gate_threshold:float=12, gate_hold_frames:int=30, gate_thumb_width:int=32,
+                 lighting_change:bool=False, lighting_luminance_jump:float=25, lighting_foreground_ratio:float=0.5,
+                 lighting_transition_frames:int=60, lighting_profiles:list=None, **kwargs):
         """
 
         :param named_subtractor: one of CNT,GMG(DEFAULT),MOG,GSOC,LSBP
         :type named_subtractor:
+        :param roi_mode: how the motion_roi_rects are used.
+                'mask' - copy the ROIs in to a black full size frame and model the whole frame
+                'crop' - keep one subtractor model per ROI rectangle and only blur/subtract the cropped views
+                'union' - like 'crop' but overlapping ROI rectangles share one model over their union bounding box
+        :type roi_mode: str
+        :param process_width: when > 0, frames wider than this are downscaled to this width before detection.
+                motion_roi_rects, min_radius, the returned contours and the motion rectangle all stay in the
+                coordinates of the frame passed to apply().
+        :type process_width: int
+        :param stage_timer: optional StageTimer that apply() reports the time of each stage to
+        :param motion_roi_polygons: ROIs that are not rectangles, lists of (x, y) points.  They are used
+                along with motion_roi_rects, in 'crop' and 'union' mode each polygon is cropped to its bounding box.
+        :param roi_min_inside_ratio: reject motion contours with less than this fraction of their foreground
+                pixels inside the ROIs, for example foliage next to the trail.  0 turns the check off.
+        :param blob_mode: how the foreground blobs are found and filtered.
+                'contours' - findContours and a minEnclosingCircle/boundingRect per contour
+                'components' - connectedComponentsWithStats and numpy filtering of all of the blobs at once
+        :param blob_max_aspect_ratio: reject blobs with a bounding box longer than this ratio of its
+                width and height, like a swaying branch or wire.  0 turns the check off.
+        :param gate_interval: when > 0, a FrameDifferenceGate skips the full pipeline on quiet frames
+                and only runs it every gate_interval'th frame until the scene changes.  Skipped frames
+                are reported as frames without motion.
+        :param gate_threshold: gray level change of a gate thumbnail pixel that counts as a change
+        :param gate_hold_frames: frames that are all processed after a change or motion
+        :param gate_thumb_width: width of the gate thumbnail
+        :param lighting_change: watch for global lighting changes with a LightingChangeDetector.  After a
+                change the background model is started fresh, or swapped for the lighting_profiles entry
+                for the new luminance, and no motion is reported for lighting_transition_frames frames.
+        :param lighting_luminance_jump: jump in the mean ROI luminance, in gray levels, that is a lighting change
+        :param lighting_foreground_ratio: fraction of the ROIs that is foreground that is a lighting change
+        :param lighting_transition_frames: frames the fresh model learns for before motion is reported again
+        :param lighting_profiles: list of dicts with 'name', 'min_luminance'/'max_luminance' and the
+                'named_subtractor' and '<name>_params' to use in that luminance range
         """
         self.OPENCV_BG_SUBTRACTORS = {
             "CNT": cv2.bgsegm.createBackgroundSubtractorCNT,
@@ -21,11 +65,21 @@ class BackgroundSubtractor():
             "MOG2": cv2.createBackgroundSubtractorMOG2
         }
 
+        if roi_mode not in ROI_MODES:
+            raise ValueError(f"Invalid roi_mode: {roi_mode}.  Only {ROI_MODES} allowed.")
+        if blob_mode not in BLOB_MODES:
+            raise ValueError(f"Invalid blob_mode: {blob_mode}.  Only {BLOB_MODES} allowed.")
+
         subtractor_params = {}
         if f"{named_subtractor}_params" in kwargs.keys():
             subtractor_params = kwargs[f"{named_subtractor}_params"]
 
-        self.subtractor = self.OPENCV_BG_SUBTRACTORS[named_subtractor](**subtractor_params)
+        self.named_subtractor = named_subtractor
+        self.subtractor_params = subtractor_params
+        self.subtractor = self._create_subtractor()
+        # the configured subtractor and the <name>_params of every subtractor, for the lighting profiles
+        self.base_subtractor = (named_subtractor, subtractor_params)
+        self.all_subtractor_params = {key: value for key, value in kwargs.items() if key.endswith('_params')}
 
         self.eKernel = None
         self.dKernel = None
@@ -51,38 +105,232 @@ class BackgroundSubtractor():
         self.annotate_image = annotate_background_motion
 
         self.motion_roi_rects = motion_roi_rects
+        self.motion_roi_polygons = motion_roi_polygons or []
+        self.roi_min_inside_ratio = roi_min_inside_ratio
+        self.blob_mode = blob_mode
+        self.blob_max_aspect_ratio = blob_max_aspect_ratio
+        # set by apply(), the bounding box (x, y, w, h) and area of each motion blob in frame coordinates
+        self.motion_rects = []
+        self.motion_areas = []
+        self.roi_mode = roi_mode
+        self.process_width = process_width
 
-    def apply(self, image):
+        # frame -> processing scale and the ROIs in processing coordinates, set on the first frame
+        # and again whenever the frame size changes
+        self.input_shape = None
+        self.process_scale = None
+        self.process_roi_rects = None
+        self.process_roi_polygons = None
+        # all of the ROIs compiled in to one mask at the processing resolution, None without ROIs
+        self.roi_mask = None
 
-        mask = None
-        motion_roi_rects = self.motion_roi_rects
+        # crop/union mode state, built on the first frame once the frame size is known
+        self.roi_regions = None
+        self.roi_full_mask = None
+
+        self.stage_timer = stage_timer if stage_timer is not None else NULL_STAGE_TIMER
+
+        self.frame_gate = None
+        if gate_interval is not None and gate_interval > 0:
+            self.frame_gate = FrameDifferenceGate(gate_interval, gate_threshold, gate_hold_frames, gate_thumb_width)
+        # mask of the last processed frame, returned again for gated frames
+        self.last_mask = None
+
+        self.lighting = None
+        if lighting_change:
+            self.lighting = LightingChangeDetector(lighting_luminance_jump, lighting_foreground_ratio,
+                                                   lighting_transition_frames, profiles=lighting_profiles)
+
+        # preallocated per frame work images, see _buffer
+        self.buffers = {}
+        self.buffer_allocations = 0
+
+    def _buffer(self, name, shape, dtype=np.uint8):
+        """
+        Reusable work image, passed as the dst= of the OpenCV calls so apply() does not allocate
+        full size images every frame.  Only allocated again if the frame size changes.
+        """
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.zeros(shape, dtype=dtype)
+            self.buffers[name] = buffer
+            self.buffer_allocations += 1
+        return buffer
 
-        image = cv2.GaussianBlur(image, (3,3), 0)
+    def _create_subtractor(self):
+        return self.OPENCV_BG_SUBTRACTORS[self.named_subtractor](**self.subtractor_params)
 
-        if motion_roi_rects is not None and len(motion_roi_rects) > 0:
-            masked_image = mask_image_to_rectanges(image, motion_roi_rects)
-            mask = self.subtractor.apply(masked_image)
+    def _lighting_changed(self):
+        """
+        Start a fresh background model, with the settings of the profile for the new lighting.  It
+        learns the new background while motion is suppressed for the transition.
+        """
+        named_subtractor, subtractor_params = self.base_subtractor
+        profile = self.lighting.profile
+        if profile is not None:
+            named_subtractor = profile.get('named_subtractor', named_subtractor)
+            subtractor_params = profile.get(f"{named_subtractor}_params", self.all_subtractor_params.get(f"{named_subtractor}_params", {}))
+        self.named_subtractor = named_subtractor
+        self.subtractor_params = subtractor_params
+
+        self.subtractor = self._create_subtractor()
+        if self.roi_regions is not None:
+            for region in self.roi_regions:
+                region[2] = self._create_subtractor()
+        print(f"Lighting change, luminance {self.lighting.luminance:.0f}, relearning the background with "
+              f"{named_subtractor} ({self.lighting.profile_name()} profile)")
+
+    def _build_roi_regions(self, image_shape):
+        """
+        Create one subtractor model per region.  Each region is a list of
+        [ region_rect, member_mask, subtractor ] where member_mask is None when the region is a
+        single ROI rectangle, or a crop sized mask of the member shapes when the region is a polygon
+        or overlapping shapes were merged in to one union bounding box.
+        """
+        h, w = image_shape[:2]
+        # (xmin, ymin, xmax, ymax, polygon) with polygon None for rectangles.  The 5th element
+        # is carried along by merge_overlapping_rectangles, which only looks at the first 4
+        shapes = [rect + (None,) for rect in clip_rectangles(self.process_roi_rects or [], w, h)]
+        for polygon in self.process_roi_polygons:
+            rect = polygon_bounding_rect(polygon, w, h)
+            if rect is not None:
+                shapes.append(rect + (polygon,))
+
+        if self.roi_mode == 'union':
+            groups = merge_overlapping_rectangles(shapes)
         else:
-            mask = self.subtractor.apply(image)
+            groups = [(shape[:4], [shape]) for shape in shapes]
+
+        self.roi_regions = []
+        for (x0, y0, x1, y1), members in groups:
+            member_mask = None
+            if len(members) > 1 or members[0][4] is not None:
+                member_mask = build_roi_mask((y1 - y0, x1 - x0),
+                                             [m[:4] for m in members if m[4] is None],
+                                             [m[4] for m in members if m[4] is not None],
+                                             offset=(x0, y0))
+            self.roi_regions.append([(x0, y0, x1, y1), member_mask, self._create_subtractor()])
+
+        # full frame mask that the per region masks are copied in to.  This is only used
+        # for display and to keep the apply() return values the same as 'mask' mode.
+        self.roi_full_mask = np.zeros((h, w), dtype=np.uint8)
 
-        # perform erosions and dilations to eliminate noise and fill gaps
+    def _erode_dilate(self, mask, name='mask'):
+        # perform erosions and dilations to eliminate noise and fill gaps.
+        # erode in to a second buffer and dilate back in to the mask buffer
         if self.eKernel is not None:
-            mask = cv2.erode(mask, self.eKernel,
+            mask = cv2.erode(mask, self.eKernel, dst=self._buffer(f"{name}_morph", mask.shape),
                              iterations=self.erode_iterations)
+            self.stage_timer.lap('erode')
         if self.dKernel is not None:
-            mask = cv2.dilate(mask, self.dKernel,
+            mask = cv2.dilate(mask, self.dKernel, dst=self._buffer(name, mask.shape),
                               iterations=self.dilate_iterations)
+            self.stage_timer.lap('dilate')
+        return mask
 
-        # find contours in the mask and reset the motion status
-        contours = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL,
-                                cv2.CHAIN_APPROX_SIMPLE)
-        contours = imutils.grab_contours(contours)
-        motionThisFrame = False
+    def _apply_roi_regions(self, image):
+        """
+        Run each region subtractor on its cropped view of the image.
 
-        image_area = (image.shape[0] * image.shape[1])
+        :return: full frame mask, contours in full frame coordinates
+        """
+        if self.roi_regions is None:
+            self._build_roi_regions(image.shape)
+
+        timer = self.stage_timer
+        full_mask = self.roi_full_mask
+        for (x0, y0, x1, y1), _, _ in self.roi_regions:
+            full_mask[y0:y1, x0:x1] = 0
+
+        contours = []
+        for i, ((x0, y0, x1, y1), member_mask, subtractor) in enumerate(self.roi_regions):
+            crop = image[y0:y1, x0:x1]
+            roi_image = cv2.GaussianBlur(crop, (3,3), 0, dst=self._buffer(f"blur{i}", crop.shape))
+            timer.lap('blur')
+            if member_mask is not None:
+                # bitwise_and only writes where the mask is set, so clear the rest first
+                masked = self._buffer(f"masked{i}", crop.shape)
+                masked[:] = 0
+                roi_image = cv2.bitwise_and(roi_image, roi_image, dst=masked, mask=member_mask)
+                timer.lap('roi_mask')
+
+            roi_mask = subtractor.apply(roi_image, self._buffer(f"mask{i}", crop.shape[:2]))
+            timer.lap('subtract')
+            roi_mask = self._erode_dilate(roi_mask, f"mask{i}")
+
+            # crop regions may overlap so OR the region mask in to the full frame mask
+            full_roi_mask = full_mask[y0:y1, x0:x1]
+            cv2.bitwise_or(full_roi_mask, roi_mask, dst=full_roi_mask)
+            timer.lap('roi_mask')
+
+            if self.blob_mode == 'components':
+                # the blobs are found in the full frame mask afterwards
+                continue
+
+            # offset maps the contours back to frame coordinates
+            roi_contours = cv2.findContours(roi_mask, cv2.RETR_EXTERNAL,
+                                            cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+            contours.extend(imutils.grab_contours(roi_contours))
+            timer.lap('find_contours')
+
+        return full_mask, contours
+
+    def _set_process_scale(self, image_shape):
+        if self.input_shape is not None:
+            # a reopened stream or another camera mode, the background model and everything else
+            # sized for the old frames starts again
+            print(f"Frame size changed from {self.input_shape[1]}x{self.input_shape[0]} to "
+                  f"{image_shape[1]}x{image_shape[0]}, relearning the background")
+            self.subtractor = self._create_subtractor()
+            self.roi_regions = None
+            self.roi_full_mask = None
+            self.last_mask = None
+        self.input_shape = image_shape
+
+        self.process_scale = 1.0
+        if self.process_width is not None and 0 < self.process_width < image_shape[1]:
+            self.process_scale = self.process_width / image_shape[1]
+
+        self.process_roi_rects = self.motion_roi_rects
+        self.process_roi_polygons = self.motion_roi_polygons
+        if self.process_scale != 1.0:
+            if self.motion_roi_rects is not None:
+                self.process_roi_rects = scale_rectangles(self.motion_roi_rects, self.process_scale)
+            self.process_roi_polygons = scale_polygons(self.motion_roi_polygons, self.process_scale)
 
-        # loop over the contours
+        # compile the ROIs once, instead of copying each rectangle every frame
+        self.roi_mask = None
+        if self.process_roi_rects or self.process_roi_polygons:
+            process_shape = (int(round(image_shape[0] * self.process_scale)), int(round(image_shape[1] * self.process_scale)))
+            self.roi_mask = build_roi_mask(process_shape, clip_rectangles(self.process_roi_rects or [], process_shape[1], process_shape[0]),
+                                           self.process_roi_polygons)
+        if self.frame_gate is not None:
+            self.frame_gate.set_roi_mask(self.roi_mask)
+        if self.lighting is not None:
+            self.lighting.set_roi_mask(self.roi_mask)
+
+    def _inside_roi_ratio(self, mask, rect):
+        """
+        :return: fraction of the foreground pixels of mask inside rect that are also inside the ROIs
+        """
+        if self.roi_mask is None:
+            return 1.0
+        (x, y, w, h) = rect
+        foreground = cv2.countNonZero(mask[y:y + h, x:x + w])
+        if foreground == 0:
+            return 0.0
+        inside = cv2.countNonZero(cv2.bitwise_and(mask[y:y + h, x:x + w], self.roi_mask[y:y + h, x:x + w]))
+        return inside / foreground
+
+    def _contour_blobs(self, contours, mask, image_area, min_radius):
+        """
+        Filter the contours one at a time with minEnclosingCircle and boundingRect.
+
+        :return: threshold met contours, list of (rect, area, circle, radius_met, area_met) for each
+                of them, and the (minX, minY, maxX, maxY) rectangle around all of the contours
+        """
         threshold_met_contours = []
+        blobs = []
 
         # use these variables to find the largest rectangle surrounding the
         # motion
@@ -103,21 +351,199 @@ class BackgroundSubtractor():
             (x, y, radius) = [int(v) for v in (x, y, radius)]
 
             # only process motion contours above the specified size
-            # print(radius, (contour_area / image_area))
-            if radius >= self.min_radius or (contour_area / image_area) >= self.min_area_ratio:
-                motionThisFrame = True
-                self.framesWithoutMotion = 0
+            radius_met = radius >= min_radius
+            area_met = (contour_area / image_area) >= self.min_area_ratio
+            if radius_met or area_met:
+                if self.blob_max_aspect_ratio > 0 and max(rw, rh) / max(1, min(rw, rh)) > self.blob_max_aspect_ratio:
+                    continue
+                if self.roi_min_inside_ratio > 0 and self._inside_roi_ratio(mask, (rx, ry, rw, rh)) < self.roi_min_inside_ratio:
+                    continue
+
                 threshold_met_contours.append(c)
+                blobs.append(((rx, ry, rw, rh), cv2.contourArea(c), (x, y, radius), radius_met, area_met))
 
-                if self.annotate_image:
-                    if radius >= self.min_radius:
-                        cv2.circle(image, (x, y), radius, (0, 0, 255), 4)
-                    if (contour_area / image_area) >= self.min_area_ratio:
-                        # print("\t***MOTION")
-                        cv2.rectangle(image, (rx, ry), (rx + rw, ry + rh),
-                                  (0, 255, 0), 2)
+        self.stage_timer.lap('contour_loop')
+        return threshold_met_contours, blobs, (minX, minY, maxX, maxY)
 
-        if not motionThisFrame:
+    def _component_blobs(self, mask, image_area, min_radius):
+        """
+        Label the mask with connectedComponentsWithStats and filter all of the blobs at once with
+        numpy.  On a windy day the mask can have hundreds of small blobs, which is where the
+        contour loop spends its time.
+
+        The enclosing circle radius is estimated from the bounding box, half of its diagonal.  The
+        returned contours are the bounding boxes of the blobs as 4 point contours.
+
+        :return: same as _contour_blobs
+        """
+        # only label the part of the mask that has any foreground in it, most frames have little
+        (ox, oy, ow, oh) = cv2.boundingRect(mask)
+        if ow == 0 or oh == 0:
+            self.stage_timer.lap('components')
+            return [], [], (np.inf, np.inf, -np.inf, -np.inf)
+
+        labels = self._buffer('labels', mask.shape, np.int32)[oy:oy + oh, ox:ox + ow]
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(mask[oy:oy + oh, ox:ox + ow], labels, connectivity=8)
+        self.stage_timer.lap('components')
+
+        # label 0 is the background
+        stats = stats[1:]
+        centroids = centroids[1:] + (ox, oy)
+
+        x, y, w, h, area = stats[:, 0] + ox, stats[:, 1] + oy, stats[:, 2], stats[:, 3], stats[:, 4]
+        radius = np.hypot(w, h) / 2
+        radius_met = radius >= min_radius
+        area_met = (w * h) / image_area >= self.min_area_ratio
+        keep = radius_met | area_met
+
+        if self.blob_max_aspect_ratio > 0:
+            keep &= np.maximum(w, h) / np.maximum(1, np.minimum(w, h)) <= self.blob_max_aspect_ratio
+
+        if self.roi_min_inside_ratio > 0 and self.roi_mask is not None and keep.any():
+            # foreground pixels of each label that are inside the ROIs
+            inside = np.bincount(labels[self.roi_mask[oy:oy + oh, ox:ox + ow] > 0], minlength=count)[1:]
+            keep &= inside >= area * self.roi_min_inside_ratio
+
+        motion_rect = (int(x.min()), int(y.min()), int((x + w).max()), int((y + h).max()))
+
+        threshold_met_contours = []
+        blobs = []
+        for i in np.flatnonzero(keep):
+            (rx, ry, rw, rh) = (int(x[i]), int(y[i]), int(w[i]), int(h[i]))
+            threshold_met_contours.append(np.array([[[rx, ry]], [[rx + rw - 1, ry]], [[rx + rw - 1, ry + rh - 1]], [[rx, ry + rh - 1]]], dtype=np.int32))
+            blobs.append(((rx, ry, rw, rh), float(area[i]), (int(centroids[i][0]), int(centroids[i][1]), int(radius[i])), bool(radius_met[i]), bool(area_met[i])))
+
+        self.stage_timer.lap('blob_filter')
+        return threshold_met_contours, blobs, motion_rect
+
+    def apply(self, image):
+        """
+        Detect motion in image.  image itself is never drawn on.
+
+        The returned image and mask are work buffers that are reused by the next call to apply(),
+        copy them if they are needed for longer.
+
+        :return: motionThisFrame, framesWithoutMotion, contours, annotated image, mask, (minX, minY, maxX, maxY)
+        """
+
+        mask = None
+        timer = self.stage_timer
+
+        if image.shape != self.input_shape:
+            self._set_process_scale(image.shape)
+
+        gate = self.frame_gate
+        if gate is not None:
+            process = gate.should_process(image)
+            timer.lap('gate')
+            if not process:
+                self.framesWithoutMotion += 1
+                self.motion_rects = []
+                self.motion_areas = []
+                return False, self.framesWithoutMotion, [], image, self.last_mask, (np.inf, np.inf, -np.inf, -np.inf)
+            gate_start = time.perf_counter()
+
+        # detection runs on a downscaled copy when process_width is set, results are mapped
+        # back on to the full resolution frame
+        frame = image
+        input_frame = image
+        scale = self.process_scale
+        if scale != 1.0:
+            process_height = int(round(frame.shape[0] * scale))
+            image = cv2.resize(frame, (self.process_width, process_height), dst=self._buffer('resize', (process_height, self.process_width) + frame.shape[2:]),
+                               interpolation=cv2.INTER_AREA)
+            timer.lap('resize')
+        process_image = image
+
+        if self.roi_mode != 'mask' and self.roi_mask is not None:
+            mask, contours = self._apply_roi_regions(image)
+        else:
+            image = cv2.GaussianBlur(image, (3,3), 0, dst=self._buffer('blur', image.shape))
+            if scale == 1.0:
+                frame = image
+            timer.lap('blur')
+
+            mask = self._buffer('mask', image.shape[:2])
+            if self.roi_mask is not None:
+                # same result as image_util.mask_image_to_rectanges for rectangles, in one call with
+                # the precompiled mask.  Only the inside of the ROIs is ever written so the rest of
+                # the buffer stays black.
+                masked_image = cv2.copyTo(image, self.roi_mask, self._buffer('masked', image.shape))
+                timer.lap('roi_mask')
+                mask = self.subtractor.apply(masked_image, mask)
+            else:
+                mask = self.subtractor.apply(image, mask)
+            timer.lap('subtract')
+
+            mask = self._erode_dilate(mask)
+
+            contours = []
+            if self.blob_mode == 'contours':
+                # find contours in the mask and reset the motion status.  findContours no longer
+                # modifies its input so the mask does not need to be copied
+                contours = cv2.findContours(mask, cv2.RETR_EXTERNAL,
+                                        cv2.CHAIN_APPROX_SIMPLE)
+                contours = imutils.grab_contours(contours)
+                timer.lap('find_contours')
+
+        image_area = (image.shape[0] * image.shape[1])
+
+        # min_radius is configured in frame pixels
+        min_radius = self.min_radius * scale
+
+        lighting = self.lighting
+        if lighting is not None:
+            if lighting.update(process_image, mask):
+                self._lighting_changed()
+            timer.lap('lighting')
+
+        if lighting is not None and lighting.suppressing:
+            # the whole frame changed, not something moving through it
+            threshold_met_contours, blobs, motion_rect = [], [], (np.inf, np.inf, -np.inf, -np.inf)
+        elif self.blob_mode == 'components':
+            threshold_met_contours, blobs, motion_rect = self._component_blobs(mask, image_area, min_radius)
+        else:
+            threshold_met_contours, blobs, motion_rect = self._contour_blobs(contours, mask, image_area, min_radius)
+
+        motionThisFrame = len(blobs) > 0
+        if motionThisFrame:
+            self.framesWithoutMotion = 0
+        else:
             self.framesWithoutMotion += 1
 
+        if self.annotate_image and motionThisFrame:
+            if frame is input_frame:
+                # never draw on the caller's frame, copy it in to a reused buffer the first time
+                frame = self._buffer('annotated', frame.shape)
+                np.copyto(frame, input_frame)
+            for (rx, ry, rw, rh), _, (x, y, radius), radius_met, area_met in blobs:
+                if radius_met:
+                    cv2.circle(frame, (int(x / scale), int(y / scale)), int(radius / scale), (0, 0, 255), 4)
+                if area_met:
+                    cv2.rectangle(frame, (int(rx / scale), int(ry / scale)), (int((rx + rw) / scale), int((ry + rh) / scale)),
+                                  (0, 255, 0), 2)
+
+        # bounding boxes and areas of the motion, in frame coordinates, so callers do not have
+        # to compute them again from the contours
+        self.motion_rects = [(int(rx / scale), int(ry / scale), int(np.ceil(rw / scale)), int(np.ceil(rh / scale)))
+                             for (rx, ry, rw, rh), _, _, _, _ in blobs]
+        self.motion_areas = [area / (scale * scale) for _, area, _, _, _ in blobs]
+
+        (minX, minY, maxX, maxY) = motion_rect
+        if scale != 1.0:
+            # map the contours and motion rectangle back to frame coordinates.  The returned
+            # image is the full resolution frame, the mask stays at the processing resolution.
+            threshold_met_contours = [np.round(c / scale).astype(np.int32) for c in threshold_met_contours]
+            if minX != np.inf:
+                (minX, minY, maxX, maxY) = (int(minX / scale), int(minY / scale), int(np.ceil(maxX / scale)), int(np.ceil(maxY / scale)))
+
+        # the returned image is the full resolution frame with the annotations
+        image = frame
+        self.last_mask = mask
+        timer.lap('annotate')
+
+        if gate is not None:
+            gate.motion(motionThisFrame)
+            gate.processed_seconds += time.perf_counter() - gate_start
+
         return motionThisFrame, self.framesWithoutMotion, threshold_met_contours, image, mask, (minX, minY, maxX, maxY)
@@ -0,0 +1,294 @@
+from collections import deque
+from threading import Thread, Condition
+import time
+import cv2
+
+# when the ring is full, throw away the oldest decoded frame.  Use for live sources.
+DROP_OLDEST = 'drop_oldest'
+# when the ring is full, wait for the consumer.  Use for offline video files.
+BLOCK = 'block'
+
+CAPTURE_POLICIES = [DROP_OLDEST, BLOCK]
+
+
+def is_live_source(src):
+    """
+    :return: True for a camera index or a stream url, False for a video file
+    """
+    return isinstance(src, int) or (isinstance(src, str) and (src.isdigit() or "://" in src))
+
+
+class BufferedVideoStream:
+    """
+        Decode frames from a cv2.VideoCapture source in a background thread in to a ring of
+        preallocated frame buffers, so decoding overlaps with the detection loop.
+
+        Similar to imutils FileVideoStream, but frames are decoded in to reused buffers instead of
+        allocating a new frame per read, and the stream keeps track of which side was the bottleneck.
+
+        The frame returned from read() is only valid until the next call to read() or stop(), after
+        that the buffer is handed back to the decode thread.  position_msec and frame_index are the
+        position of that frame in the source.
+
+        For replaying recorded clips, frame_step, start_msec and end_msec limit the frames handed to
+        read().  Skipped frames are only grabbed, not retrieved, which saves the colour conversion and copy.
+
+        A failed read of a video file is the end of the stream.  A camera or stream url can fail a
+        read now and then, so a live source is retried.  The first failed read is retried on the
+        same capture, from the second failed read in a row on the source is reopened, and after
+        read_retries failed reads in a row the stream ends.  The failures are counted in stats().
+    """
+
+    def __init__(self, src, queue_size: int = 4, policy: str = BLOCK, frame_step: int = 1, start_msec: float = 0, end_msec: float = None,
+                 read_retries: int = 5, retry_delay: float = 0.5):
+        """
+
+        :param src: anything cv2.VideoCapture accepts, file path or camera index
+        :param queue_size: number of preallocated frame buffers in the ring
+        :param policy: what the decode thread does when the ring is full, one of CAPTURE_POLICIES
+        :param frame_step: only hand every frame_step-th frame to read()
+        :param start_msec: skip the frames before this position.  The frames are grabbed up to it,
+                CAP_PROP_POS_MSEC seeks to a key frame and can land seconds away.
+        :param end_msec: end the stream after this position, None for the whole source
+        :param read_retries: failed reads in a row of a live source before the stream ends
+        :param retry_delay: seconds to wait after a failed read of a live source, multiplied by the
+                number of failed reads in a row
+        """
+        if policy not in CAPTURE_POLICIES:
+            raise ValueError(f"Invalid capture policy: {policy}.  Only {CAPTURE_POLICIES} allowed.")
+        if queue_size < 2:
+            raise ValueError("queue_size must be at least 2")
+
+        self.src = src
+        self.queue_size = queue_size
+        self.policy = policy
+        self.frame_step = max(1, frame_step)
+        self.start_msec = start_msec or 0
+        self.end_msec = end_msec
+        self.live = is_live_source(src)
+        self.read_retries = read_retries
+        self.retry_delay = retry_delay
+
+        self.stream = None
+        self.thread = None
+        self.stopped = False
+        self.eof = False
+        self.past_end = False
+
+        self.buffers = [None] * queue_size
+        # source position and frame number of the frame in each slot
+        self.positions = [(0.0, 0)] * queue_size
+        self.position_msec = None
+        self.frame_index = None
+        self.source_frames = 0
+        # first source frame in range, frame_step counts from it
+        self.first_index = None
+        self.free_slots = deque(range(queue_size))
+        self.filled_slots = deque()
+        self.held_slot = None
+        self.condition = Condition()
+
+        self.frames_decoded = 0
+        self.frames_read = 0
+        self.frames_dropped = 0
+        # frames left out by frame_step, start_msec and end_msec
+        self.frames_skipped = 0
+        # reads that had to wait for the decode thread, i.e. decode was the bottleneck
+        self.decode_bound_reads = 0
+        self.decode_wait_time = 0.0
+        # decodes that had to wait for a free buffer, i.e. detection was the bottleneck
+        self.detect_bound_decodes = 0
+        self.detect_wait_time = 0.0
+        # failed reads of a live source, and how many times it was reopened
+        self.read_errors = 0
+        self.consecutive_read_errors = 0
+        self.reopens = 0
+        # the stream ended because a live source kept failing, not because it was stopped
+        self.gave_up = False
+
+    def start(self):
+        self.stream = cv2.VideoCapture(self.src)
+
+        self.thread = Thread(target=self._update, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _acquire_free_slot(self):
+        with self.condition:
+            if not self.free_slots and not self.stopped:
+                if self.policy == DROP_OLDEST and self.filled_slots:
+                    self.free_slots.append(self.filled_slots.popleft())
+                    self.frames_dropped += 1
+                else:
+                    self.detect_bound_decodes += 1
+                    start = time.perf_counter()
+                    while not self.free_slots and not self.stopped:
+                        self.condition.wait()
+                    self.detect_wait_time += time.perf_counter() - start
+
+            if self.stopped:
+                return None
+            return self.free_slots.popleft()
+
+    def _grab(self):
+        """
+        Grab frames until one that should be handed to read()
+
+        :return: (position msec, frame index) of the grabbed frame, or None at the end of the stream
+        """
+        while True:
+            if not self.stream.grab():
+                return None
+            frame_index = self.source_frames
+            self.source_frames += 1
+            position_msec = self.stream.get(cv2.CAP_PROP_POS_MSEC)
+
+            if self.end_msec is not None and position_msec > self.end_msec:
+                self.past_end = True
+                return None
+            if position_msec < self.start_msec:
+                self.frames_skipped += 1
+                continue
+            if self.frame_step > 1:
+                # count from the first frame in range
+                if self.first_index is None:
+                    self.first_index = frame_index
+                if (frame_index - self.first_index) % self.frame_step != 0:
+                    self.frames_skipped += 1
+                    continue
+            return position_msec, frame_index
+
+    def _update(self):
+        while True:
+            slot = self._acquire_free_slot()
+            if slot is None:
+                return
+
+            # retrieve in to the preallocated buffer.  The first retrieve for each slot allocates it,
+            # and OpenCV hands back a new array if the source ever changes resolution.
+            position = self._grab()
+            grabbed, frame = False, None
+            if position is not None:
+                grabbed, frame = self.stream.retrieve(self.buffers[slot])
+
+            failed = position is None or not grabbed or frame is None
+            if failed and self.live and not self.past_end and self._recover():
+                with self.condition:
+                    self.free_slots.append(slot)
+                    self.condition.notify_all()
+                continue
+            if not failed:
+                self.consecutive_read_errors = 0
+
+            with self.condition:
+                if failed:
+                    self.free_slots.append(slot)
+                    self.eof = True
+                    self.condition.notify_all()
+                    return
+
+                self.buffers[slot] = frame
+                self.positions[slot] = position
+                self.filled_slots.append(slot)
+                self.frames_decoded += 1
+                self.condition.notify_all()
+
+    def _recover(self):
+        """
+        Wait after a failed read of a live source, and reopen it if the read before failed as well
+
+        :return: False to give up and end the stream
+        """
+        self.read_errors += 1
+        self.consecutive_read_errors += 1
+        if self.consecutive_read_errors > self.read_retries:
+            self.gave_up = True
+            return False
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.stopped, timeout=self.retry_delay * self.consecutive_read_errors)
+            if self.stopped:
+                return False
+
+        if self.consecutive_read_errors > 1:
+            # one failed read is usually a dropped packet, two in a row and the connection is likely gone
+            self.stream.release()
+            self.stream = cv2.VideoCapture(self.src)
+            self.reopens += 1
+        return True
+
+    def read(self, latest: bool = False):
+        """
+        :param latest: skip over any older decoded frames and return the newest one.  The
+                skipped frames are counted as dropped.  Used by live sources when detection
+                falls behind the camera.
+        :return: the next decoded frame, or None when the source is exhausted or the stream was stopped
+        """
+        with self.condition:
+            if self.held_slot is not None:
+                self.free_slots.append(self.held_slot)
+                self.held_slot = None
+                self.condition.notify_all()
+
+            if latest:
+                while len(self.filled_slots) > 1:
+                    self.free_slots.append(self.filled_slots.popleft())
+                    self.frames_dropped += 1
+                self.condition.notify_all()
+
+            if not self.filled_slots and not self.eof and not self.stopped:
+                self.decode_bound_reads += 1
+                start = time.perf_counter()
+                while not self.filled_slots and not self.eof and not self.stopped:
+                    self.condition.wait()
+                self.decode_wait_time += time.perf_counter() - start
+
+            if not self.filled_slots:
+                return None
+
+            self.held_slot = self.filled_slots.popleft()
+            self.position_msec, self.frame_index = self.positions[self.held_slot]
+            self.frames_read += 1
+            return self.buffers[self.held_slot]
+
+    def more(self):
+        with self.condition:
+            return len(self.filled_slots) > 0 or not (self.eof or self.stopped)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+        if self.thread is not None:
+            self.thread.join()
+
+        if self.stream is not None:
+            self.stream.release()
+
+    def stats(self):
+        return {
+            "frames_decoded": self.frames_decoded,
+            "frames_read": self.frames_read,
+            "frames_dropped": self.frames_dropped,
+            "frames_skipped": self.frames_skipped,
+            "decode_bound_reads": self.decode_bound_reads,
+            "decode_wait_time": self.decode_wait_time,
+            "detect_bound_decodes": self.detect_bound_decodes,
+            "detect_wait_time": self.detect_wait_time,
+            "read_errors": self.read_errors,
+            "reopens": self.reopens,
+            "gave_up": self.gave_up,
+        }
+
+    def stats_summary(self):
+        read = max(self.frames_read, 1)
+        decoded = max(self.frames_decoded, 1)
+        skipped = f", skipped {self.frames_skipped}" if self.frames_skipped > 0 else ""
+        errors = f", {self.read_errors} read errors, reopened {self.reopens} times" if self.read_errors > 0 else ""
+        if self.gave_up:
+            errors += f", gave up after {self.read_retries} failed reads in a row"
+        return (f"Capture: decoded {self.frames_decoded}, read {self.frames_read}, dropped {self.frames_dropped}{skipped}{errors}.  "
+                f"Decode bottleneck on {(self.decode_bound_reads / read) * 100:.1f}% of reads ({self.decode_wait_time:.2f}s waiting), "
+                f"detection bottleneck on {(self.detect_bound_decodes / decoded) * 100:.1f}% of decodes ({self.detect_wait_time:.2f}s waiting)")
@@ -1,32 +1,120 @@
 from utils.BackgroundFileProcessor import BackgroundFileProcessor
+from utils.SnapshotEncoderUtil import THUMBNAIL_PATTERN, thumbnail_path
 from pathlib import Path
+from threading import Lock
+import os
+import time
 import dropbox
-from dropbox.exceptions import ApiError
+import requests
+from dropbox.exceptions import ApiError, InternalServerError, RateLimitError
+from dropbox.files import CommitInfo, UploadSessionCursor, WriteMode
+
+# errors worth retrying, anything else (bad token, no space, ...) fails right away
+TRANSIENT_ERRORS = (InternalServerError, RateLimitError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
 
 class DropboxFileWatcherUpload(BackgroundFileProcessor):
     def _upload_file(self, file_from, file_to):
-        dbx = dropbox.Dropbox(self.dropbox_access_token)
+        file_size = os.path.getsize(file_from)
 
         with open(file_from, 'rb') as f:
-            dbx.files_upload(f.read(), file_to)
-
-    def __init__(self, dropbox_access_token: str,  root_dir: str, include_parent_dir_in_to_file=True, pattern:str="*", delete_after_process: bool=False, batch_size: int=10, polling_time: int=5 ):
-        super().__init__(root_dir, pattern, delete_after_process, batch_size, polling_time)
+            if file_size <= self.upload_session_threshold:
+                self.dbx.files_upload(f.read(), file_to, mode=WriteMode.overwrite)
+            else:
+                # large files go up in chunks through an upload session so the whole file
+                # is never held in memory
+                session = self.dbx.files_upload_session_start(f.read(self.upload_chunk_size))
+                cursor = UploadSessionCursor(session_id=session.session_id, offset=f.tell())
+                commit = CommitInfo(path=file_to, mode=WriteMode.overwrite)
+                while file_size - f.tell() > self.upload_chunk_size:
+                    self.dbx.files_upload_session_append_v2(f.read(self.upload_chunk_size), cursor)
+                    cursor.offset = f.tell()
+                self.dbx.files_upload_session_finish(f.read(self.upload_chunk_size), cursor, commit)
+
+        return file_size
+
+    def _upload_file_with_retry(self, file_from, file_to):
+        attempt = 0
+        while True:
+            try:
+                return self._upload_file(file_from, file_to)
+            except TRANSIENT_ERRORS as err:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+
+                # exponential backoff, unless Dropbox told us how long to back off for
+                backoff = self.retry_backoff * (2 ** (attempt - 1))
+                if isinstance(err, RateLimitError) and err.backoff is not None:
+                    backoff = max(backoff, err.backoff)
+                with self.stats_lock:
+                    self.retries += 1
+                print(f"Upload of {file_from} failed ({err}), retry {attempt} of {self.max_retries} in {backoff:.1f}s")
+                time.sleep(backoff)
+
+    def __init__(self, dropbox_access_token: str,  root_dir: str, include_parent_dir_in_to_file=True, pattern:str="*", delete_after_process: bool=False, batch_size: int=10, polling_time: int=5, watcher: str='auto',
+                 workers: int=1, journal_path: str=None, max_retries: int=3, retry_backoff: float=1.0, upload_session_threshold: int=8*1024*1024, upload_chunk_size: int=4*1024*1024 ):
+        """
+
+        :param include_parent_dir_in_to_file: upload to the file's path under root_dir, instead of just its name
+        :param workers: number of concurrent upload threads.  They all share one Dropbox client.
+        :param max_retries: number of times an upload is retried after a transient error
+        :param retry_backoff: seconds to wait before the first retry, doubled for each retry after that
+        :param upload_session_threshold: files larger than this many bytes are uploaded with an upload session
+        :param upload_chunk_size: bytes per upload session request
+        """
+        # a thumbnail goes up with its snapshot instead of as a file of its own
+        super().__init__(root_dir, pattern, delete_after_process, batch_size, polling_time, watcher, workers, journal_path,
+                         exclude=THUMBNAIL_PATTERN)
 
         self.include_parent_dir_in_to_file = include_parent_dir_in_to_file
         self.dropbox_access_token = dropbox_access_token
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.upload_session_threshold = upload_session_threshold
+        self.upload_chunk_size = upload_chunk_size
+
+        # one client and one pooled http session for all of the upload threads.  Retries are
+        # handled by _upload_file_with_retry so turn off the client's own retries.
+        self.dbx = dropbox.Dropbox(self.dropbox_access_token, session=dropbox.create_session(max_connections=max(1, workers)),
+                                   max_retries_on_error=0, max_retries_on_rate_limit=0)
+
+        self.stats_lock = Lock()
+        self.files_uploaded = 0
+        self.bytes_uploaded = 0
+        self.failures = 0
+        self.retries = 0
+        self.start_time = time.time()
 
     def process_file(self, absolute_file_path):
+        """
+        Errors are logged and raised again so the file is not deleted and gets retried
+        """
         print(absolute_file_path)
         p = Path(absolute_file_path)
         if self.include_parent_dir_in_to_file:
-            to_path = f"/{p.parent.name}/{p.name}"
+            # the whole path under root_dir, so the per camera sub directories of the supervisor are kept
+            relative = Path(os.path.relpath(os.path.abspath(absolute_file_path), os.path.abspath(self.root_dir)))
+            if relative.parts[0] == os.pardir:
+                relative = Path(p.parent.name) / p.name
+            to_path = f"/{relative.as_posix()}"
         else:
             to_path = p.name
 
+        uploads = [(absolute_file_path, to_path)]
+        thumbnail = thumbnail_path(absolute_file_path)
+        if thumbnail.exists():
+            uploads.append((thumbnail, str(Path(to_path).with_name(thumbnail.name).as_posix())))
+
         try:
-            self._upload_file(absolute_file_path, to_path)
+            for file_from, file_to in uploads:
+                file_size = self._upload_file_with_retry(file_from, file_to)
+                with self.stats_lock:
+                    self.files_uploaded += 1
+                    self.bytes_uploaded += file_size
         except ApiError as err:
+            with self.stats_lock:
+                self.failures += 1
             # Check user has enough Dropbox space quota
             if (err.error.is_path() and
                     err.error.get_path().error.is_insufficient_space()):
@@ -36,6 +124,38 @@ class DropboxFileWatcherUpload(BackgroundFileProcessor):
 
             else:
                 print(err)
+            raise
+        except TRANSIENT_ERRORS as err:
+            with self.stats_lock:
+                self.failures += 1
+            print(f"ERROR: Upload failed for {absolute_file_path}: {err}")
+            raise
+
+    def _delete(self, file_path):
+        super()._delete(file_path)
+        thumbnail = thumbnail_path(file_path)
+        if thumbnail.exists():
+            thumbnail.unlink()
+
+    def stats(self):
+        elapsed = time.time() - self.start_time
+        with self.stats_lock:
+            return {
+                "files_uploaded": self.files_uploaded,
+                "bytes_uploaded": self.bytes_uploaded,
+                "failures": self.failures,
+                "retries": self.retries,
+                "files_per_sec": self.files_uploaded / elapsed if elapsed > 0 else 0.0,
+                "bytes_per_sec": self.bytes_uploaded / elapsed if elapsed > 0 else 0.0,
+                "backlog": self.backlog(),
+                "workers": self.workers,
+            }
+
+    def stats_summary(self):
+        s = self.stats()
+        return (f"Dropbox: uploaded {s['files_uploaded']} files, {s['bytes_uploaded'] / (1024 * 1024):.1f} MB, "
+                f"{s['files_per_sec']:.2f} files/s, {s['bytes_per_sec'] / 1024:.1f} KB/s, "
+                f"{s['failures']} failed, {s['retries']} retries, backlog {s['backlog']}, {s['workers']} workers")
 
 
 
@@ -56,3 +176,4 @@ if __name__ == '__main__':
 
     db.drain()
 
+    print(db.stats_summary())
@@ -0,0 +1,293 @@
+from collections import deque
+from pathlib import Path
+from threading import Thread
+import queue
+import cv2
+from utils.FrameBufferPoolUtil import FrameBufferPool
+
+# queued after the last frame of a video file so the next file starts with an empty pre-roll
+_FLUSH = "flush"
+
+# frame times the clip frame rate is measured over
+FPS_WINDOW = 30
+
+
+class PreRollBuffer:
+    """
+        The last max_seconds of frames, JPEG compressed, and never more than max_bytes of them.
+        A 1080p frame is about 6MB raw and 200-400KB as a JPEG, so a few seconds of pre-roll
+        fits in tens of MB instead of hundreds.  With width the frames are downscaled before they
+        are encoded, which makes the encoding cheaper as well, and scaled back up for the clip.
+    """
+
+    def __init__(self, max_seconds: float, max_bytes: int, jpeg_quality: int = 80, width: int = 0):
+        self.max_seconds = max(0, max_seconds)
+        self.max_bytes = max_bytes
+        self.width = width
+        self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+        # (seconds, encoded) oldest first
+        self.frames = deque()
+        self.bytes = 0
+
+    def append(self, frame, seconds):
+        """
+        :param seconds: time of the frame, see EventClipRecorder.add_frame
+        """
+        if self.max_seconds == 0:
+            return
+        h, w = frame.shape[:2]
+        if 0 < self.width < w:
+            frame = cv2.resize(frame, (self.width, max(1, int(round(h * self.width / w)))), interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode('.jpg', frame, self.encode_params)
+        if not ok:
+            return
+        self.frames.append((seconds, encoded))
+        self.bytes += encoded.nbytes
+
+        while self.frames and (seconds - self.frames[0][0] > self.max_seconds or self.bytes > self.max_bytes):
+            self.bytes -= self.frames.popleft()[1].nbytes
+
+    def drain(self, size):
+        """
+        Decode and remove the buffered frames, oldest first
+
+        :param size: (width, height) of the clip
+        :return: generator of (seconds, frame)
+        """
+        while self.frames:
+            seconds, encoded = self.frames.popleft()
+            self.bytes -= encoded.nbytes
+            frame = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+            if frame.shape[1::-1] != tuple(size):
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_LINEAR)
+            yield seconds, frame
+
+    def clear(self):
+        self.frames.clear()
+        self.bytes = 0
+
+
+class EventClipRecorder:
+    """
+        Record a video clip of each motion event, starting pre_roll_seconds before the first
+        motion frame, with cv2.VideoWriter.
+
+        The detection loop only hands frames over with add_frame(), which never blocks; if the
+        recorder falls behind frames are dropped and counted.  All of the JPEG encoding for the
+        pre-roll and the video encoding happen in the recorder thread.  Memory is bounded by
+        queue_size raw frames plus max_pre_roll_mb of JPEGs.
+
+        Frames are written to the clip by their time, so a clip plays back at the speed it was
+        recorded at even when frames arrive irregularly, from a governed or lagging camera, or
+        only every pre_roll_step-th frame is kept while nothing is happening.  Frames are repeated
+        to fill gaps and left out when they arrive faster than the clip frame rate.  The clip frame
+        rate is fps when it is set, otherwise the rate frames were arriving at when the clip opened.
+    """
+
+    def __init__(self, output_dir: str, fps: float = 0, pre_roll_seconds: float = 3, max_pre_roll_mb: float = 64,
+                 end_frames: int = 15, max_clip_seconds: float = 300, jpeg_quality: int = 80, codec: str = "mp4v",
+                 queue_size: int = 30, frame_pool: FrameBufferPool = None, pre_roll_width: int = 0, pre_roll_step: int = 1,
+                 fallback_fps: float = 10, flush_timeout: float = 5):
+        """
+
+        :param output_dir: detected_motion_dir, clips go in to day sub directories of it
+        :param fps: frame rate of the clips, 0 to use the measured rate frames arrive at
+        :param pre_roll_seconds: seconds of frames before the first motion frame to include
+        :param max_pre_roll_mb: upper limit on the memory used by the pre-roll
+        :param end_frames: consecutive frames without motion that end a clip
+        :param max_clip_seconds: a longer clip is closed and the next motion frame starts a new one
+        :param codec: cv2.VideoWriter fourcc
+        :param queue_size: raw frames waiting for the recorder thread before frames are dropped
+        :param frame_pool: pool the queued frames are copied in to
+        :param pre_roll_width: downscale the pre-roll frames to this width, 0 keeps the full width
+        :param pre_roll_step: while there is no motion and no clip, only every pre_roll_step-th frame
+                is copied and encoded in to the pre-roll
+        :param fallback_fps: clip frame rate when fps is 0 and the rate could not be measured yet
+        :param flush_timeout: seconds flush() waits for room in a full queue
+        """
+        self.output_dir = output_dir
+        self.fps = fps
+        self.fallback_fps = fallback_fps
+        self.end_frames = max(1, end_frames)
+        self.max_clip_seconds = max_clip_seconds
+        self.codec = codec
+        self.pre_roll_step = max(1, pre_roll_step)
+        self.pre_roll = PreRollBuffer(pre_roll_seconds, int(max_pre_roll_mb * 1024 * 1024), jpeg_quality, pre_roll_width)
+        self.Q = queue.Queue(maxsize=queue_size)
+        self.flush_timeout = flush_timeout
+        self.frame_pool = frame_pool if frame_pool is not None else FrameBufferPool()
+        self.thread = None
+
+        # set by the detection loop
+        self.position_source = None
+        self.frame_times = deque(maxlen=FPS_WINDOW)
+        self.measured_fps = 0.0
+        self.idle_frames = 0
+
+        # used by the recorder thread
+        self.writer = None
+        self.clip_fqn = None
+        self.clip_fps = None
+        self.clip_start = None
+        self.frames_in_clip = 0
+
+        self.clips_written = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.frames_sampled_out = 0
+        self.flushes_dropped = 0
+
+    def start(self):
+        self.thread = Thread(target=self._run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def set_position_source(self, cap):
+        """
+        Time the frames by their position in a video file instead of by their timestamps, which
+        are the processing time unless the file is replayed.  Reset by flush().
+
+        :param cap: BufferedVideoStream or CachedVideoStream the frames are read from
+        """
+        self.position_source = cap
+
+    def add_frame(self, timestamp, frame, motionThisFrame, framesWithoutMotion):
+        """
+        Hand a copy of a frame to the recorder thread.  Nothing is copied when the frame is dropped,
+        or left out of the pre-roll by pre_roll_step.
+
+        :return: False if the frame was dropped because the recorder is behind
+        """
+        if self.position_source is not None:
+            seconds = self.position_source.position_msec / 1000
+        else:
+            seconds = timestamp.timestamp()
+        self.frame_times.append(seconds)
+        if len(self.frame_times) > 1 and self.frame_times[-1] > self.frame_times[0]:
+            self.measured_fps = (len(self.frame_times) - 1) / (self.frame_times[-1] - self.frame_times[0])
+
+        # past end_frames without motion any clip has been closed, the frame can only go in to the pre-roll
+        if not motionThisFrame and framesWithoutMotion > self.end_frames:
+            self.idle_frames += 1
+            if self.idle_frames % self.pre_roll_step != 0:
+                self.frames_sampled_out += 1
+                return True
+        else:
+            self.idle_frames = 0
+
+        # only the detection loop adds frames, so the queue can not fill up between the check and the put
+        if self.Q.full():
+            self.frames_dropped += 1
+            return False
+        self.Q.put_nowait((timestamp, seconds, self.frame_pool.copy(frame), motionThisFrame, framesWithoutMotion))
+        return True
+
+    def flush(self):
+        """
+        Close any open clip and empty the pre-roll, for example at the end of a video file.  Waits
+        up to flush_timeout seconds for room in the queue, if there is none the flush is counted as
+        dropped and the next file carries on the clip.
+        """
+        self.position_source = None
+        self.frame_times.clear()
+        self.idle_frames = 0
+        try:
+            self.Q.put(_FLUSH, timeout=self.flush_timeout)
+        except queue.Full:
+            self.flushes_dropped += 1
+
+    def stop(self):
+        if self.thread is not None:
+            self.Q.put(None)
+            self.thread.join()
+            self.thread = None
+        print(self.stats_summary())
+
+    def _open_clip(self, timestamp, frame):
+        day_outputdir = Path(self.output_dir) / timestamp.strftime("%Y%m%d")
+        day_outputdir.mkdir(parents=True, exist_ok=True)
+        self.clip_fqn = day_outputdir / f"{timestamp.strftime('%Y%m%d-%H%M%S.%f')[:-3]}-clip.mp4"
+
+        h, w = frame.shape[:2]
+        self.clip_fps = self.fps or self.measured_fps or self.fallback_fps
+        self.writer = cv2.VideoWriter(str(self.clip_fqn), cv2.VideoWriter_fourcc(*self.codec), self.clip_fps, (w, h))
+        self.frames_in_clip = 0
+        self.clip_start = None
+        for seconds, pre_roll_frame in self.pre_roll.drain((w, h)):
+            self._write(pre_roll_frame, seconds)
+
+    def _write(self, frame, seconds):
+        if self.clip_start is None:
+            self.clip_start = seconds
+        # frames the clip should have by the time of this one
+        copies = int(round((seconds - self.clip_start) * self.clip_fps)) + 1 - self.frames_in_clip
+        if self.frames_in_clip == 0:
+            copies = 1
+        # a long gap, like a stalled camera, is cut short instead of filled with a frozen frame
+        max_copies = max(1, int(self.clip_fps))
+        if copies > max_copies:
+            self.clip_start += (copies - max_copies) / self.clip_fps
+            copies = max_copies
+        for _ in range(copies):
+            self.writer.write(frame)
+            self.frames_in_clip += 1
+            self.frames_written += 1
+
+    def _close_clip(self):
+        if self.writer is None:
+            return
+        self.writer.release()
+        self.writer = None
+        self.clips_written += 1
+        print(f"Wrote clip {self.clip_fqn}, {self.frames_in_clip} frames at {self.clip_fps:.1f} fps")
+
+    def _run(self):
+        while True:
+            item = self.Q.get()
+            if item is None:
+                self._close_clip()
+                return
+            if item is _FLUSH:
+                self._close_clip()
+                self.pre_roll.clear()
+                continue
+
+            timestamp, seconds, frame, motionThisFrame, framesWithoutMotion = item
+            if self.writer is None:
+                if motionThisFrame:
+                    self._open_clip(timestamp, frame)
+                    self._write(frame, seconds)
+                else:
+                    self.pre_roll.append(frame, seconds)
+            else:
+                self._write(frame, seconds)
+                if framesWithoutMotion >= self.end_frames or seconds - self.clip_start >= self.max_clip_seconds:
+                    self._close_clip()
+            self.frame_pool.release(frame)
+
+    def stats_summary(self):
+        flushes = f", {self.flushes_dropped} flushes dropped" if self.flushes_dropped > 0 else ""
+        return (f"Clips: wrote {self.clips_written} clips, {self.frames_written} frames, "
+                f"dropped {self.frames_dropped} frames, {self.frames_sampled_out} idle frames left out of the pre-roll{flushes}, "
+                f"pre-roll {self.pre_roll.bytes / (1024 * 1024):.1f} MB")
+
+
+def create_clip_recorder(conf, frame_pool=None):
+    """
+    :return: a started EventClipRecorder when conf['record_clips'] is set, otherwise None
+    """
+    if not conf['record_clips']:
+        return None
+
+    return EventClipRecorder(conf['detected_motion_dir'], fps=conf['clip_fps'] or 0,
+                             pre_roll_seconds=conf['clip_pre_roll_seconds'] if conf['clip_pre_roll_seconds'] is not None else 3,
+                             max_pre_roll_mb=conf['clip_max_pre_roll_mb'] or 64,
+                             end_frames=conf['event_end_frames'] or 15,
+                             max_clip_seconds=conf['clip_max_seconds'] or 300,
+                             codec=conf['clip_codec'] or "mp4v",
+                             queue_size=conf['clip_queue_size'] or 30,
+                             frame_pool=frame_pool,
+                             pre_roll_width=conf['clip_pre_roll_width'] or 0,
+                             pre_roll_step=conf['clip_pre_roll_step'] or 1,
+                             fallback_fps=conf['target_fps'] or 10).start()
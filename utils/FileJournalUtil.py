@@ -0,0 +1,98 @@
+from threading import Lock
+import sqlite3
+import time
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class FileJournal:
+    """
+        Small SQLite journal of the files a BackgroundFileProcessor has seen and what state they are in,
+        so a restart does not upload or recognize the same file twice.
+
+            pending   - queued, not started
+            in_flight - process_file was running.  Left in this state means the process died part way
+                        through, it is retried on the next start.
+            done      - process_file finished
+            failed    - process_file raised, attempts says how many times
+    """
+
+    def __init__(self, journal_path: str = ":memory:"):
+        self.journal_path = journal_path
+        self.lock = Lock()
+        self.db = sqlite3.connect(journal_path, check_same_thread=False)
+        # WAL keeps the writes sequential which is kinder to an SD card
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                            path TEXT PRIMARY KEY,
+                            state TEXT NOT NULL,
+                            attempts INTEGER NOT NULL DEFAULT 0,
+                            updated REAL NOT NULL,
+                            error TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_state ON files(state)")
+        self.db.commit()
+
+    def get(self, path):
+        """
+        :return: (state, attempts) or None if the file is not in the journal
+        """
+        with self.lock:
+            return self.db.execute("SELECT state, attempts FROM files WHERE path = ?", (path,)).fetchone()
+
+    def _set_state(self, path, state, error=None, add_attempt=False):
+        with self.lock:
+            self.db.execute("""INSERT INTO files(path, state, attempts, updated, error) VALUES (?, ?, ?, ?, ?)
+                               ON CONFLICT(path) DO UPDATE SET state = excluded.state, updated = excluded.updated,
+                               error = excluded.error, attempts = files.attempts + ?""",
+                            (path, state, 1 if add_attempt else 0, time.time(), error, 1 if add_attempt else 0))
+            self.db.commit()
+            return self.db.execute("SELECT attempts FROM files WHERE path = ?", (path,)).fetchone()[0]
+
+    def mark_pending(self, path):
+        self._set_state(path, PENDING)
+
+    def mark_in_flight(self, path):
+        self._set_state(path, IN_FLIGHT)
+
+    def mark_done(self, path):
+        self._set_state(path, DONE)
+
+    def mark_failed(self, path, error: str = None):
+        """
+        :return: the number of failed attempts so far
+        """
+        return self._set_state(path, FAILED, error=error, add_attempt=True)
+
+    def remove(self, path):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+            self.db.commit()
+
+    def retryable(self, max_attempts: int):
+        """
+        :return: paths that were pending, interrupted while in flight, or failed fewer than max_attempts times
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT path FROM files WHERE state IN (?, ?) OR (state = ? AND attempts < ?)",
+                                   (PENDING, IN_FLIGHT, FAILED, max_attempts)).fetchall()
+        return [row[0] for row in rows]
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM files GROUP BY state").fetchall())
+
+    def prune(self, older_than_seconds: float):
+        """
+        Forget done files that have not been touched in older_than_seconds
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE state = ? AND updated < ?", (DONE, time.time() - older_than_seconds))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,250 @@
+from threading import Thread, Event
+from fnmatch import fnmatch
+import ctypes
+import ctypes.util
+import os
+import platform
+import select
+import struct
+
+"""
+File watcher backends for the BackgroundFileProcessor.
+
+Each watcher calls on_file(absolute_path) for every file under root_dir whose name matches pattern,
+once for the files already there when it starts and then for new files as they show up.  The same
+file may be reported more than once, the BackgroundFileProcessor ignores files it has already queued.
+
+    inotify - Linux inotify events, no polling and no re-walking of the directory tree
+    poll    - walks the tree every polling_time seconds but only lists directories whose mtime changed
+    notify  - only the startup scan.  New files are expected to be handed to BackgroundFileProcessor.notify()
+              directly, for example from BackgroundImageWriter after each imwrite
+    auto    - inotify when available, otherwise poll
+"""
+
+FILE_WATCHERS = ['auto', 'inotify', 'poll', 'notify']
+
+# inotify event masks from <sys/inotify.h>
+IN_MOVED_TO = 0x00000080
+IN_CLOSE_WRITE = 0x00000008
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_libc_inotify():
+    if platform.system() != 'Linux':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def inotify_available():
+    return _load_libc_inotify() is not None
+
+
+def scan_tree(root_dir, pattern, on_file, dir_index=None):
+    """
+    Walk root_dir and report every matching file.
+
+    :param dir_index: optional dict of directory path -> (mtime, sub directories) that is kept up
+            to date by the scan.  Directories whose mtime has not changed since the previous scan are
+            not listed again, only their sub directories are checked.  Directories that no longer
+            exist are removed from it.
+    """
+    visited = set()
+    stack = [root_dir]
+    while stack:
+        dir_path = stack.pop()
+        try:
+            mtime = os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        visited.add(dir_path)
+
+        if dir_index is not None and dir_path in dir_index and dir_index[dir_path][0] == mtime:
+            # unchanged directory, its files were already reported
+            stack.extend(dir_index[dir_path][1])
+            continue
+
+        subdirs = []
+        try:
+            for entry in os.scandir(dir_path):
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif fnmatch(entry.name, pattern):
+                    on_file(os.path.abspath(entry.path))
+        except FileNotFoundError:
+            continue
+
+        if dir_index is not None:
+            dir_index[dir_path] = (mtime, subdirs)
+        stack.extend(subdirs)
+
+    if dir_index is not None:
+        for dir_path in [d for d in dir_index if d not in visited]:
+            del dir_index[dir_path]
+
+
+class FileWatcher:
+    """
+        Base watcher, does the startup scan and nothing else.  This is the 'notify' backend.
+    """
+
+    def __init__(self, root_dir: str, pattern: str, on_file, polling_time: float = 5):
+        self.root_dir = os.path.abspath(root_dir)
+        self.pattern = pattern
+        self.on_file = on_file
+        self.polling_time = polling_time
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        os.makedirs(self.root_dir, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        """
+        Report everything under root_dir, used at startup and by drain() to catch anything missed.
+        """
+        scan_tree(self.root_dir, self.pattern, self.on_file)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class PollingWatcher(FileWatcher):
+    """
+        Walk the tree every polling_time seconds, only listing the directories whose mtime changed.
+        Adding or removing a file changes the mtime of its directory, so with thousands of day
+        directories only the current day directory is listed each cycle.
+    """
+
+    def __init__(self, root_dir: str, pattern: str, on_file, polling_time: float = 5):
+        super().__init__(root_dir, pattern, on_file, polling_time)
+        self.dir_index = {}
+
+    def start(self):
+        os.makedirs(self.root_dir, exist_ok=True)
+        scan_tree(self.root_dir, self.pattern, self.on_file, self.dir_index)
+
+        self.thread = Thread(target=self._run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.polling_time):
+            scan_tree(self.root_dir, self.pattern, self.on_file, self.dir_index)
+
+
+class InotifyWatcher(FileWatcher):
+    """
+        Linux inotify backend.  Every directory under root_dir is watched, and new sub directories
+        (like the day directories) are added as they are created.  Files are reported when they are
+        closed after writing or moved in to a watched directory.
+    """
+
+    FILE_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+    def __init__(self, root_dir: str, pattern: str, on_file, polling_time: float = 5):
+        super().__init__(root_dir, pattern, on_file, polling_time)
+        self.libc = _load_libc_inotify()
+        if self.libc is None:
+            raise OSError("inotify is not available on this platform")
+        self.fd = None
+        self.watch_dirs = {}
+
+    def _add_watch(self, dir_path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), self.FILE_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            print(f"inotify_add_watch failed for {dir_path}: {os.strerror(errno)}")
+            return
+        self.watch_dirs[wd] = dir_path
+
+    def _add_tree(self, dir_path):
+        # add the watches first so nothing created during the scan is missed
+        for current_dir, dirnames, _ in os.walk(dir_path):
+            self._add_watch(current_dir)
+        scan_tree(dir_path, self.pattern, self.on_file)
+
+    def start(self):
+        os.makedirs(self.root_dir, exist_ok=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._add_tree(self.root_dir)
+
+        self.thread = Thread(target=self._run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            readable, _, _ = select.select([self.fd], [], [], 1.0)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, name_len = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = data[offset:offset + name_len].rstrip(b"\0").decode(errors='surrogateescape')
+                offset += name_len
+
+                if mask & IN_Q_OVERFLOW:
+                    # the kernel dropped events, fall back to a full scan
+                    self.scan()
+                    continue
+
+                if mask & (IN_IGNORED | IN_DELETE_SELF):
+                    self.watch_dirs.pop(wd, None)
+                    continue
+
+                dir_path = self.watch_dirs.get(wd)
+                if dir_path is None or not name:
+                    continue
+                path = os.path.join(dir_path, name)
+
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._add_tree(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and fnmatch(name, self.pattern):
+                    self.on_file(path)
+
+    def stop(self):
+        super().stop()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def create_file_watcher(kind: str, root_dir: str, pattern: str, on_file, polling_time: float = 5):
+    if kind not in FILE_WATCHERS:
+        raise ValueError(f"Invalid file watcher: {kind}.  Only {FILE_WATCHERS} allowed.")
+
+    if kind == 'auto':
+        kind = 'inotify' if inotify_available() else 'poll'
+
+    if kind == 'inotify':
+        return InotifyWatcher(root_dir, pattern, on_file, polling_time)
+    elif kind == 'poll':
+        return PollingWatcher(root_dir, pattern, on_file, polling_time)
+    return FileWatcher(root_dir, pattern, on_file, polling_time)
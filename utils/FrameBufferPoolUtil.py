@@ -0,0 +1,53 @@
+from threading import Lock
+import numpy as np
+
+
+class FrameBufferPool:
+    """
+        Reusable full size frame buffers for the copies that outlive a capture buffer, like
+        snapshots waiting in the image writer queue or frames held by the event tracker and the
+        clip recorder.
+
+        copy() takes a free buffer, or allocates a new one when there is none, and copies the frame
+        in to it.  Whoever holds the buffer last hands it back with release().  At most max_free
+        buffers are kept for reuse, so a burst of snapshots does not keep its memory forever.
+
+        allocations counts the new buffers, once the pool has warmed up it should stop going up.
+    """
+
+    def __init__(self, max_free: int = 16):
+        self.max_free = max_free
+        self.free = []
+        self.lock = Lock()
+        self.allocations = 0
+        self.copies = 0
+
+    def copy(self, frame):
+        """
+        :return: a pool buffer holding a copy of frame
+        """
+        buffer = None
+        with self.lock:
+            self.copies += 1
+            while self.free:
+                candidate = self.free.pop()
+                if candidate.shape == frame.shape and candidate.dtype == frame.dtype:
+                    buffer = candidate
+                    break
+            if buffer is None:
+                self.allocations += 1
+
+        if buffer is None:
+            buffer = np.empty_like(frame)
+        np.copyto(buffer, frame)
+        return buffer
+
+    def release(self, buffer):
+        if buffer is None:
+            return
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(buffer)
+
+    def stats_summary(self):
+        return f"Frame pool: {self.copies} copies, {self.allocations} allocations, {len(self.free)} free"
@@ -0,0 +1,320 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+import cv2
+import numpy as np
+
+
+class CachedClip:
+    """
+        The decoded frames of one clip from a FrameCache.
+
+        frames is a read only memory map of the .npy file, indexing and slicing it gives views of
+        the file without copying, and the pages are shared with every other process that has the
+        clip open.  position_msec[i] is CAP_PROP_POS_MSEC of frame i, for the ReplayClock.
+    """
+
+    def __init__(self, key, clip, frames, position_msec, fps, scale, grayscale):
+        self.key = key
+        self.clip = str(clip)
+        self.frames = frames
+        self.position_msec = position_msec
+        self.fps = fps
+        # decoded width / source width
+        self.scale = scale
+        self.grayscale = grayscale
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+
+class FrameCache:
+    """
+        On disk cache of decoded video frames, so a clip that is analysed over and over, by the
+        tuner, the benchmark or main.py, is only decoded once.
+
+        Each clip is kept as a <clip>-<key>.npy file of all of its frames and a <clip>-<key>.json
+        file with the frame positions.  The key is made from the clip path, its modification time
+        and size, and the transform, the width the frames were downscaled to and grayscale, so a
+        clip that is recorded again is decoded again.  The .json file is written last, a clip
+        without one is still being decoded or was interrupted.
+
+        When the .npy files take more than max_bytes, whole clips are evicted, least recently
+        opened first.  The clip being opened is never evicted, even when it is larger than
+        max_bytes on its own.
+    """
+
+    def __init__(self, cache_dir, max_bytes: int = 0):
+        """
+
+        :param cache_dir: directory for the cached clips, shared by every process using the cache
+        :param max_bytes: size limit of the cached frames, 0 for no limit
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.decode_seconds = 0.0
+
+    def key(self, clip, width: int = 0, grayscale: bool = False):
+        """
+        :return: name of the cache entry of clip with the transform
+        """
+        path = Path(clip).resolve()
+        st = path.stat()
+        digest = hashlib.sha1(json.dumps([str(path), st.st_mtime_ns, st.st_size, width, grayscale]).encode()).hexdigest()[:16]
+        return f"{path.stem}-{digest}"
+
+    def _paths(self, key):
+        return self.cache_dir / f"{key}.npy", self.cache_dir / f"{key}.json"
+
+    def open(self, clip, width: int = 0, grayscale: bool = False):
+        """
+        Map the decoded frames of clip, decoding it in to the cache first if it is not there
+
+        :param width: downscale the frames to this width, 0 keeps the source width
+        :param grayscale: keep single channel gray frames instead of BGR
+        :return: CachedClip
+        """
+        key = self.key(clip, width, grayscale)
+        npy_path, json_path = self._paths(key)
+        try:
+            meta, frames = self._map(npy_path, json_path)
+            self.hits += 1
+        except FileNotFoundError:
+            # not cached, or evicted by another process between finding and mapping it
+            self.misses += 1
+            start = time.perf_counter()
+            self._decode(clip, key, width, grayscale)
+            self.decode_seconds += time.perf_counter() - start
+            meta, frames = self._map(npy_path, json_path)
+        self.evict(keep=key)
+
+        return CachedClip(key, clip, frames, np.array(meta['position_msec']), meta['fps'], meta['scale'], grayscale)
+
+    @staticmethod
+    def _map(npy_path, json_path):
+        """
+        :return: (metadata, frames memory map) of a cached clip
+        :raise FileNotFoundError: if the clip is not in the cache
+        """
+        with open(json_path) as f:
+            meta = json.load(f)
+        # the modification time of the .json file is the last use, for the LRU eviction
+        os.utime(json_path)
+        # once mapped the frames stay readable, even if the clip is evicted after this
+        frames = np.load(npy_path, mmap_mode='r')[:meta['frames']]
+        return meta, frames
+
+    def _decode(self, clip, key, width, grayscale):
+        cap = cv2.VideoCapture(str(clip))
+        if not cap.isOpened():
+            raise ValueError(f"Could not open {clip}")
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        # an estimate, the file is sized to it and the frames past the end are not used
+        frame_count = max(1, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+        source_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        source_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        scale = width / source_width if 0 < width < source_width else 1.0
+        size = (int(round(source_width * scale)), int(round(source_height * scale)))
+        shape = (size[1], size[0]) if grayscale else (size[1], size[0], 3)
+
+        npy_path, json_path = self._paths(key)
+        # written under a temporary name so other processes never map a partial file
+        tmp_path = self.cache_dir / f"{key}.{os.getpid()}.tmp.npy"
+        frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(frame_count,) + shape)
+        # frames past the estimate, if CAP_PROP_FRAME_COUNT was short
+        extra = []
+        position_msec = []
+        while True:
+            grabbed, frame = cap.read()
+            if not grabbed or frame is None:
+                break
+            decoded = len(position_msec)
+            position_msec.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+            if scale != 1.0:
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            if grayscale:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if decoded < frame_count:
+                frames[decoded] = frame
+            else:
+                extra.append(frame)
+        cap.release()
+
+        if len(extra) > 0:
+            grown = np.lib.format.open_memmap(f"{tmp_path}.grow.npy", mode='w+', dtype=np.uint8, shape=(len(position_msec),) + shape)
+            grown[:frame_count] = frames
+            grown[frame_count:] = np.stack(extra)
+            grown.flush()
+            del frames, grown
+            os.replace(f"{tmp_path}.grow.npy", tmp_path)
+        else:
+            frames.flush()
+            del frames
+
+        meta = {
+            "clip": str(Path(clip).resolve()),
+            "width": width,
+            "grayscale": grayscale,
+            "frames": len(position_msec),
+            "fps": fps,
+            "scale": scale,
+            "shape": list(shape),
+            "bytes": tmp_path.stat().st_size,
+            "position_msec": position_msec,
+        }
+        os.replace(tmp_path, npy_path)
+        tmp_json = self.cache_dir / f"{key}.{os.getpid()}.tmp.json"
+        with open(tmp_json, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_json, json_path)
+
+        # an older recording of the same clip with the same transform will not be used again
+        for entry in self.entries():
+            if entry['key'] != key and entry['clip'] == meta['clip'] and entry['width'] == width and entry['grayscale'] == grayscale:
+                self._remove(entry['key'])
+
+    def entries(self):
+        """
+        :return: metadata of the cached clips, least recently opened first
+        """
+        entries = []
+        for json_path in self.cache_dir.glob("*.json"):
+            if ".tmp." in json_path.name:
+                continue
+            try:
+                with open(json_path) as f:
+                    meta = json.load(f)
+                meta['last_used'] = json_path.stat().st_mtime
+            except (OSError, ValueError):
+                # removed or being replaced by another process
+                continue
+            meta['key'] = json_path.stem
+            del meta['position_msec']
+            entries.append(meta)
+        entries.sort(key=lambda entry: entry['last_used'])
+        return entries
+
+    def _remove(self, key):
+        npy_path, json_path = self._paths(key)
+        # the .json first, so the entry is never found without its frames.  Processes that
+        # have the frames mapped keep them until they let go of the map.
+        for path in [json_path, npy_path]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep=None):
+        """
+        Remove least recently opened clips until the cache is within max_bytes
+
+        :param keep: key of a clip that is not removed
+        :return: number of clips removed
+        """
+        if self.max_bytes <= 0:
+            return 0
+        entries = self.entries()
+        total = sum(entry['bytes'] for entry in entries)
+        removed = 0
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry['key'] == keep:
+                continue
+            self._remove(entry['key'])
+            total -= entry['bytes']
+            removed += 1
+        self.evictions += removed
+        return removed
+
+    def size_bytes(self):
+        return sum(entry['bytes'] for entry in self.entries())
+
+    def stats_summary(self):
+        limit = f" of {self.max_bytes / (1024 * 1024):.0f}" if self.max_bytes > 0 else ""
+        return (f"Frame cache {self.cache_dir}: {self.hits} hits, {self.misses} misses ({self.decode_seconds:.1f}s decoding), "
+                f"{self.evictions} evicted, {self.size_bytes() / (1024 * 1024):.0f}{limit} MB")
+
+
+class CachedVideoStream:
+    """
+        Reads the frames of a CachedClip with the same interface as a BufferedVideoStream, so the
+        detection loop does not know the frames were not decoded.  read() returns views of the
+        memory map without copying them.  The frames are read only.
+    """
+
+    def __init__(self, cached_clip: CachedClip, frame_step: int = 1, start_msec: float = 0, end_msec: float = None):
+        """
+        :param frame_step, start_msec, end_msec: as for the BufferedVideoStream
+        """
+        self.cached_clip = cached_clip
+        self.frame_step = max(1, frame_step)
+        self.start_msec = start_msec or 0
+        self.end_msec = end_msec
+
+        position_msec = cached_clip.position_msec
+        in_range = position_msec >= self.start_msec
+        if end_msec is not None:
+            # like the BufferedVideoStream, the stream ends at the first frame past end_msec
+            past_end = np.flatnonzero(position_msec > end_msec)
+            if len(past_end) > 0:
+                in_range[past_end[0]:] = False
+        self.indices = np.flatnonzero(in_range)[::self.frame_step]
+
+        self.next = 0
+        self.position_msec = None
+        self.frame_index = None
+        self.frames_read = 0
+        self.frames_skipped = len(cached_clip) - len(self.indices)
+
+    def start(self):
+        return self
+
+    def read(self, latest: bool = False):
+        """
+        :param latest: not used, there is nothing to fall behind on
+        :return: the next frame, or None after the last one
+        """
+        if self.next >= len(self.indices):
+            return None
+        self.frame_index = int(self.indices[self.next])
+        self.position_msec = float(self.cached_clip.position_msec[self.frame_index])
+        self.next += 1
+        self.frames_read += 1
+        return self.cached_clip.frames[self.frame_index]
+
+    def more(self):
+        return self.next < len(self.indices)
+
+    def stop(self):
+        self.next = len(self.indices)
+
+    def stats(self):
+        return {
+            "frames_read": self.frames_read,
+            "frames_skipped": self.frames_skipped,
+        }
+
+    def stats_summary(self):
+        skipped = f", skipped {self.frames_skipped}" if self.frames_skipped > 0 else ""
+        return f"Capture: read {self.frames_read} frames from the frame cache{skipped}, nothing decoded"
+
+
+def create_frame_cache(cache_dir, max_mb: float = 0):
+    """
+    :param cache_dir: None for no cache
+    :return: FrameCache, or None
+    """
+    if cache_dir is None:
+        return None
+    return FrameCache(cache_dir, max_bytes=int((max_mb or 0) * 1024 * 1024))
@@ -0,0 +1,130 @@
+import cv2
+import numpy as np
+
+# the frame is point sampled down to this many times the thumbnail size before it is averaged
+SAMPLE_FACTOR = 4
+
+
+class FrameDifferenceGate:
+    """
+        Cheap check in front of the background subtractor, so the full pipeline does not run on
+        every frame of an empty trail.
+
+        Each frame is shrunk to a thumb_width wide grayscale thumbnail and compared with the
+        thumbnail of the last frame that was fully processed.  While the scene is quiet only every
+        interval'th frame is processed, which also keeps the subtractor model adapting.  As soon as
+        any thumbnail pixel has changed by threshold gray levels, or the subtractor has reported
+        motion, every frame is processed for the next hold_frames frames.
+    """
+
+    def __init__(self, interval: int = 5, threshold: float = 12, hold_frames: int = 30, thumb_width: int = 32):
+        """
+
+        :param interval: process every interval'th frame while the scene is quiet
+        :param threshold: gray level change of a single thumbnail pixel that wakes the gate up
+        :param hold_frames: frames to keep processing every frame after a change or motion
+        :param thumb_width: width of the thumbnail, each thumbnail pixel averages a block of the frame
+        """
+        self.interval = max(1, interval)
+        self.threshold = threshold
+        self.hold_frames = hold_frames
+        self.thumb_width = thumb_width
+
+        self.reference = None
+        self.sample = None
+        self.thumb = None
+        self.gray = None
+        self.diff = None
+        self.roi_mask = None
+        self.frames_since_processed = 0
+        self.hot_frames_left = 0
+
+        self.frames = 0
+        self.frames_gated = 0
+        # time spent in the full pipeline, to estimate the time saved by the gated frames
+        self.processed_seconds = 0.0
+
+    def set_roi_mask(self, roi_mask):
+        """
+        Only look at the thumbnail pixels that overlap the ROIs.
+
+        Also called when the frame size changes, the thumbnail is sized again for the next frame.
+
+        :param roi_mask: mask of the ROIs at any resolution with the same aspect ratio as the frames,
+                None to look at all of the pixels
+        """
+        self.roi_mask = roi_mask
+        self.reference = None
+        self.thumb = None
+        self.sample = None
+
+    def _thumbnail(self, image):
+        if self.thumb is None:
+            h, w = image.shape[:2]
+            thumb_height = max(1, int(round(h * self.thumb_width / w)))
+            if w > SAMPLE_FACTOR * self.thumb_width:
+                self.sample = np.empty((thumb_height * SAMPLE_FACTOR, self.thumb_width * SAMPLE_FACTOR) + image.shape[2:], dtype=image.dtype)
+            self.thumb = np.empty((thumb_height, self.thumb_width) + image.shape[2:], dtype=image.dtype)
+            self.gray = np.empty((thumb_height, self.thumb_width), dtype=image.dtype)
+            self.diff = np.empty((thumb_height, self.thumb_width), dtype=image.dtype)
+            if self.roi_mask is not None:
+                self.roi_mask = cv2.resize(self.roi_mask, (self.thumb_width, thumb_height), interpolation=cv2.INTER_AREA) > 0
+
+        if self.sample is not None:
+            # averaging every pixel of a full size frame costs more than the gate saves, point
+            # sample it first and only average the samples
+            image = cv2.resize(image, self.sample.shape[1::-1], dst=self.sample, interpolation=cv2.INTER_NEAREST)
+        # INTER_AREA averages each block, which also averages out the sensor noise
+        cv2.resize(image, self.thumb.shape[1::-1], dst=self.thumb, interpolation=cv2.INTER_AREA)
+        if self.thumb.ndim == 3:
+            return cv2.cvtColor(self.thumb, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        return self.thumb
+
+    def should_process(self, image):
+        """
+        :return: True if the full pipeline should run on this frame
+        """
+        self.frames += 1
+        thumbnail = self._thumbnail(image)
+
+        if self.reference is None:
+            changed = True
+            self.reference = np.empty_like(thumbnail)
+        else:
+            cv2.absdiff(thumbnail, self.reference, dst=self.diff)
+            delta = self.diff[self.roi_mask] if self.roi_mask is not None else self.diff
+            changed = delta.size > 0 and int(delta.max()) >= self.threshold
+
+        if changed:
+            self.hot_frames_left = self.hold_frames
+
+        self.frames_since_processed += 1
+        if changed or self.hot_frames_left > 0 or self.frames_since_processed >= self.interval:
+            self.hot_frames_left = max(0, self.hot_frames_left - 1)
+            self.frames_since_processed = 0
+            np.copyto(self.reference, thumbnail)
+            return True
+
+        self.frames_gated += 1
+        return False
+
+    def motion(self, motionThisFrame):
+        """
+        Report the result of a processed frame, motion keeps every frame being processed
+        """
+        if motionThisFrame:
+            self.hot_frames_left = self.hold_frames
+
+    def gated_ratio(self):
+        return self.frames_gated / self.frames if self.frames > 0 else 0.0
+
+    def saved_seconds(self):
+        """
+        :return: estimate of the detection time saved, the gated frames times the average processed frame time
+        """
+        processed = self.frames - self.frames_gated
+        return self.frames_gated * self.processed_seconds / processed if processed > 0 else 0.0
+
+    def stats_summary(self):
+        return (f"Frame gate: gated {self.frames_gated} of {self.frames} frames ({self.gated_ratio() * 100:.1f}%), "
+                f"saved about {self.saved_seconds():.1f}s of detection time")
@@ -0,0 +1,127 @@
+import time
+
+
+class FrameRateGovernor:
+    """
+        Limit a processing loop to a target number of frames per second.
+
+        Call wait() once at the top of each loop iteration.  When the loop is running faster
+        than target_fps it sleeps off the remainder of the frame period.  When it is running
+        behind it does not sleep and does not try to catch up, the caller is expected to skip
+        to the latest frame instead.
+    """
+
+    def __init__(self, target_fps: float = 0):
+        """
+
+        :param target_fps: frames per second to run at.  0 or None means no limit
+        """
+        self.target_fps = target_fps
+        self.frame_period = 1.0 / target_fps if target_fps else 0.0
+        self.next_frame_time = None
+        self.behind_count = 0
+
+    def wait(self):
+        if self.frame_period <= 0:
+            return
+
+        now = time.monotonic()
+        if self.next_frame_time is None:
+            self.next_frame_time = now
+
+        if now < self.next_frame_time:
+            time.sleep(self.next_frame_time - now)
+            self.next_frame_time += self.frame_period
+        else:
+            if now - self.next_frame_time > self.frame_period:
+                self.behind_count += 1
+            # behind schedule, restart the schedule from now instead of bursting to catch up
+            self.next_frame_time = now + self.frame_period
+
+
+class CpuBudgetGovernor(FrameRateGovernor):
+    """
+        FrameRateGovernor that also keeps the thread calling wait() within cpu_budget cores, so one
+        busy camera can not take the cores the other cameras in the process need.
+
+        Every adjust_interval seconds the CPU time of the calling thread is compared with the wall
+        time.  When it is over the budget the frame rate is lowered in proportion, and when it is
+        well under the budget the frame rate is raised again, up to target_fps.  Only the calling
+        thread is measured, so the capture thread and OpenCV's own worker threads are not counted.
+        One thread can not use more than one core, so a budget of 1 or more could never be exceeded
+        and is clamped to MAX_CPU_BUDGET.
+    """
+
+    MAX_CPU_BUDGET = 0.95
+
+    def __init__(self, target_fps: float = 0, cpu_budget: float = 0, adjust_interval: float = 5, min_fps: float = 1):
+        """
+
+        :param target_fps: highest frames per second to run at.  0 or None means no limit
+        :param cpu_budget: cores the thread may use, for example 0.5.  0 or None means no budget.
+            Clamped to MAX_CPU_BUDGET
+        :param adjust_interval: seconds between frame rate adjustments
+        :param min_fps: the frame rate is never lowered below this
+        """
+        super().__init__(target_fps)
+        self.max_fps = target_fps or 0
+        self.cpu_budget = cpu_budget or 0
+        if self.cpu_budget > self.MAX_CPU_BUDGET:
+            print(f"WARNING: cpu_budget {self.cpu_budget} is more than one thread can use, clamped to {self.MAX_CPU_BUDGET}")
+            self.cpu_budget = self.MAX_CPU_BUDGET
+        self.adjust_interval = adjust_interval
+        self.min_fps = min_fps
+
+        self.window_start = None
+        self.window_cpu = None
+        self.window_frames = 0
+        self.cpu_usage = 0.0
+        self.fps = 0.0
+        self.adjustments = 0
+
+    def set_target_fps(self, target_fps):
+        self.target_fps = target_fps
+        self.frame_period = 1.0 / target_fps if target_fps else 0.0
+
+    def wait(self):
+        if self.cpu_budget > 0:
+            self._adjust()
+        super().wait()
+
+    def _adjust(self):
+        now = time.monotonic()
+        cpu = time.thread_time()
+        if self.window_start is None:
+            self.window_start, self.window_cpu = now, cpu
+            return
+
+        self.window_frames += 1
+        elapsed = now - self.window_start
+        if elapsed < self.adjust_interval:
+            return
+
+        self.cpu_usage = (cpu - self.window_cpu) / elapsed
+        self.fps = self.window_frames / elapsed
+        self.window_start, self.window_cpu, self.window_frames = now, cpu, 0
+
+        target_fps = self.target_fps
+        if self.cpu_usage > self.cpu_budget:
+            # aim a little under the budget so it does not flip back and forth
+            target_fps = max(self.min_fps, self.fps * 0.9 * self.cpu_budget / self.cpu_usage)
+        elif self.target_fps and self.cpu_usage < self.cpu_budget * 0.7:
+            target_fps = self.target_fps * 1.25
+            if self.max_fps and target_fps >= self.max_fps:
+                target_fps = self.max_fps
+            elif not self.max_fps and target_fps > self.fps * 2:
+                # the limit is no longer what holds the thread back, there was none to begin with
+                target_fps = 0
+
+        if target_fps != self.target_fps:
+            self.adjustments += 1
+            self.set_target_fps(target_fps)
+
+    def stats_summary(self):
+        budget = f"{self.cpu_budget:.2f}" if self.cpu_budget > 0 else "unlimited"
+        limit = f"{self.target_fps:.1f}" if self.target_fps else "unlimited"
+        return (f"CPU {self.cpu_usage:.2f} of {budget} cores, {self.fps:.1f} fps, "
+                f"fps limit {limit}, {self.adjustments} adjustments, behind {self.behind_count} times")
@@ -0,0 +1,138 @@
+import cv2
+import numpy as np
+
+
+class LightingChangeDetector:
+    """
+        Spot global lighting changes, like a cloud, dusk or the camera switching to IR, that make
+        the background model flag the whole frame as motion until it has re-adapted.
+
+        A change is either the mean luminance inside the ROIs jumping by luminance_jump gray levels
+        away from its running average, or more than foreground_ratio of the ROIs being foreground.
+        After a change there is a transition of transition_frames frames.  The caller starts a fresh
+        background model, which learns the new lighting during the transition, and motion is not
+        reported until the transition is over.
+
+        profiles are alternative subtractor settings for a luminance range, for example MOG2 with
+        other params at night.  profile_for() picks the one for the current luminance, and a move in
+        to the range of another profile is also treated as a change.
+    """
+
+    def __init__(self, luminance_jump: float = 25, foreground_ratio: float = 0.5, transition_frames: int = 60,
+                 average_alpha: float = 0.05, profiles: list = None, sample_width: int = 64):
+        """
+
+        :param luminance_jump: gray levels between the luminance and its running average that count as a change, 0 turns it off
+        :param foreground_ratio: fraction of the ROIs that is foreground that counts as a change, 0 turns it off
+        :param transition_frames: frames motion is suppressed for after a change
+        :param average_alpha: weight of each frame in the running average luminance
+        :param profiles: list of dicts with 'name', optional 'min_luminance'/'max_luminance' and the
+                'named_subtractor' and '<name>_params' to use in that range
+        :param sample_width: width the frame is point sampled down to for the luminance
+        """
+        self.luminance_jump = luminance_jump
+        self.foreground_ratio = foreground_ratio
+        self.transition_frames = max(1, transition_frames)
+        self.average_alpha = average_alpha
+        self.profiles = profiles or []
+        self.sample_width = sample_width
+
+        self.roi_mask = None
+        self.roi_pixels = None
+        self.sample = None
+        self.sample_mask = None
+
+        self.average_luminance = None
+        self.luminance = None
+        self.profile = None
+        self.transition_frames_left = 0
+        # True while motion should not be reported, set by update()
+        self.suppressing = False
+
+        self.changes = 0
+        self.frames_suppressed = 0
+
+    def set_roi_mask(self, roi_mask):
+        """
+        Also called when the frame size changes, the luminance sample is sized again for the next frame.
+
+        :param roi_mask: mask of the ROIs at the resolution of the masks passed to update(), None for
+                the whole frame
+        """
+        self.roi_mask = roi_mask
+        self.roi_pixels = cv2.countNonZero(roi_mask) if roi_mask is not None else None
+        self.sample = None
+        self.sample_mask = None
+
+    def _luminance(self, image):
+        if self.sample is None:
+            h, w = image.shape[:2]
+            sample_width = min(w, self.sample_width)
+            sample_height = max(1, int(round(h * sample_width / w)))
+            self.sample = np.empty((sample_height, sample_width) + image.shape[2:], dtype=image.dtype)
+            if self.roi_mask is not None:
+                self.sample_mask = cv2.resize(self.roi_mask, (sample_width, sample_height), interpolation=cv2.INTER_NEAREST)
+                if cv2.countNonZero(self.sample_mask) == 0:
+                    self.sample_mask = None
+
+        cv2.resize(image, self.sample.shape[1::-1], dst=self.sample, interpolation=cv2.INTER_NEAREST)
+        means = cv2.mean(self.sample, self.sample_mask)
+        # BGR weights of the luma, the same as COLOR_BGR2GRAY
+        if image.ndim == 3:
+            return 0.114 * means[0] + 0.587 * means[1] + 0.299 * means[2]
+        return means[0]
+
+    def profile_for(self, luminance):
+        """
+        :return: the first profile whose luminance range has luminance in it, None for the base settings
+        """
+        for profile in self.profiles:
+            if profile.get('min_luminance', -np.inf) <= luminance < profile.get('max_luminance', np.inf):
+                return profile
+        return None
+
+    def update(self, image, mask):
+        """
+        Call once per frame, after the subtractor.
+
+        :param image: the frame at the processing resolution
+        :param mask: the foreground mask of the frame
+        :return: True if the lighting has just changed and a fresh background model should be started
+        """
+        luminance = self._luminance(image)
+        self.luminance = luminance
+        first = self.average_luminance is None
+        if first:
+            self.average_luminance = luminance
+
+        changed = not first and self.luminance_jump > 0 and abs(luminance - self.average_luminance) >= self.luminance_jump
+        self.average_luminance += self.average_alpha * (luminance - self.average_luminance)
+
+        # a fresh model reports plenty of foreground while it learns, only look at it outside a transition
+        if not changed and not first and self.foreground_ratio > 0 and not self.suppressing:
+            roi_pixels = self.roi_pixels if self.roi_pixels else mask.shape[0] * mask.shape[1]
+            changed = cv2.countNonZero(mask) >= roi_pixels * self.foreground_ratio
+
+        # a slow change, like dusk, in to the luminance range of another profile.  On the first
+        # frame this picks the profile to start with
+        changed = changed or self.profile_for(self.average_luminance) is not self.profile
+
+        if changed:
+            # start the running average again from the new lighting
+            self.average_luminance = luminance
+            self.profile = self.profile_for(luminance)
+            self.transition_frames_left = self.transition_frames
+            self.changes += 1
+
+        self.suppressing = self.transition_frames_left > 0
+        if self.suppressing:
+            self.transition_frames_left -= 1
+            self.frames_suppressed += 1
+        return changed
+
+    def profile_name(self):
+        return self.profile.get('name', 'profile') if self.profile is not None else 'base'
+
+    def stats_summary(self):
+        return (f"Lighting: {self.changes} changes, {self.frames_suppressed} frames suppressed, "
+                f"luminance {self.luminance or 0:.0f}, profile {self.profile_name()}")
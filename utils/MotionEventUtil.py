@@ -0,0 +1,297 @@
+from pathlib import Path
+import datetime
+import heapq
+import itertools
+import json
+import cv2
+import numpy as np
+from utils.FrameBufferPoolUtil import FrameBufferPool
+
+SNAPSHOT_MODES = ['interval', 'event']
+
+DEFAULT_SCORE_WEIGHTS = {"area": 1.0, "sharpness": 0.5, "centrality": 0.5}
+
+
+def sharpness(image, rect):
+    """
+    Variance of the Laplacian over rect of the image, higher is sharper.  Motion blur and
+    out of focus frames score low.
+    """
+    (x, y, w, h) = rect
+    crop = image[y:y + h, x:x + w]
+    if crop.size == 0:
+        return 0.0
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY) if crop.ndim == 3 else crop
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+class MotionEvent:
+    """
+        One motion event, from the first motion frame until motion has been absent for
+        end_frames frames.  Keeps the top_k best scoring frames seen so far.
+    """
+
+    def __init__(self, start_time, top_k):
+        self.start_time = start_time
+        self.end_time = start_time
+        self.top_k = top_k
+        self.frames = 0
+        self.motion_frames = 0
+        self.peak_area = 0
+        # min heap of (score, sequence, timestamp, image, info) so the worst of the top_k is at [0]
+        self.best = []
+        self.sequence = itertools.count()
+
+    def would_keep(self, score):
+        return len(self.best) < self.top_k or score > self.best[0][0]
+
+    def add_candidate(self, score, timestamp, image, info):
+        """
+        :return: the image that dropped out of the top_k, or None
+        """
+        entry = (score, next(self.sequence), timestamp, image, info)
+        if len(self.best) < self.top_k:
+            heapq.heappush(self.best, entry)
+            return None
+        return heapq.heapreplace(self.best, entry)[3]
+
+    def best_frames(self):
+        """
+        :return: list of (score, timestamp, image, info), best first
+        """
+        return [(score, timestamp, image, info) for score, _, timestamp, image, info in sorted(self.best, reverse=True)]
+
+
+class MotionEventTracker:
+    """
+        Group motion frames in to events and only snapshot the best few frames of each event,
+        instead of every frames_between_snaps frame while there is motion.
+
+        An event opens after start_frames consecutive motion frames and closes once
+        BackgroundSubtractor.apply has reported end_frames frames in a row without motion, or when
+        it has run for max_frames.  Each motion frame is scored on the area of its largest contour,
+        the sharpness inside that contour's bounding box and how close it is to the centre of the
+        ROIs.  The motion frames before the event opens are scored as well, so the event starts at
+        the first of them.  When the event closes the top_k frames are queued on the image writer
+        along with a <event start>-event.json metadata record.  The metadata records of days older
+        than metadata_days are deleted.
+    """
+
+    def __init__(self, image_writer, output_dir: str, motion_roi_rects: list = None, start_frames: int = 2,
+                 end_frames: int = 15, max_frames: int = 900, top_k: int = 3, score_weights: dict = None,
+                 sharpness_reference: float = 500.0, frame_pool: FrameBufferPool = None,
+                 motion_roi_polygons: list = None, metadata_days: int = 7):
+        """
+
+        :param image_writer: BackgroundImageWriter the chosen frames are queued on
+        :param output_dir: detected_motion_dir, snapshots go in to day sub directories of it
+        :param motion_roi_rects: (x0, y0, x1, y1) ROIs, the centrality score is relative to their centre
+        :param motion_roi_polygons: lists of (x, y) points, used along with motion_roi_rects
+        :param start_frames: consecutive motion frames needed to open an event
+        :param end_frames: consecutive frames without motion that close an event
+        :param max_frames: frames after which a long running event is closed and a new one opened
+        :param top_k: number of frames snapshot per event
+        :param score_weights: weights of the 'area', 'sharpness' and 'centrality' scores
+        :param sharpness_reference: Laplacian variance that counts as fully sharp
+        :param frame_pool: pool the kept frames are copied in to
+        :param metadata_days: days of event.json records to keep, 0 keeps them all
+        """
+        self.image_writer = image_writer
+        self.output_dir = output_dir
+        self.start_frames = max(1, start_frames)
+        self.end_frames = max(1, end_frames)
+        self.max_frames = max_frames
+        self.top_k = max(1, top_k)
+        self.score_weights = dict(DEFAULT_SCORE_WEIGHTS, **(score_weights or {}))
+        self.sharpness_reference = sharpness_reference
+        self.motion_roi_rects = motion_roi_rects or []
+        self.motion_roi_polygons = motion_roi_polygons or []
+        self.frame_pool = frame_pool if frame_pool is not None else image_writer.frame_pool
+        self.metadata_days = metadata_days
+        self.pruned_day = None
+
+        self.event = None
+        self.motion_run = 0
+        # (score, timestamp, image, info) of the motion frames of a run that has not opened an event yet
+        self.run_frames = []
+        self.events_closed = 0
+        self.snaps_queued = 0
+
+    def _centre(self, frame_shape):
+        corners = [(x0, y0) for x0, y0, _, _ in self.motion_roi_rects] + [(x1, y1) for _, _, x1, y1 in self.motion_roi_rects]
+        for polygon in self.motion_roi_polygons:
+            corners.extend(polygon)
+        if len(corners) > 0:
+            points = np.array(corners)
+            xmin, ymin = points.min(axis=0)
+            xmax, ymax = points.max(axis=0)
+        else:
+            xmin, ymin, xmax, ymax = 0, 0, frame_shape[1], frame_shape[0]
+        return (xmin + xmax) / 2, (ymin + ymax) / 2, max(1.0, np.hypot(xmax - xmin, ymax - ymin) / 2)
+
+    def score(self, image, motion_rects, motion_areas):
+        """
+        :param motion_rects: (x, y, w, h) of each motion blob, BackgroundSubtractor.motion_rects
+        :param motion_areas: area of each motion blob, BackgroundSubtractor.motion_areas
+        :return: (score, info dict), higher score is a better snapshot
+        """
+        largest = int(np.argmax(motion_areas))
+        area = motion_areas[largest]
+        rect = motion_rects[largest]
+
+        frame_area = image.shape[0] * image.shape[1]
+        area_score = min(1.0, area / (frame_area * 0.05))
+
+        sharp = sharpness(image, rect)
+        sharpness_score = min(1.0, sharp / self.sharpness_reference)
+
+        cx, cy, radius = self._centre(image.shape)
+        distance = np.hypot(rect[0] + rect[2] / 2 - cx, rect[1] + rect[3] / 2 - cy)
+        centrality_score = max(0.0, 1.0 - distance / radius)
+
+        w = self.score_weights
+        score = w['area'] * area_score + w['sharpness'] * sharpness_score + w['centrality'] * centrality_score
+        # (minX, minY, maxX, maxY) around all of the motion, for a snapshot encoder that crops to it
+        rects = np.array(motion_rects)
+        motion_box = [int(rects[:, 0].min()), int(rects[:, 1].min()), int((rects[:, 0] + rects[:, 2]).max()), int((rects[:, 1] + rects[:, 3]).max())]
+        info = {"area": float(area), "sharpness": round(sharp, 1), "centrality": round(float(centrality_score), 3), "rect": list(rect),
+                "motion_box": motion_box}
+        return score, info
+
+    def update(self, timestamp, motionThisFrame, framesWithoutMotion, motion_rects, motion_areas, image):
+        """
+        Call once per frame with the results of BackgroundSubtractor.apply, and its motion_rects
+        and motion_areas.
+
+        :param timestamp: datetime of the frame
+        :param image: full resolution frame to snapshot.  It is only copied if it scores in the top_k
+                so far, or before an event opens, so it can be a capture buffer that is about to be reused.
+        :return: number of snapshots queued by this call
+        """
+        queued = 0
+        if motionThisFrame and len(motion_rects) > 0:
+            self.motion_run += 1
+        else:
+            self.motion_run = 0
+
+        if self.event is None:
+            if self.motion_run == 0:
+                self._release_run_frames()
+                return 0
+            if self.motion_run < self.start_frames:
+                # kept until the run is long enough to open an event, at most start_frames - 1 of them
+                score, info = self.score(image, motion_rects, motion_areas)
+                self.run_frames.append((score, timestamp, self.frame_pool.copy(image), info))
+                return 0
+            self._open_event()
+
+        event = self.event
+        event.frames += 1
+        event.end_time = timestamp
+
+        if self.motion_run > 0:
+            score, info = self.score(image, motion_rects, motion_areas)
+            self._add_motion_frame(score, timestamp, image, info)
+
+        if framesWithoutMotion >= self.end_frames or event.frames >= self.max_frames:
+            queued = self.close()
+        return queued
+
+    def _open_event(self):
+        run_frames, self.run_frames = self.run_frames, []
+        self.event = MotionEvent(run_frames[0][1] if run_frames else None, self.top_k)
+        for score, timestamp, image, info in run_frames:
+            self.event.frames += 1
+            self._add_motion_frame(score, timestamp, image, info, copy=False)
+
+    def _add_motion_frame(self, score, timestamp, image, info, copy=True):
+        event = self.event
+        if event.start_time is None:
+            event.start_time = timestamp
+        event.end_time = timestamp
+        event.motion_frames += 1
+        event.peak_area = max(event.peak_area, info['area'])
+        if event.would_keep(score):
+            self.frame_pool.release(event.add_candidate(score, timestamp, self.frame_pool.copy(image) if copy else image, info))
+        elif not copy:
+            self.frame_pool.release(image)
+
+    def _release_run_frames(self):
+        for _, _, image, _ in self.run_frames:
+            self.frame_pool.release(image)
+        self.run_frames = []
+
+    def _prune_metadata(self, day):
+        """
+        Delete the event.json records of the days more than metadata_days before day, once a day.
+        """
+        if self.metadata_days <= 0 or day == self.pruned_day:
+            return
+        self.pruned_day = day
+        oldest = (day - datetime.timedelta(days=self.metadata_days)).strftime("%Y%m%d")
+        for metadata_fqn in Path(self.output_dir).glob("*/*-event.json"):
+            if metadata_fqn.parent.name < oldest:
+                metadata_fqn.unlink(missing_ok=True)
+
+    def close(self):
+        """
+        Close the open event, if there is one, and queue its snapshots and metadata.
+
+        :return: number of snapshots queued
+        """
+        self._release_run_frames()
+        event = self.event
+        if event is None:
+            return 0
+        self.event = None
+        self.events_closed += 1
+
+        day_outputdir = Path(self.output_dir) / event.start_time.strftime("%Y%m%d")
+        day_outputdir.mkdir(parents=True, exist_ok=True)
+
+        queued = 0
+        snapshots = []
+        for score, timestamp, image, info in event.best_frames():
+            image_fqn = day_outputdir / f"{timestamp.strftime('%Y%m%d-%H%M%S.%f')[:-3]}{self.image_writer.extension}"
+            # the writer owns the image from here, and releases it back to the pool
+            if self.image_writer.add_image_to_queue(str(image_fqn), image, throttle=False, motion_box=info['motion_box']):
+                queued += 1
+            snapshots.append(dict(info, file=image_fqn.name, score=round(score, 3), time=timestamp.isoformat()))
+
+        metadata = {
+            "start": event.start_time.isoformat(),
+            "end": event.end_time.isoformat(),
+            "seconds": (event.end_time - event.start_time).total_seconds(),
+            "frames": event.frames,
+            "motion_frames": event.motion_frames,
+            "peak_area": event.peak_area,
+            "snapshots": snapshots,
+        }
+        with open(day_outputdir / f"{event.start_time.strftime('%Y%m%d-%H%M%S.%f')[:-3]}-event.json", 'w') as f:
+            json.dump(metadata, f, indent=2)
+        self._prune_metadata(event.start_time.date())
+
+        print(f"Motion event {metadata['start']} {metadata['seconds']:.1f}s, {event.motion_frames} motion frames, {queued} snapshots")
+        self.snaps_queued += queued
+        return queued
+
+
+def create_event_tracker(conf, image_writer, motion_roi_rects=None, frame_pool=None, motion_roi_polygons=None):
+    """
+    :return: a MotionEventTracker when conf['snapshot_mode'] is 'event', otherwise None
+    """
+    snapshot_mode = conf['snapshot_mode'] or 'interval'
+    if snapshot_mode not in SNAPSHOT_MODES:
+        raise ValueError(f"Invalid snapshot_mode: {snapshot_mode}.  Only {SNAPSHOT_MODES} allowed.")
+    if snapshot_mode != 'event':
+        return None
+
+    return MotionEventTracker(image_writer, conf['detected_motion_dir'], motion_roi_rects,
+                              start_frames=conf['event_start_frames'] or 2,
+                              end_frames=conf['event_end_frames'] or 15,
+                              max_frames=conf['event_max_frames'] or 900,
+                              top_k=conf['event_top_k'] or 3,
+                              score_weights=conf['event_score_weights'],
+                              frame_pool=frame_pool,
+                              motion_roi_polygons=motion_roi_polygons,
+                              metadata_days=conf['event_metadata_days'] if conf['event_metadata_days'] is not None else 7)
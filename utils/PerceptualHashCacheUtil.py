@@ -0,0 +1,154 @@
+from collections import deque
+from threading import Event, Lock
+import time
+import cv2
+import numpy as np
+
+
+def dhash(image_bytes, hash_size: int = 8):
+    """
+    Difference hash of an encoded image.  JPEGs are decoded at 1/8 scale in grayscale, which is
+    much cheaper than a full decode and is all the hash needs.
+
+    :return: hash_size * hash_size bit int, or None if the bytes could not be decoded
+    """
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        return None
+
+    small = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(hash1: int, hash2: int):
+    return bin(hash1 ^ hash2).count("1")
+
+
+class PendingResult:
+    """
+        A result that one thread is computing and other threads with a near duplicate image wait for
+    """
+
+    def __init__(self, image_hash):
+        self.image_hash = image_hash
+        self.result = None
+        self.done = Event()
+
+    def wait(self, timeout: float = 60):
+        """
+        :return: the result, or None if computing it failed or took longer than timeout
+        """
+        self.done.wait(timeout)
+        return self.result
+
+
+class PerceptualHashCache:
+    """
+        Remember results by the perceptual hash of the image they were computed for, so a near
+        duplicate image seen within window_seconds can reuse the result.
+
+        Consecutive snapshots of the same scene differ by a few bits of the hash, so entries match
+        when the hamming distance is at most max_distance.  Only the last window_seconds of entries
+        are kept, which also keeps the linear search short.
+
+        Threads working through a burst of near duplicates at the same time would all miss, so
+        reserve() also matches results that are still being computed, see PendingResult.
+    """
+
+    def __init__(self, window_seconds: float = 30, max_distance: int = 6, clock=time.monotonic):
+        """
+
+        :param clock: seconds from a monotonic clock, replaced in tests
+        """
+        self.window_seconds = window_seconds
+        self.max_distance = max_distance
+        self.clock = clock
+        self.entries = deque()
+        self.pending = []
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        # lookups that waited for another thread's result
+        self.waits = 0
+
+    def _expire(self, now):
+        while self.entries and now - self.entries[0][0] > self.window_seconds:
+            self.entries.popleft()
+
+    def _closest(self, image_hash):
+        best = None
+        best_distance = self.max_distance + 1
+        for _, entry_hash, result in self.entries:
+            distance = hamming_distance(image_hash, entry_hash)
+            if distance < best_distance:
+                best, best_distance = result, distance
+        return best
+
+    def get(self, image_hash):
+        """
+        :return: the result of the closest entry within max_distance, or None
+        """
+        if image_hash is None:
+            return None
+
+        with self.lock:
+            self._expire(self.clock())
+            best = self._closest(image_hash)
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return best
+
+    def reserve(self, image_hash):
+        """
+        Look up image_hash, and on a miss reserve it so other threads wait for this one's result.
+
+        :return: (result, pending, owner).  On a hit the result.  When another thread is computing
+                the result for a near duplicate, the PendingResult to wait() on.  Otherwise owner
+                is True, and the caller computes the result and hands it to complete(pending, result),
+                or None on failure.  An image_hash of None gives (None, None, False).
+        """
+        if image_hash is None:
+            return None, None, False
+
+        with self.lock:
+            self._expire(self.clock())
+            best = self._closest(image_hash)
+            if best is not None:
+                self.hits += 1
+                return best, None, False
+
+            for pending in self.pending:
+                if hamming_distance(image_hash, pending.image_hash) <= self.max_distance:
+                    self.waits += 1
+                    return None, pending, False
+
+            self.misses += 1
+            pending = PendingResult(image_hash)
+            self.pending.append(pending)
+            return None, pending, True
+
+    def complete(self, pending, result):
+        """
+        Finish a reservation from reserve().  A result of None is not cached, the threads waiting
+        on it compute their own.
+        """
+        with self.lock:
+            self.pending.remove(pending)
+            if result is not None:
+                now = self.clock()
+                self._expire(now)
+                self.entries.append((now, pending.image_hash, result))
+        pending.result = result
+        pending.done.set()
+
+    def put(self, image_hash, result):
+        if image_hash is None:
+            return
+
+        with self.lock:
+            now = self.clock()
+            self._expire(now)
+            self.entries.append((now, image_hash, result))
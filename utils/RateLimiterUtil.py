@@ -0,0 +1,50 @@
+from threading import Lock
+import time
+
+
+class RateLimiter:
+    """
+        Token bucket shared by several threads, to keep calls to a remote API under its
+        transactions per second limit instead of finding the limit by getting throttled.
+
+        Call acquire() before each call.  It returns straight away while there are tokens left
+        and otherwise sleeps until the next token is due.
+    """
+
+    def __init__(self, max_per_second: float = 0, burst: int = 1, clock=time.monotonic, sleep=time.sleep):
+        """
+
+        :param max_per_second: calls allowed per second.  0 or None means no limit
+        :param burst: calls that can be made back to back after the limiter has been idle
+        :param clock: seconds from a monotonic clock, replaced in tests
+        :param sleep: sleeps for the given seconds, replaced in tests
+        """
+        self.max_per_second = max_per_second
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(self.burst)
+        self.last_refill = self.clock()
+        self.lock = Lock()
+        self.wait_seconds = 0.0
+
+    def acquire(self):
+        """
+        :return: seconds spent waiting for a token
+        """
+        if not self.max_per_second:
+            return 0.0
+
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.max_per_second)
+            self.last_refill = now
+
+            # take the token now, going negative reserves the next one for this caller
+            self.tokens -= 1
+            wait = -self.tokens / self.max_per_second if self.tokens < 0 else 0.0
+            self.wait_seconds += wait
+
+        if wait > 0:
+            self.sleep(wait)
+        return wait
@@ -0,0 +1,143 @@
+import csv
+import datetime
+import json
+import os
+import re
+from pathlib import Path
+import cv2
+
+# 20221018-093015.250 at the start of a file name, as written by the EventClipRecorder
+CLIP_TIME_PATTERN = re.compile(r"(\d{8}-\d{6})(\.\d{3})?")
+
+
+def clip_start_time(clip):
+    """
+    When a recorded clip started.  Taken from a %Y%m%d-%H%M%S file name, like the clips of the
+    EventClipRecorder, otherwise the file modification time less the clip duration, as the file is
+    last written when the recording ends.
+
+    :return: datetime
+    """
+    match = CLIP_TIME_PATTERN.match(Path(clip).name)
+    if match is not None:
+        start = datetime.datetime.strptime(match.group(1), "%Y%m%d-%H%M%S")
+        if match.group(2):
+            start += datetime.timedelta(milliseconds=int(match.group(2)[1:]))
+        return start
+
+    cap = cv2.VideoCapture(str(clip))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    cap.release()
+    duration = frame_count / fps if fps > 0 else 0.0
+    # whole milliseconds, so the snapshot names are the same on file systems with finer mtimes
+    return datetime.datetime.fromtimestamp(round(os.path.getmtime(clip) - duration, 3))
+
+
+class ReplayClock:
+    """
+        Timestamps for the frames of a recorded clip, the clip start time plus the position of the
+        frame in the clip.  A replay stamps its snapshots, events and timeline the same way on every
+        run, however fast it runs, where datetime.now() would stamp them with the processing time.
+    """
+
+    def __init__(self, cap, start_time: datetime.datetime):
+        """
+
+        :param cap: BufferedVideoStream of the clip
+        """
+        self.cap = cap
+        self.start_time = start_time
+
+    @property
+    def frame_index(self):
+        """
+        frame number in the clip of the frame last read from cap
+        """
+        return self.cap.frame_index
+
+    def timestamp(self):
+        """
+        :return: datetime of the frame last read from cap
+        """
+        return self.start_time + datetime.timedelta(milliseconds=round(self.cap.position_msec))
+
+
+class MotionTimeline:
+    """
+        The motion result of each replayed frame, and the motion intervals made from them.
+
+        Only the detection results go in to the timeline, nothing that depends on how fast the
+        replay ran, so two replays of a clip with the same settings write identical files.
+    """
+
+    CSV_FIELDS = ["frame", "position_ms", "time", "motion", "blobs", "min_x", "min_y", "max_x", "max_y"]
+
+    def __init__(self, clip, clock: ReplayClock, settings: dict = None):
+        """
+
+        :param settings: replay settings recorded in the json timeline, frame_step etc.
+        """
+        self.clip = str(clip)
+        self.clock = clock
+        self.settings = settings or {}
+        self.rows = []
+        self.intervals = []
+        self._open_interval = None
+
+    def add(self, timestamp, motion, motion_rects, motion_box):
+        """
+        Call once per frame with the results of BackgroundSubtractor.apply
+
+        :param timestamp: ReplayClock.timestamp() of the frame
+        :param motion_box: (minX, minY, maxX, maxY) from BackgroundSubtractor.apply
+        """
+        frame_index = self.clock.frame_index
+        position_ms = round((timestamp - self.clock.start_time).total_seconds() * 1000)
+        if not motion:
+            motion_box = (None, None, None, None)
+        self.rows.append([frame_index, position_ms, timestamp.isoformat(timespec='milliseconds'), int(motion),
+                          len(motion_rects)] + [None if v is None else int(v) for v in motion_box])
+
+        if motion:
+            if self._open_interval is None:
+                self._open_interval = {"start_frame": frame_index, "start_ms": position_ms, "motion_frames": 0}
+                self.intervals.append(self._open_interval)
+            self._open_interval['end_frame'] = frame_index
+            self._open_interval['end_ms'] = position_ms
+            self._open_interval['motion_frames'] += 1
+        else:
+            self._open_interval = None
+
+    def summary(self):
+        motion_frames = sum(row[3] for row in self.rows)
+        return {
+            "clip": Path(self.clip).name,
+            "start_time": self.clock.start_time.isoformat(timespec='milliseconds'),
+            "settings": self.settings,
+            "frames": len(self.rows),
+            "motion_frames": motion_frames,
+            "motion_pct": (motion_frames / len(self.rows)) * 100 if self.rows else 0.0,
+            "intervals": len(self.intervals),
+        }
+
+    def write(self, output_dir):
+        """
+        Write <clip>-timeline.json with the summary and the motion intervals, and <clip>-timeline.csv
+        with a row per frame.
+
+        :return: path of the json timeline
+        """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        stem = Path(self.clip).stem
+
+        json_path = output_dir / f"{stem}-timeline.json"
+        with open(json_path, 'w') as f:
+            json.dump(dict(self.summary(), motion_intervals=self.intervals), f, indent=2)
+
+        with open(output_dir / f"{stem}-timeline.csv", 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.CSV_FIELDS)
+            writer.writerows(self.rows)
+        return json_path
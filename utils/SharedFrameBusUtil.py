@@ -0,0 +1,336 @@
+from multiprocessing import shared_memory, resource_tracker
+import os
+import time
+import numpy as np
+
+# first int64 of the shared memory, so a subscriber can tell it attached to a frame bus
+MAGIC = 0x4D4F54494F4E4255
+VERSION = 2
+HEADER_FIELDS = 16
+SLOT_FIELDS = 8
+# motion rectangles kept per frame, any more are left out
+MAX_RECTS = 32
+ALIGN = 64
+
+# global header fields
+_MAGIC, _VERSION, _SLOTS, _FRAME_H, _FRAME_W, _FRAME_C, _MASK_H, _MASK_W, _LATEST_SEQ, _SLOT_SIZE, _CLOSED, _GENERATION, _REPLACED, _PID = range(14)
+# slot header fields.  seq is -1 while the slot is being written
+_SEQ, _TIMESTAMP_US, _MOTION, _RECT_COUNT = range(4)
+
+
+# names of the buses published from this process.  Python's resource tracker is per process, and a
+# subscriber in the publishing process must leave the publisher's registration alone.
+_published = set()
+
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _live_publisher(name):
+    """
+    :return: pid of the process still publishing the existing shared memory called name, or None
+            when it is closed, replaced or left behind by a process that is gone
+    """
+    existing = shared_memory.SharedMemory(name=name)
+    try:
+        if name not in _published:
+            resource_tracker.unregister(existing._name, "shared_memory")
+        if existing.size < HEADER_FIELDS * 8:
+            return None
+        header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=existing.buf)
+        magic, closed, replaced, pid = (int(header[field]) for field in [_MAGIC, _CLOSED, _REPLACED, _PID])
+        del header
+    finally:
+        existing.close()
+
+    if magic != MAGIC or closed or replaced or not _pid_running(pid):
+        return None
+    return pid
+
+
+def _align(size):
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _layout(frame_shape, mask_shape):
+    """
+    :return: (slot header offset, rects offset, frame offset, mask offset) in a slot, and the slot size
+    """
+    rects_offset = _align(SLOT_FIELDS * 8)
+    frame_offset = _align(rects_offset + MAX_RECTS * 4 * 4)
+    mask_offset = _align(frame_offset + int(np.prod(frame_shape)))
+    slot_size = _align(mask_offset + int(np.prod(mask_shape)))
+    return 0, rects_offset, frame_offset, mask_offset, slot_size
+
+
+class _SlotViews:
+    def __init__(self, buf, offset, frame_shape, mask_shape):
+        header_offset, rects_offset, frame_offset, mask_offset, _ = _layout(frame_shape, mask_shape)
+        self.header = np.ndarray((SLOT_FIELDS,), dtype=np.int64, buffer=buf, offset=offset + header_offset)
+        self.rects = np.ndarray((MAX_RECTS, 4), dtype=np.int32, buffer=buf, offset=offset + rects_offset)
+        self.frame = np.ndarray(frame_shape, dtype=np.uint8, buffer=buf, offset=offset + frame_offset)
+        self.mask = np.ndarray(mask_shape, dtype=np.uint8, buffer=buf, offset=offset + mask_offset)
+
+
+class FrameBusPublisher:
+    """
+        Publish each frame, its foreground mask and the motion results in to a ring of slots in
+        multiprocessing.shared_memory, so processes other than the detector, like the display or a
+        snapshot encoder, can map them without copying and without competing for the detector's GIL.
+
+        Each slot has a sequence number that is set to -1 while the slot is written and to the
+        frame's sequence number once it is complete.  A subscriber checks it before and after using
+        a slot, see FrameBusSubscriber.  The shared memory is created on the first publish(), when
+        the frame and mask sizes are known, and removed by close().  When the frame or mask size
+        changes, for example at the next clip of a --video-dir run, the shared memory is replaced
+        by a new one of the same name and the subscribers attach to it on their next read().
+    """
+
+    def __init__(self, name: str, slots: int = 8):
+        """
+
+        :param name: shared memory name the subscribers attach to
+        :param slots: frames kept in the ring.  A subscriber has slots - 1 frame times to use a frame
+                before it can be overwritten.
+        """
+        self.name = name
+        self.slots = max(2, slots)
+        self.shm = None
+        self.header = None
+        self.slot_views = None
+        self.frame_shape = None
+        self.mask_shape = None
+        # number of times the shared memory was replaced for a new frame size
+        self.generation = 0
+        self.seq = 0
+
+    def _create(self, frame_shape, mask_shape):
+        slot_size = _layout(frame_shape, mask_shape)[-1]
+        size = _align(HEADER_FIELDS * 8) + slot_size * self.slots
+        try:
+            self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        except FileExistsError:
+            pid = _live_publisher(self.name)
+            if pid is not None:
+                raise FileExistsError(f"Frame bus {self.name} is already being published by process {pid}, "
+                                      f"give each publisher its own frame_bus name")
+            # left behind by a run that did not shut down cleanly
+            stale = shared_memory.SharedMemory(name=self.name)
+            stale.unlink()
+            stale.close()
+            self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        _published.add(self.name)
+
+        self.header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=self.shm.buf)
+        self.header[:] = 0
+        self.slot_views = [_SlotViews(self.shm.buf, _align(HEADER_FIELDS * 8) + i * slot_size, frame_shape, mask_shape)
+                           for i in range(self.slots)]
+        for views in self.slot_views:
+            views.header[_SEQ] = -1
+
+        frame_h, frame_w = frame_shape[:2]
+        frame_c = frame_shape[2] if len(frame_shape) == 3 else 1
+        self.header[[_VERSION, _SLOTS, _FRAME_H, _FRAME_W, _FRAME_C, _MASK_H, _MASK_W, _LATEST_SEQ, _SLOT_SIZE]] = \
+            [VERSION, self.slots, frame_h, frame_w, frame_c, mask_shape[0], mask_shape[1], -1, slot_size]
+        self.header[_GENERATION] = self.generation
+        self.header[_PID] = os.getpid()
+        self.frame_shape, self.mask_shape = frame_shape, mask_shape
+        # the magic goes in last, a subscriber that sees it sees a complete header
+        self.header[_MAGIC] = MAGIC
+        print(f"Frame bus {self.name}: {self.slots} slots of {slot_size / (1024 * 1024):.1f} MB")
+
+    def publish(self, timestamp, frame, mask, motion, motion_rects=None):
+        """
+        Copy a frame and its mask in to the next slot.
+
+        :param timestamp: datetime of the frame
+        :param motion_rects: (x, y, w, h) motion rectangles, BackgroundSubtractor.motion_rects
+        :return: sequence number of the frame
+        """
+        if self.shm is not None and (frame.shape != self.frame_shape or mask.shape != self.mask_shape):
+            print(f"Frame bus {self.name}: frame size changed from {self.frame_shape} to {frame.shape}, replacing it")
+            self._unlink(replaced=True)
+            self.generation += 1
+        if self.shm is None:
+            self._create(frame.shape, mask.shape)
+
+        seq = self.seq
+        views = self.slot_views[seq % self.slots]
+        views.header[_SEQ] = -1
+        np.copyto(views.frame, frame)
+        np.copyto(views.mask, mask)
+        rects = (motion_rects or [])[:MAX_RECTS]
+        if rects:
+            views.rects[:len(rects)] = rects
+        views.header[_TIMESTAMP_US] = int(timestamp.timestamp() * 1000000)
+        views.header[_MOTION] = int(motion)
+        views.header[_RECT_COUNT] = len(rects)
+        views.header[_SEQ] = seq
+        self.header[_LATEST_SEQ] = seq
+        self.seq += 1
+        return seq
+
+    def _unlink(self, replaced: bool = False):
+        """
+        :param replaced: tell the subscribers to attach to the new shared memory instead of stopping
+        """
+        if replaced:
+            self.header[_REPLACED] = 1
+        else:
+            self.header[_CLOSED] = 1
+        self.header = None
+        self.slot_views = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+        _published.discard(self.name)
+
+    def close(self):
+        if self.shm is None:
+            return
+        self._unlink()
+
+
+class BusFrame:
+    """
+        A frame read from the bus.  frame and mask are views of the shared memory, they are only
+        good while valid() is True, so check it after using them or take a copy().
+    """
+
+    def __init__(self, views, seq):
+        self.views = views
+        self.seq = seq
+        self.timestamp = views.header[_TIMESTAMP_US] / 1000000
+        self.motion = bool(views.header[_MOTION])
+        self.motion_rects = [tuple(int(v) for v in rect) for rect in views.rects[:views.header[_RECT_COUNT]]]
+        self.frame = views.frame
+        self.mask = views.mask
+
+    def valid(self):
+        """
+        :return: False if the publisher has started writing another frame in to this slot
+        """
+        return int(self.views.header[_SEQ]) == self.seq
+
+    def copy(self):
+        """
+        :return: (frame, mask) copies, or None if the slot was overwritten while copying
+        """
+        frame, mask = self.frame.copy(), self.mask.copy()
+        return (frame, mask) if self.valid() else None
+
+
+class FrameBusSubscriber:
+    """
+        Read the frames of a FrameBusPublisher in another process.
+    """
+
+    def __init__(self, name: str, timeout: float = 30):
+        """
+
+        :param timeout: seconds to wait for the publisher to create the bus
+        """
+        self.name = name
+        self.timeout = timeout
+        self.retired = []
+        self._map()
+        self.last_seq = -1
+        self.frames_missed = 0
+
+    def _map(self):
+        self.shm = self._attach(self.name, self.timeout)
+        self.header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=self.shm.buf)
+        while self.header[_MAGIC] != MAGIC:
+            time.sleep(0.05)
+
+        self.generation = int(self.header[_GENERATION])
+        self.slots = int(self.header[_SLOTS])
+        frame_c = int(self.header[_FRAME_C])
+        frame_shape = (int(self.header[_FRAME_H]), int(self.header[_FRAME_W])) + ((frame_c,) if frame_c > 1 else ())
+        mask_shape = (int(self.header[_MASK_H]), int(self.header[_MASK_W]))
+        slot_size = int(self.header[_SLOT_SIZE])
+        self.frame_shape = frame_shape
+        self.slot_views = [_SlotViews(self.shm.buf, _align(HEADER_FIELDS * 8) + i * slot_size, frame_shape, mask_shape)
+                           for i in range(self.slots)]
+
+    @staticmethod
+    def _attach(name, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                shm = shared_memory.SharedMemory(name=name)
+                break
+            except FileNotFoundError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        # the publisher owns the shared memory, without this python removes it when a subscriber exits.
+        # In the publishing process the registration is the publisher's, it unregisters when it unlinks.
+        if name not in _published:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+    def closed(self):
+        return bool(self.header[_CLOSED])
+
+    def read(self, latest: bool = True):
+        """
+        :param latest: skip ahead to the newest frame, otherwise return the next frame in order
+                while it is still in the ring
+        :return: BusFrame, or None if there is no new frame
+        """
+        if self.header[_REPLACED]:
+            # the publisher's frame size changed, sequence numbers carry on in the new shared memory
+            self._release()
+            self._map()
+            print(f"Frame bus {self.name}: attached to generation {self.generation}, {self.frame_shape}")
+        latest_seq = int(self.header[_LATEST_SEQ])
+        if latest_seq <= self.last_seq:
+            return None
+
+        seq = latest_seq
+        if not latest:
+            # the oldest frame still in the ring
+            seq = max(self.last_seq + 1, latest_seq - self.slots + 2)
+        if seq > self.last_seq + 1:
+            self.frames_missed += seq - self.last_seq - 1
+
+        views = self.slot_views[seq % self.slots]
+        bus_frame = BusFrame(views, seq)
+        if not bus_frame.valid():
+            # overwritten before we got to it, try again with the newest one
+            self.last_seq = seq
+            return self.read(latest=True)
+        self.last_seq = seq
+        return bus_frame
+
+    def _release(self):
+        self.header = None
+        self.slot_views = None
+        self.retired.append(self.shm)
+        # a BusFrame the caller still holds keeps its shared memory mapped until it is let go of
+        for shm in list(self.retired):
+            try:
+                shm.close()
+                self.retired.remove(shm)
+            except BufferError:
+                pass
+
+    def close(self):
+        self._release()
+
+
+def create_frame_bus(conf):
+    """
+    :return: a FrameBusPublisher named conf['frame_bus'], or None when it is not set
+    """
+    if not conf['frame_bus']:
+        return None
+    return FrameBusPublisher(conf['frame_bus'], conf['frame_bus_slots'] or 8)
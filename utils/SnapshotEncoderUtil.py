@@ -0,0 +1,129 @@
+from pathlib import Path
+import cv2
+
+SNAPSHOT_FORMATS = ['jpg', 'webp', 'png']
+
+# suffix added to the file name of the full frame thumbnail
+THUMBNAIL_SUFFIX = "-thumb"
+# file names of thumbnails, for the file watchers to leave out
+THUMBNAIL_PATTERN = f"*{THUMBNAIL_SUFFIX}.*"
+
+
+def thumbnail_path(snapshot_path):
+    """
+    :return: Path of the thumbnail that goes with snapshot_path
+    """
+    snapshot_path = Path(snapshot_path)
+    return snapshot_path.with_name(f"{snapshot_path.stem}{THUMBNAIL_SUFFIX}{snapshot_path.suffix}")
+
+
+class SnapshotEncoder:
+    """
+        Encode a snapshot the way a deployment wants it, smaller files for an SD card and a cellular
+        uplink, or full quality on a desktop.
+
+        The snapshot can be cropped to the motion box, grown by crop_margin on each side, and is
+        downscaled to max_width when it is wider.  With thumbnail_width a small full frame thumbnail
+        is encoded as well, so the crop can still be placed in the scene.
+    """
+
+    def __init__(self, format: str = 'jpg', quality: int = 95, max_width: int = 0, crop_to_motion: bool = False,
+                 crop_margin: float = 0.25, thumbnail_width: int = 0, png_compression: int = 3):
+        """
+
+        :param format: one of SNAPSHOT_FORMATS
+        :param quality: 1-100 for jpg and webp, png is lossless and uses png_compression instead
+        :param max_width: snapshots wider than this are downscaled to it, 0 keeps the full width
+        :param crop_to_motion: crop the snapshot to the motion box
+        :param crop_margin: fraction of the motion box width and height added on each side of the crop
+        :param thumbnail_width: width of the full frame thumbnail, 0 for no thumbnail
+        :param png_compression: 0-9, higher is smaller and slower
+        """
+        if format not in SNAPSHOT_FORMATS:
+            raise ValueError(f"Invalid snapshot format: {format}.  Only {SNAPSHOT_FORMATS} allowed.")
+
+        self.format = format
+        self.extension = f".{format}"
+        self.quality = quality
+        self.max_width = max_width
+        self.crop_to_motion = crop_to_motion
+        self.crop_margin = crop_margin
+        self.thumbnail_width = thumbnail_width
+
+        if format == 'jpg':
+            self.params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        elif format == 'webp':
+            self.params = [int(cv2.IMWRITE_WEBP_QUALITY), quality]
+        else:
+            self.params = [int(cv2.IMWRITE_PNG_COMPRESSION), png_compression]
+
+    def crop_rect(self, frame_shape, motion_box):
+        """
+        :param motion_box: (minX, minY, maxX, maxY) around all of the motion, as returned by BackgroundSubtractor.apply
+        :return: (x0, y0, x1, y1) of the crop, or None to keep the whole frame
+        """
+        if not self.crop_to_motion or motion_box is None:
+            return None
+        (minX, minY, maxX, maxY) = motion_box
+        if minX == float('inf') or maxX <= minX or maxY <= minY:
+            return None
+
+        h, w = frame_shape[:2]
+        margin_x = int((maxX - minX) * self.crop_margin)
+        margin_y = int((maxY - minY) * self.crop_margin)
+        return (max(0, int(minX) - margin_x), max(0, int(minY) - margin_y),
+                min(w, int(maxX) + margin_x), min(h, int(maxY) + margin_y))
+
+    @staticmethod
+    def _downscale(image, width):
+        h, w = image.shape[:2]
+        if width <= 0 or w <= width:
+            return image
+        return cv2.resize(image, (width, max(1, int(round(h * width / w)))), interpolation=cv2.INTER_AREA)
+
+    def encode(self, frame, motion_box=None):
+        """
+        :return: list of (file name suffix, encoded bytes), the snapshot with suffix "" and the
+                thumbnail with THUMBNAIL_SUFFIX
+        """
+        image = frame
+        crop = self.crop_rect(frame.shape, motion_box)
+        if crop is not None:
+            (x0, y0, x1, y1) = crop
+            image = frame[y0:y1, x0:x1]
+        image = self._downscale(image, self.max_width)
+
+        ok, encoded = cv2.imencode(self.extension, image, self.params)
+        if not ok:
+            raise ValueError(f"Could not encode the snapshot as {self.format}")
+        encoded_files = [("", encoded)]
+
+        if self.thumbnail_width > 0:
+            ok, thumbnail = cv2.imencode(self.extension, self._downscale(frame, self.thumbnail_width), self.params)
+            if ok:
+                encoded_files.append((THUMBNAIL_SUFFIX, thumbnail))
+        return encoded_files
+
+    def describe(self):
+        description = f"{self.format}"
+        if self.format != 'png':
+            description += f" q{self.quality}"
+        if self.max_width > 0:
+            description += f" max {self.max_width}px"
+        if self.crop_to_motion:
+            description += f" crop +{self.crop_margin:.0%}"
+        if self.thumbnail_width > 0:
+            description += f" thumb {self.thumbnail_width}px"
+        return description
+
+
+def create_snapshot_encoder(conf):
+    """
+    :return: SnapshotEncoder with the snapshot_* settings of conf
+    """
+    return SnapshotEncoder(format=conf['snapshot_format'] or 'jpg',
+                           quality=conf['snapshot_quality'] or 95,
+                           max_width=conf['snapshot_max_width'] or 0,
+                           crop_to_motion=bool(conf['snapshot_crop_to_motion']),
+                           crop_margin=conf['snapshot_crop_margin'] if conf['snapshot_crop_margin'] is not None else 0.25,
+                           thumbnail_width=conf['snapshot_thumbnail_width'] or 0)
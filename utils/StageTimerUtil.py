@@ -0,0 +1,134 @@
+from collections import deque
+import json
+import time
+import numpy as np
+
+
+class NullStageTimer:
+    """
+        Stage timer that does nothing.  This is the default so the detection loop pays only
+        for an empty method call per stage when instrumentation is turned off.
+    """
+    enabled = False
+
+    def add_gauge(self, name, fn):
+        pass
+
+    def start(self):
+        pass
+
+    def lap(self, stage):
+        pass
+
+    def end_frame(self):
+        pass
+
+    def report(self):
+        pass
+
+
+NULL_STAGE_TIMER = NullStageTimer()
+
+
+class StageTimer:
+    """
+        Time each stage of the per frame detection pipeline.
+
+        Call start() at the top of the frame, lap(stage) right after each stage finishes, and
+        end_frame() when the frame is done.  lap() charges the time since the previous start()/lap()
+        to the stage.  Stages that run more than once in a frame, like the per ROI crops, are added up.
+
+        The last `window` frames of each stage are kept and every `interval` seconds end_frame()
+        writes a p50/p95/p99 summary, in milliseconds, to stdout or appends it as one JSON line
+        to `output_file`.  Gauges are callables that are sampled at report time, for example
+        the image writer queue size.
+    """
+    enabled = True
+
+    def __init__(self, interval: float = 10, window: int = 1000, output_file: str = None, gauges: dict = None):
+        self.interval = interval
+        self.window = window
+        self.output_file = output_file
+        self.gauges = gauges if gauges is not None else {}
+
+        self.samples = {}
+        self.current = {}
+        self.frame_start = None
+        self.last_lap = None
+        self.frames = 0
+        self.last_report_time = time.monotonic()
+        self.last_report_frames = 0
+
+    def add_gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def start(self):
+        self.frame_start = self.last_lap = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.current[stage] = self.current.get(stage, 0.0) + (now - self.last_lap)
+        self.last_lap = now
+
+    def end_frame(self):
+        now = time.perf_counter()
+        self.current['total'] = now - self.frame_start
+
+        for stage, seconds in self.current.items():
+            stage_samples = self.samples.get(stage)
+            if stage_samples is None:
+                stage_samples = self.samples[stage] = deque(maxlen=self.window)
+            stage_samples.append(seconds)
+        self.current = {}
+        self.frames += 1
+
+        if time.monotonic() - self.last_report_time >= self.interval:
+            self.report()
+
+    def summary(self):
+        now = time.monotonic()
+        elapsed = now - self.last_report_time
+        stats = {
+            "time": time.time(),
+            "frames": self.frames,
+            "fps": (self.frames - self.last_report_frames) / elapsed if elapsed > 0 else 0.0,
+            "stages": {},
+            "gauges": {},
+        }
+
+        # report the stages in pipeline order with the frame total last
+        for stage in sorted(self.samples, key=lambda name: name == 'total'):
+            stage_samples = self.samples[stage]
+            p50, p95, p99 = np.percentile(np.fromiter(stage_samples, dtype=np.float64), [50, 95, 99]) * 1000
+            stats['stages'][stage] = {"p50": round(p50, 3), "p95": round(p95, 3), "p99": round(p99, 3)}
+
+        for name, fn in self.gauges.items():
+            try:
+                stats['gauges'][name] = fn()
+            except Exception as exc:
+                stats['gauges'][name] = str(exc)
+
+        return stats
+
+    def report(self):
+        stats = self.summary()
+        self.last_report_time = time.monotonic()
+        self.last_report_frames = self.frames
+
+        if self.output_file is not None:
+            with open(self.output_file, 'a') as f:
+                f.write(json.dumps(stats) + "\n")
+        else:
+            stages = "  ".join(f"{stage} {s['p50']:.1f}/{s['p95']:.1f}/{s['p99']:.1f}" for stage, s in stats['stages'].items())
+            gauges = "  ".join(f"{name}={value}" for name, value in stats['gauges'].items())
+            print(f"Stats: {stats['frames']} frames, {stats['fps']:.1f} fps.  ms p50/p95/p99: {stages}  {gauges}")
+
+
+def create_stage_timer(conf):
+    """
+    :return: a StageTimer when conf['stage_stats'] is set, otherwise the NULL_STAGE_TIMER
+    """
+    if not conf['stage_stats']:
+        return NULL_STAGE_TIMER
+
+    return StageTimer(interval=conf['stats_interval'] or 10, output_file=conf['stats_file'])
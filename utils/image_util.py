@@ -1,3 +1,4 @@
+import cv2
 import numpy as np
 
 
@@ -21,3 +22,91 @@ def mask_image_to_rectanges(image, list_of_rect_rois: list, background_color='bl
     return masked_frame
 
 
+
+def clip_rectangles(list_of_rect_rois: list, width: int, height: int):
+    """
+    Clip (xmin, ymin, xmax, ymax) rectangles to the frame bounds, dropping any that end up empty.
+    """
+    clipped = []
+    for (xmin, ymin, xmax, ymax) in list_of_rect_rois:
+        xmin, xmax = max(0, min(xmin, width)), max(0, min(xmax, width))
+        ymin, ymax = max(0, min(ymin, height)), max(0, min(ymax, height))
+        if xmax > xmin and ymax > ymin:
+            clipped.append((xmin, ymin, xmax, ymax))
+
+    return clipped
+
+
+def merge_overlapping_rectangles(list_of_rect_rois: list):
+    """
+    Group rectangles that overlap (directly or through a chain of other rectangles).
+
+    :return: list of (union_rect, member_rects) tuples where union_rect is the bounding
+             box of all of the member rectangles.
+    """
+    groups = [[rect] for rect in list_of_rect_rois]
+
+    def _bbox(rects):
+        return (min(r[0] for r in rects), min(r[1] for r in rects),
+                max(r[2] for r in rects), max(r[3] for r in rects))
+
+    def _overlaps(a, b):
+        return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(groups)):
+            for j in range(i + 1, len(groups)):
+                if any(_overlaps(a, b) for a in groups[i] for b in groups[j]):
+                    groups[i].extend(groups.pop(j))
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return [(_bbox(group), group) for group in groups]
+
+
+def scale_rectangles(list_of_rect_rois: list, scale: float):
+    """
+    Scale (xmin, ymin, xmax, ymax) rectangles between coordinate spaces, rounding outwards so
+    a scaled rectangle always covers the original region.
+    """
+    return [(int(np.floor(xmin * scale)), int(np.floor(ymin * scale)), int(np.ceil(xmax * scale)), int(np.ceil(ymax * scale)))
+            for (xmin, ymin, xmax, ymax) in list_of_rect_rois]
+
+
+def scale_polygons(list_of_polygons: list, scale: float):
+    """
+    Scale polygons, lists of (x, y) points, between coordinate spaces
+    """
+    return [[(int(round(x * scale)), int(round(y * scale))) for (x, y) in polygon] for polygon in list_of_polygons]
+
+
+def polygon_bounding_rect(polygon, width: int, height: int):
+    """
+    :return: (xmin, ymin, xmax, ymax) of the pixels the polygon covers, clipped to the frame, with
+            xmax/ymax exclusive like the ROI rectangles.  None if it is outside of the frame.
+    """
+    xs = [x for x, _ in polygon]
+    ys = [y for _, y in polygon]
+    clipped = clip_rectangles([(min(xs), min(ys), max(xs) + 1, max(ys) + 1)], width, height)
+    return clipped[0] if clipped else None
+
+
+def build_roi_mask(shape: tuple, list_of_rect_rois: list = None, list_of_polygons: list = None, offset: tuple = (0, 0)):
+    """
+    Compile ROI rectangles and polygons in to one uint8 mask, 255 inside any ROI and 0 outside.
+    Rectangles cover the same pixels as mask_image_to_rectanges, [ymin:ymax, xmin:xmax].
+
+    :param shape: (height, width) of the mask
+    :param offset: (x, y) that is subtracted from the ROI coordinates, to build the mask of a crop
+    """
+    mask = np.zeros(shape, dtype=np.uint8)
+    ox, oy = offset
+    for (xmin, ymin, xmax, ymax) in list_of_rect_rois or []:
+        mask[max(0, ymin - oy):max(0, ymax - oy), max(0, xmin - ox):max(0, xmax - ox)] = 255
+    if list_of_polygons:
+        cv2.fillPoly(mask, [np.array(polygon, dtype=np.int32) for polygon in list_of_polygons], 255, offset=(-ox, -oy))
+    return mask
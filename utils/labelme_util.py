@@ -0,0 +1,31 @@
+import json
+
+
+def read_labelme_polygons(labelme_json_path):
+    """
+    Read the ROI shapes from a LabelMe (https://github.com/wkentaro/labelme) annotation file.
+    labelImg can only draw rectangles, LabelMe can also draw polygons that follow a curving trail.
+
+    'polygon' shapes are returned as they are and 'rectangle' shapes are turned in to 4 point
+    polygons.  Other shape types are ignored.
+
+    :return: list of polygons, each a list of (x, y) points
+    """
+    motion_roi_polygons = []
+
+    if labelme_json_path is not None:
+        with open(labelme_json_path) as f:
+            annotation = json.load(f)
+
+        for shape in annotation.get('shapes', []):
+            points = [(int(round(x)), int(round(y))) for x, y in shape['points']]
+            shape_type = shape.get('shape_type', 'polygon')
+            if shape_type == 'polygon' and len(points) >= 3:
+                motion_roi_polygons.append(points)
+            elif shape_type == 'rectangle' and len(points) == 2:
+                (x0, y0), (x1, y1) = points
+                x0, x1 = min(x0, x1), max(x0, x1)
+                y0, y1 = min(y0, y1), max(y0, y1)
+                motion_roi_polygons.append([(x0, y0), (x1, y0), (x1, y1), (x0, y1)])
+
+    return motion_roi_polygons
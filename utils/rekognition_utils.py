@@ -1,4 +1,5 @@
 # https://github.com/awsdocs/aws-doc-sdk-examples/blob/main/python/example_code/rekognition/rekognition_objects.py
+import time
 
 
 class RekognitionFace:
@@ -154,6 +155,29 @@ class RekognitionLabel:
         return rendering
 
 
+class StubRekognitionClient:
+    """
+        Stand in for the boto3 rekognition client that answers detect_labels locally, for running
+        the AWSRekognitionFileWatcher without an AWS account or network.
+    """
+
+    def __init__(self, labels=None, latency: float = 0.2):
+        """
+
+        :param labels: label dicts, in the format returned by detect_labels, to return for every image
+        :param latency: seconds each call takes, to stand in for the round trip to AWS
+        """
+        self.labels = labels if labels is not None else [{'Name': 'Vehicle', 'Confidence': 95.0, 'Instances': [], 'Parents': []}]
+        self.latency = latency
+        self.calls = 0
+
+    def detect_labels(self, Image, MaxLabels=10, MinConfidence=80):
+        time.sleep(self.latency)
+        self.calls += 1
+        labels = [label for label in self.labels if label.get('Confidence', 0) >= MinConfidence]
+        return {'Labels': labels[:MaxLabels]}
+
+
 def create_collection(collection_name, rekognition_client):
     response = rekognition_client.create_collection(CollectionId=collection_name)
     if response['StatusCode'] == 200: